@@ -107,7 +107,7 @@ class DliClient:
   It is based on the Zolera SOAP Infrastructure (http://pywebsvcs.sourceforge.net/).
   """
 
-  def __init__(self, dli_endpoint = None, verbosity = DLI_VERB_WARN):
+  def __init__(self, dli_endpoint = None, verbosity = DLI_VERB_WARN, useTemplate = True):
     """
     Constructor of the class. It sets the DLI enpoint to communicate with
     and the verbosity level.
@@ -123,14 +123,21 @@ class DliClient:
  
     The verbosity level affects invocations of all methods in this object. See
     the setVerbosity method for information on accepted values.
+
+    If useTemplate is True, the DLI queries are built from a pre-rendered
+    SOAP envelope and their replies parsed with a light parser (see the
+    dliClient_types.DliSOAP.listReplicasUrls method), rather than being
+    serialized and parsed by ZSI (which is anyway used for SOAP faults).
       
     @exception SetupError: if no DLI endpoint can be found.
 
     @param dli_endpoint: the DLI endpoint to be used, as a string of form "hostname[:port]"
     @param verbosity: value for the verbosity level
+    @param useTemplate: boolean (default True) for the fast SOAP request building and parsing
     """
   
     self.endpoint = dli_endpoint
+    self.useTemplate = useTemplate
 
     if (not self.endpoint):
       self.endpoint = environ.get("DLI_ENDPOINT")
@@ -168,13 +175,15 @@ class DliClient:
     """
 
 
-    # Build the SOAP request 
-    request = dliClient_types.new_listReplicasRequest(file, fileType)
-
     try:
        # Query
-       response  = self.iface.listReplicas(request)
-       result = response.urlList
+       if(self.useTemplate):
+          result = self.iface.listReplicasUrls(file, fileType)
+       else:
+          # Build the SOAP request 
+          request = dliClient_types.new_listReplicasRequest(file, fileType)
+          response  = self.iface.listReplicas(request)
+          result = response.urlList
     except ZSIFaultException, inst:
        # This hack is due to extrange behaviour of DLI when an LFN has no replica
        if((inst.fault.string == "Out of memory") or (inst.fault.string == "NoURLFound")):
@@ -20,8 +20,13 @@
 #########################################
 import ZSI
 from ZSI import client
+from ZSI.auth import AUTH
 from ZSI.TCcompound import Struct
 import urlparse, types
+import httplib
+import base64, time
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 from dliClient import TypeError
 from dliClient import ValueError
 
@@ -32,8 +37,85 @@ from dliClient import ValueError
 NAMESPACE = "urn:DataLocationInterface" 
 METHOD_NAME = "listReplicas"
 
+# Pre-rendered listReplicas request (as serialized by ZSI, without the
+# optional element ids), with the input type and data to be substituted
+LISTREPLICAS_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<SOAP-ENV:Envelope
+  xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"
+  xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/"
+  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+  xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+  xmlns:ZSI="http://www.zolera.com/schemas/ZSI/" 
+  SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/" >
+<SOAP-ENV:Body>
+<%(method)s xmlns="%(ns)s">
+<inputDataType xsi:type="xsd:string">%%(inputDataType)s</inputDataType>
+<inputData xsi:type="xsd:string">%%(inputData)s</inputData>
+</%(method)s>
+</SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+""" % {'method': METHOD_NAME, 'ns': NAMESPACE}
+
 
   
+#########################################
+# DliBinding class
+#########################################
+
+class DliBinding(client.Binding):
+    """
+    ZSI Binding that can also send an already serialized SOAP request
+    (see SendRaw). The reply is read with the usual Binding methods
+    (ReceiveRaw, Receive...).
+    """
+
+    def SendRaw(self, soapdata, url = None, soapaction = None):
+        """
+        Sends the specified SOAP request (a string), in the same way as
+        Binding.Send does after serializing the request object. 
+        
+        NOTE: This is a copy of the transport part of Binding.Send in 
+        ZSI 1.7 (HTTP headers, basic authentication, tracing), so it should 
+        be checked against that method if another ZSI version is used.
+
+        @param soapdata: the SOAP request, as a string
+        @param url: the URL to POST to (default: that of the binding)
+        @param soapaction: value of the SOAPAction header (default: that of the binding)
+        """
+        # Tracing?
+        if self.trace:
+            print >>self.trace, "_" * 33, time.ctime(time.time()), "REQUEST:"
+            print >>self.trace, soapdata
+
+        # Send the request
+        if isinstance(self.host, unicode):
+            self.host = str(self.host)
+        if not isinstance(self.port, int):
+            self.port = int(self.port)
+
+        if not self.ssl:
+            self.h = httplib.HTTPConnection(self.host, self.port)
+        else:
+            self.h = httplib.HTTPSConnection(self.host, self.port, **self.ssl_files)
+
+        self.h.connect()
+        self.h.putrequest("POST", url or self.url)
+        self.h.putheader("Content-length", "%d" % len(soapdata))
+        self.h.putheader("Content-type", 'text/xml; charset=utf-8')
+        self.h.putheader("SOAPAction", '"%s"' % (soapaction or self.soapaction))
+        if self.auth_style & AUTH.httpbasic:
+            val = base64.encodestring(self.auth_user + ':' + self.auth_pass).replace("\012", "")
+            self.h.putheader('Authorization', 'Basic ' + val)
+        for header, value in self.user_headers:
+            self.h.putheader(header, value)
+        self.h.endheaders()
+        self.h.send(soapdata)
+
+        # Clear prior receive state
+        self.data, self.ps = None, None
+
+
+
 #########################################
 # DliSOAP class
 #########################################
@@ -68,7 +150,43 @@ class DliSOAP:
            raise ValueError(msg)
 
         # Create the Binding (connect to the web service)
-        self.binding = client.Binding(**kw)
+        self.binding = DliBinding(**kw)
+
+
+    def listReplicasUrls(self, file, fileType = "lfn"):
+        """
+        Queries the DLI for the list of SURLs for the specified LFN/GUID/Dataset,
+        like listReplicas, but without using the ZSI typecodes for the common
+        case. The request is built from a pre-rendered envelope (see
+        LISTREPLICAS_TEMPLATE), and the response is parsed with a light
+        expat parser (see UrlListParser). Only if the response is not a
+        plain listReplicasResponse (e.g. a SOAP fault), it is parsed by ZSI
+        as a full SOAP message (so that the same exceptions are raised).
+
+        @param file: the LFN/GUID/DataSet Id of the file/dataset to query upon
+        @param fileType: the type of file identifier being used ("lfn"/"guid"/"dataset")
+
+        @return: the list of SURLs, as a list of strings
+        """
+        b = self.binding
+        soapdata = LISTREPLICAS_TEMPLATE % {'inputDataType': escape(fileType),
+                                            'inputData': escape(file)}
+        if isinstance(soapdata, unicode):
+            soapdata = soapdata.encode('utf-8')
+
+        # Send the request and get the reply (see DliBinding)
+        b.SendRaw(soapdata)
+        data = b.ReceiveRaw()
+        if not b.IsSOAP():
+            raise TypeError('Response is "%s", not "text/xml"' % b.reply_headers.type)
+
+        # Parse the reply
+        urls = UrlListParser().parse(data)
+        if urls != None:
+            return urls
+
+        # Not the usual reply: leave it to ZSI (the received reply is reused)
+        return b.Receive(listReplicasResponseWrapper).urlList
 
 
     def listReplicas(self, request):
@@ -102,6 +220,86 @@ class DliSOAP:
 
 
 
+#########################################
+# UrlListParser class
+#########################################
+
+class UrlListParser:
+    """
+    Light parser of listReplicas responses. It just gets the text of the
+    elements within the urlList element (in the SOAP body), without
+    building a DOM tree or using typecodes.
+    """
+
+    def parse(self, data):
+        """
+        Parses the specified listReplicas response and returns the list
+        of SURLs in it. If the response is not well-formed, or it is
+        something else (e.g. a SOAP fault, or uses multi-reference values),
+        None is returned instead (and the response should be parsed by ZSI).
+
+        @param data: the SOAP response, as a string
+
+        @return: the list of SURLs, as a list of strings (or None)
+        """
+        self.urls = []
+        self.found = False
+        self.valid = True
+        self.depth = 0       # depth within the urlList element (0 if not inside)
+        self.text = None
+        p = expat.ParserCreate()
+        p.StartElementHandler = self._start
+        p.EndElementHandler = self._end
+        p.CharacterDataHandler = self._chars
+        try:
+            p.Parse(data, 1)
+        except expat.ExpatError:
+            return None
+        if self.found and self.valid:
+            return self.urls
+        return None
+
+    def _start(self, name, attrs):
+        local = name.split(':')[-1]
+        if self.depth:
+            self.depth += 1
+            if (self.depth > 2) or self._isReference(attrs):
+                self.valid = False
+            else:
+                self.text = []
+        elif local == 'urlList':
+            self.found = True
+            self.depth = 1
+            if self._isReference(attrs):
+                self.valid = False
+        elif local == 'Fault':
+            self.valid = False
+
+    def _isReference(self, attrs):
+        # Multi-reference (href) or nil (xsi:nil) values are left to ZSI
+        for attr in attrs.keys():
+            if (attr == 'href') or (attr.split(':')[-1] == 'nil'):
+                return True
+        return False
+
+    def _end(self, name):
+        if self.depth:
+            if (self.depth == 2) and (self.text != None):
+                url = ''.join(self.text).strip()
+                try:
+                    url = str(url)
+                except UnicodeError:
+                    pass
+                self.urls.append(url)
+                self.text = None
+            self.depth -= 1
+
+    def _chars(self, data):
+        if self.text != None:
+            self.text.append(data)
+
+
+
 #######################################################
 # Dli Client Data Objects (request, response) classes
 #######################################################
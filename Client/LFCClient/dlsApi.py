@@ -636,6 +636,36 @@ class DlsApi(object):
     raise NotImplementedError(msg)
 
 
+  def iterEntries(self, dir = "/", **kwd):
+    """
+    Generator version of the dumpEntries method. It returns the same
+    information, but instead of building the whole list before returning
+    it, it yields each DlsEntry object as soon as it is retrieved. This
+    allows to dump very big catalogs with a bounded amount of memory (and
+    to start processing the entries before the whole dump is finished).
+
+    The arguments and flags are those of the dumpEntries method. If session
+    (**kwd) is set to True, the session lasts until the iteration is
+    finished (or the iterator is closed or garbage collected).
+
+    @exception XXXX: On error with the DLS catalog
+
+    @param dir: the FileBlock dir, as string or DlsFileBlock object
+    @param kwd: Flags:
+     - session: boolean (default False) for using a session for the operations
+     - recursive: boolean (default False) for recursive listing of a directory 
+     - showProd: boolean (default False) for turning off the filtering of prod-only replicas
+     - showCAF: boolean (default False) for turning off the filtering of CAF replicas
+     - subscribed: boolean (default False) for showing only subscribed replicas
+     - custodial: boolean (default False) for showing only custodial replicas
+
+    @return: iterator on DlsEntry objects representing the DLS data
+    """
+    msg = "This is just a base class!"
+    msg += " This method should be implemented in an instantiable DLS API class"
+    raise NotImplementedError(msg)
+
+
   def getFileLocs(self, fileBlockList, **kwd):
     """
     Returns the files composing the specified FileBlocks and the locations
@@ -676,6 +706,39 @@ class DlsApi(object):
     raise NotImplementedError(msg)
    
 
+  def iterFileLocs(self, fileBlockList, **kwd):
+    """
+    Generator version of the getFileLocs method. It returns the same
+    information, but instead of building the whole list before returning
+    it, it yields a (DlsFileBlock, DlsFile, list of DlsLocation objects)
+    tuple for each file in the specified FileBlocks, as soon as it is
+    retrieved. This allows to process very long listings with a bounded
+    amount of memory.
+
+    NOTE: Only some DLS API implementations will support this method.
+
+    The arguments and flags are those of the getFileLocs method. In addition,
+    if errorTolerant (**kwd) is set to True, the method will not break on the
+    first error, but will warn and try to keep on with the rest of fileblocks.
+
+    @exception XXXX: On error with the DLS catalog
+
+    @param fileBlockList: the FileBlock as string/DlsFileBlock (or list of those)
+    @param kwd: Flags:
+     - errorTolerant: boolean (default False) for raising an exception after failure
+     - showProd: boolean (default False) for turning off the filtering of prod-only replicas
+     - showCAF: boolean (default False) for turning off the filtering of CAF replicas
+     - subscribed: boolean (default False) for showing only subscribed replicas
+     - custodial: boolean (default False) for showing only custodial replicas
+
+    @return: iterator on (DlsFileBlock, DlsFile, list of DlsLocation) tuples
+    """
+
+    msg = "This is just a base class!"
+    msg += " This method should be implemented in an instantiable DLS API class"
+    raise NotImplementedError(msg)
+   
+
   def startSession(self):
     """
     For DLS implementations supporting sessions (for performance improvements
@@ -0,0 +1,1122 @@
+#
+# $Id$
+#
+# DLS Client. $Name: DLS_1_1_3 $.
+# Antonio Delgado Peris. CIEMAT. CMS.
+#
+
+"""
+ This module implements a caching layer for the CMS Dataset Location
+ Service (DLS) client interface, as defined by the dlsApi module.
+
+ The DlsCacheApi class extends the DlsApi class and wraps any other DLS API
+ object (e.g. one returned by dlsClient.getDlsApi). It keeps the results of
+ the getLocations and getFileBlocks methods in a bounded in-memory cache, so
+ that repeated queries for the same FileBlocks (or locations) are answered
+ without contacting the DLS back-end. Optionally, the results are also kept
+ in a local sqlite file (see the DlsDiskCache class), to be shared between
+ processes (e.g. among successive invocations of the CLI tools). The rest of
+ methods are passed to the wrapped object.
+"""
+
+#########################################
+# Imports
+#########################################
+import dlsApi
+from dlsDataObjects import DlsFileBlock, DlsLocation, DlsSharedLocation, DlsEntry
+from dlsDataObjects import internHost, internLocation, DlsDataObjectError
+from dlsDefaults import DLS_CACHE_TTL, DLS_CACHE_NEGATIVE_TTL, DLS_CACHE_MAX_MEMORY
+from dlsDefaults import DLS_CACHE_FILE_TIMEOUT
+import threading
+import time
+import sys
+import json
+try:
+   import sqlite3
+except ImportError:
+   sqlite3 = None
+
+#########################################
+# Module globals
+#########################################
+
+# getLocations flags that change the results (part of the cache keys)
+_RESULT_FLAGS = ('longList', 'showProd', 'showCAF', 'subscribed', 'custodial')
+
+# getFileBlocks flags that change the results (part of the cache keys)
+_FILEBLOCKS_FLAGS = ('showProd', 'showCAF', 'subscribed', 'custodial', 'cmsSite')
+
+# Estimated memory taken by the objects of a cache record (bytes)
+_RECORD_SIZE = sys.getsizeof([None] * 6) + sys.getsizeof((None, None)) + 100
+_ENTRY_SIZE = sys.getsizeof(DlsEntry(DlsFileBlock(''))) + sys.getsizeof(DlsFileBlock(''))
+_LOCATION_SIZE = sys.getsizeof(DlsLocation('x'))
+
+# Fields of the cache records (in their circular LRU list)
+_PREV, _NEXT, _KEY, _ENTRY, _EXPIRES, _SIZE = range(6)
+
+# Maximum number of FileBlock names per query to the on-disk cache
+_SQL_MAX_VARS = 500
+
+
+#########################################
+# DlsCacheApi class
+#########################################
+
+class DlsCacheApi(dlsApi.DlsApi):
+  """
+  This class is an implementation of the DLS client interface, defined by
+  the dlsApi.DlsApi class, that adds a cache of FileBlock locations to any
+  other implementation (the back-end API object).
+
+  The results of getLocations are cached per FileBlock, and shown again
+  until they expire (see the constructor). The cache is bounded by an
+  estimation of its memory use, and the least recently used entries are
+  dropped first when this is exceeded. Queries that return no locations
+  for a FileBlock are also cached (negative entries), but for a shorter
+  time. The entries of the FileBlocks modified through this object (with
+  add, update, delete or renameFileBlock) are removed from the cache.
+  Notice that changes by other DLS clients will not be seen until the
+  entries expire.
+
+  The results of getFileBlocks are also cached, per query (see that
+  method).
+
+  All other methods are passed to the back-end API object as they are.
+
+  The cache is safe to use from several threads.
+  """
+
+  def __init__(self, api, **kwd):
+    """
+    Constructor of the class. It sets the back-end DLS API object, whose
+    server and verbosity are also used for this object.
+
+    The ttl and negativeTtl arguments (**kwd) set the time (in seconds)
+    that the locations of a FileBlock, or the fact that it has no
+    locations, are kept in the cache. The maxMemory argument (**kwd) sets
+    the maximum (estimated) size of the cache, in bytes.
+
+    If the cacheFile argument (**kwd) is set, the results are also stored
+    in that file (see DlsDiskCache), and looked up there when not found in
+    memory. If the file cannot be used, a warning is printed and only the
+    memory cache is used.
+
+    @param api: the back-end DLS API object (a dlsApi.DlsApi instance)
+    @param kwd: Flags:
+      - ttl: Integer (default DLS_CACHE_TTL), lifetime of the cached locations
+      - negativeTtl: Integer (default DLS_CACHE_NEGATIVE_TTL), lifetime of the negative entries
+      - maxMemory: Integer (default DLS_CACHE_MAX_MEMORY), max size of the cache (bytes)
+      - cacheFile: String (default None), path of the on-disk cache (sqlite file)
+    """
+
+    # Keywords
+    ttl = DLS_CACHE_TTL
+    if(kwd.has_key("ttl")):            ttl = kwd.get("ttl")
+    negativeTtl = DLS_CACHE_NEGATIVE_TTL
+    if(kwd.has_key("negativeTtl")):    negativeTtl = kwd.get("negativeTtl")
+    maxMemory = DLS_CACHE_MAX_MEMORY
+    if(kwd.has_key("maxMemory")):      maxMemory = kwd.get("maxMemory")
+    cacheFile = None
+    if(kwd.has_key("cacheFile")):      cacheFile = kwd.get("cacheFile")
+
+    dlsApi.DlsApi.__init__(self, api.server, api.verb)
+    self.api = api
+    self.ttl = ttl
+    self.negativeTtl = negativeTtl
+    self.maxMemory = maxMemory
+
+    # Cache records, in a dict (by key) and a circular LRU list (whose
+    # root record is self.root, and the oldest is self.root[_NEXT]). The
+    # keys are (name, flags) for getLocations, and (None, hosts, flags)
+    # for getFileBlocks
+    self.lock = threading.Lock()
+    self.records = {}
+    self.keysByName = {}
+    self.fileBlocksKeys = {}
+    self.root = [None] * 6
+    self.root[_PREV] = self.root[_NEXT] = self.root
+    self.memory = 0
+
+    # On-disk cache (shared by all back-ends of the same endpoint)
+    self.disk = None
+    if(cacheFile):
+       try:
+          self.disk = DlsDiskCache(cacheFile, _endpointKey(api))
+       except DlsDiskCacheError, inst:
+          self._warn("Not using the on-disk cache: %s" % inst)
+
+    # Counters
+    self.hits = 0
+    self.diskHits = 0
+    self.negativeHits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  ############################################
+  # Methods defining the main public interface
+  ############################################
+
+  def add(self, dlsEntryList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.add method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the cache entries of the
+    specified FileBlocks are removed (even if an exception is raised).
+    """
+    try:
+       return self.api.add(dlsEntryList, **kwd)
+    finally:
+       self._invalidateEntries(dlsEntryList)
+
+
+  def update(self, dlsEntryList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.update method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the cache entries of the
+    specified FileBlocks are removed (even if an exception is raised).
+    """
+    try:
+       return self.api.update(dlsEntryList, **kwd)
+    finally:
+       self._invalidateEntries(dlsEntryList)
+
+
+  def delete(self, dlsEntryList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.delete method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the cache entries of the
+    specified FileBlocks are removed (even if an exception is raised).
+    """
+    try:
+       return self.api.delete(dlsEntryList, **kwd)
+    finally:
+       self._invalidateEntries(dlsEntryList)
+
+
+  def getLocations(self, fileBlockList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.getLocations method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The locations of the FileBlocks found in the cache (for the same
+    longList, showProd, showCAF, subscribed and custodial flags) are
+    taken from there, and the back-end API is queried (with a single
+    call, and the same flags) only for the rest. The results are cached.
+
+    FileBlocks not returned by an errorTolerant query are stored as
+    negative entries, which make later errorTolerant queries skip them
+    (as the back-end API would do). Queries that are not errorTolerant
+    do not use those entries, so that the back-end raises its exception.
+
+    With an on-disk cache, the FileBlocks not found in memory are looked
+    up there before querying the back-end (and stored there afterwards).
+
+    FileBlock patterns (with '*' or '%', or '/' for all the FileBlocks)
+    are not cached. If any is specified, the whole query is passed to the
+    back-end API. Likewise, if the back-end returns entries for FileBlocks
+    that were not asked for (e.g. because it expanded some name), those
+    entries are returned but not cached, and no negative entries are
+    stored for that query.
+
+    The returned DlsEntry objects are new, but their DlsFileBlock and
+    DlsLocation objects are shared with the cache, and should not be
+    modified.
+    """
+    # Keywords (flags)
+    errorTolerant = False
+    if(kwd.has_key("errorTolerant")):   errorTolerant = kwd.get("errorTolerant")
+
+    # Make sure the argument is a list
+    if (isinstance(fileBlockList, list)):
+       theList = fileBlockList
+    else:
+       theList = [fileBlockList]
+
+    names = []
+    for fB in theList:
+       # Check what was passed (DlsFileBlock or string)
+       if(isinstance(fB, DlsFileBlock)):
+         names.append(fB.name)
+       else:
+         names.append(fB)
+       if(_isPattern(names[-1])):
+         self._debug("Pattern in the query for %s, not using the cache" % names[-1])
+         return self.api.getLocations(fileBlockList, **kwd)
+
+    flags = tuple([bool(kwd.get(flag)) for flag in _RESULT_FLAGS])
+
+    # Look the FileBlocks up
+    found = {}
+    missing = []
+    now = time.time()
+    self.lock.acquire()
+    try:
+       for name in names:
+          if(found.has_key(name)): continue
+          record = self._lookup((name, flags), now)
+          if(record == None) or ((record[_ENTRY] == None) and (not errorTolerant)):
+             missing.append(name)
+             found[name] = None
+          else:
+             found[name] = record[_ENTRY]
+             if(record[_ENTRY] == None): self.negativeHits += 1
+             else:                       self.hits += 1
+    finally:
+       self.lock.release()
+
+    # Then in the on-disk cache
+    if(missing and self.disk):
+       stored = self._diskCall(self.disk.get, flags, missing, now)
+       if(stored):
+          self.lock.acquire()
+          try:
+             rest = []
+             for name in missing:
+                item = stored.get(_normName(name))
+                if(item == None) or ((item[0] == None) and (not errorTolerant)):
+                   rest.append(name)
+                else:
+                   found[name] = item[0]
+                   self._store((name, flags), item[0], item[1])
+                   if(item[0] == None): self.negativeHits += 1
+                   else:                self.diskHits += 1
+             missing = rest
+          finally:
+             self.lock.release()
+
+    # Query for the rest
+    extra = []
+    if(missing):
+       self._debug("Cache misses: %d of %d FileBlocks" % (len(missing), len(names)))
+       self.lock.acquire()
+       self.misses += len(missing)
+       self.lock.release()
+       entries = self.api.getLocations(missing, **kwd)
+       if((not errorTolerant) and (len(entries) == len(missing))):
+          pairs = zip(missing, entries)
+       else:
+          requested = {}
+          for name in missing:
+             requested[_normName(name)] = None
+          byName = {}
+          for entry in entries:
+             norm = _normName(entry.fileBlock.name)
+             if(requested.has_key(norm)): byName[norm] = entry
+             else:                        extra.append(entry)
+          pairs = [(name, byName.get(_normName(name))) for name in missing]
+          if(extra):
+             # The names were not taken literally, so a FileBlock not
+             # returned is not known to have no locations
+             self._debug("%d entries for FileBlocks not queried, not caching negative entries" % len(extra))
+             pairs = [(name, entry) for (name, entry) in pairs if entry != None]
+       now = time.time()
+       items = []
+       self.lock.acquire()
+       try:
+          for name, entry in pairs:
+             found[name] = entry
+             expires = now + self._ttl(entry)
+             self._store((name, flags), entry, expires)
+             items.append((_normName(name), entry, expires))
+       finally:
+          self.lock.release()
+       if(self.disk):
+          self._diskCall(self.disk.put, flags, items, now)
+
+    # Return the entries, in the order of the arguments
+    result = []
+    for name in names:
+       entry = found.get(name)
+       if(entry != None):
+          result.append(DlsEntry(entry.fileBlock, list(entry.locations)))
+    result.extend(extra)
+    return result
+
+
+  def getFileBlocks(self, locationList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.getFileBlocks method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The result of the whole query is cached, for the same locations (in
+    the same order) and showProd, showCAF, subscribed, custodial and
+    cmsSite flags. Results with no FileBlocks are kept as negative
+    entries. With an on-disk cache, the result is also looked up and
+    stored there.
+
+    Since the FileBlocks of any location may change, all the cached
+    getFileBlocks results are removed when add, update, delete,
+    renameFileBlock or changeFileBlocksLocation are called through this
+    object.
+
+    The returned DlsEntry objects are new, but their DlsFileBlock and
+    DlsLocation objects are shared with the cache, and should not be
+    modified.
+    """
+    # Make sure the argument is a list
+    if (isinstance(locationList, list)):
+       theList = locationList
+    else:
+       theList = [locationList]
+
+    hosts = []
+    for loc in theList:
+       # Check what was passed (DlsLocation or string)
+       if(isinstance(loc, DlsLocation)):
+         hosts.append(loc.host)
+       else:
+         hosts.append(loc)
+
+    flags = tuple([bool(kwd.get(flag)) for flag in _FILEBLOCKS_FLAGS])
+    key = (None, tuple(hosts), flags)
+
+    # Look the query up
+    entries = None
+    now = time.time()
+    self.lock.acquire()
+    try:
+       record = self._lookup(key, now)
+       if(record != None):
+          entries = record[_ENTRY]
+          if(entries): self.hits += 1
+          else:        self.negativeHits += 1
+    finally:
+       self.lock.release()
+
+    # Then in the on-disk cache
+    if((entries == None) and self.disk):
+       stored = self._diskCall(self.disk.getFileBlocks, flags, hosts, now)
+       if(stored):
+          entries, expires = stored
+          self.lock.acquire()
+          try:
+             self._store(key, entries, expires)
+             if(entries): self.diskHits += 1
+             else:        self.negativeHits += 1
+          finally:
+             self.lock.release()
+
+    # Query the back-end
+    if(entries == None):
+       self._debug("Cache miss for the FileBlocks of %s" % hosts)
+       self.lock.acquire()
+       self.misses += 1
+       self.lock.release()
+       entries = self.api.getFileBlocks(locationList, **kwd)
+       if(entries): expires = time.time() + self.ttl
+       else:        expires = time.time() + self.negativeTtl
+       self.lock.acquire()
+       try:
+          self._store(key, entries, expires)
+       finally:
+          self.lock.release()
+       if(self.disk):
+          self._diskCall(self.disk.putFileBlocks, flags, hosts, entries, expires, now)
+
+    # Return copies of the entries
+    result = []
+    for entry in entries:
+       result.append(DlsEntry(entry.fileBlock, list(entry.locations)))
+    return result
+
+
+  def listFileBlocks(self, fileBlockList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.listFileBlocks method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.listFileBlocks(fileBlockList, **kwd)
+
+
+  def renameFileBlock(self, oldFileBlock, newFileBlock, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.renameFileBlock method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the cache entries of both
+    FileBlocks are removed (even if an exception is raised).
+    """
+    try:
+       return self.api.renameFileBlock(oldFileBlock, newFileBlock, **kwd)
+    finally:
+       self._invalidateEntries([oldFileBlock, newFileBlock])
+
+
+  def getAllLocations(self, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.getAllLocations method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.getAllLocations(**kwd)
+
+
+  def dumpEntries(self, dir = "/", **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.dumpEntries method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.dumpEntries(dir, **kwd)
+
+
+  def iterEntries(self, dir = "/", **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterEntries method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.iterEntries(dir, **kwd)
+
+
+  def getFileLocs(self, fileBlockList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.getFileLocs method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.getFileLocs(fileBlockList, **kwd)
+
+
+  def iterFileLocs(self, fileBlockList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterFileLocs method, passed to
+    the back-end API (not cached).
+    """
+    return self.api.iterFileLocs(fileBlockList, **kwd)
+
+
+  def startSession(self):
+    """
+    Implementation of the dlsApi.DlsApi.startSession method, passed to
+    the back-end API.
+    """
+    return self.api.startSession()
+
+
+  def endSession(self):
+    """
+    Implementation of the dlsApi.DlsApi.endSession method, passed to
+    the back-end API.
+    """
+    return self.api.endSession()
+
+
+  def startTrans(self):
+    """
+    Implementation of the dlsApi.DlsApi.startTrans method, passed to
+    the back-end API.
+    """
+    return self.api.startTrans()
+
+
+  def endTrans(self):
+    """
+    Implementation of the dlsApi.DlsApi.endTrans method, passed to
+    the back-end API.
+    """
+    return self.api.endTrans()
+
+
+  def abortTrans(self):
+    """
+    Implementation of the dlsApi.DlsApi.abortTrans method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the whole cache is
+    emptied (the aborted changes may have been seen within the
+    transaction).
+    """
+    try:
+       return self.api.abortTrans()
+    finally:
+       self.clearCache()
+
+
+
+  ##################################
+  # Other public methods (utilities)
+  ##################################
+
+  def changeFileBlocksLocation(self, org_location, dest_location, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.changeFileBlocksLocation method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The call is passed to the back-end API, and the whole cache is emptied
+    (even if an exception is raised).
+    """
+    try:
+       return self.api.changeFileBlocksLocation(org_location, dest_location, **kwd)
+    finally:
+       self.clearCache()
+
+
+  def setVerbosity(self, value = dlsApi.DLS_VERB_WARN):
+    """
+    Implementation of the dlsApi.DlsApi.setVerbosity method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The verbosity of the back-end API is also set.
+    """
+    dlsApi.DlsApi.setVerbosity(self, value)
+    if(getattr(self, 'api', None)):
+       self.api.setVerbosity(value)
+
+
+  def getCacheStats(self):
+    """
+    Returns the cache counters, as a dictionary with the following keys:
+     - hits: FileBlocks whose locations (or getFileBlocks queries whose
+       results) were taken from the cache (memory)
+     - diskHits: FileBlocks (or getFileBlocks queries) taken from the on-disk cache
+     - negativeHits: FileBlocks (or getFileBlocks queries) answered by a negative cache entry
+     - misses: FileBlocks (or getFileBlocks queries) passed to the back-end
+     - evictions: cache entries dropped to keep the memory limit
+     - entries: current number of cache entries
+     - memory: current estimated size of the cache (bytes)
+
+    @return: a dictionary with the counters
+    """
+    self.lock.acquire()
+    try:
+       return {'hits': self.hits, 'diskHits': self.diskHits,
+               'negativeHits': self.negativeHits,
+               'misses': self.misses, 'evictions': self.evictions,
+               'entries': len(self.records), 'memory': self.memory}
+    finally:
+       self.lock.release()
+
+
+  def clearCache(self):
+    """
+    Empties the cache, including the entries of the on-disk cache for
+    the back-end server (the counters are kept).
+    """
+    if(self.disk):
+       self._diskCall(self.disk.clear)
+    self.lock.acquire()
+    try:
+       self.records.clear()
+       self.keysByName.clear()
+       self.fileBlocksKeys.clear()
+       self.root[_PREV] = self.root[_NEXT] = self.root
+       self.memory = 0
+    finally:
+       self.lock.release()
+
+
+
+  ##################################
+  # Private methods
+  ##################################
+
+  def _lookup(self, key, now):
+    """
+    Returns the (non-expired) cache record for the specified key, or None,
+    and marks it as the most recently used. Expired records are removed.
+    To be called with self.lock held.
+    """
+    record = self.records.get(key)
+    if(record == None):
+       return None
+    if(record[_EXPIRES] <= now):
+       self._remove(record)
+       return None
+    # Move to the end of the LRU list
+    record[_PREV][_NEXT] = record[_NEXT]
+    record[_NEXT][_PREV] = record[_PREV]
+    last = self.root[_PREV]
+    record[_PREV] = last
+    record[_NEXT] = self.root
+    last[_NEXT] = self.root[_PREV] = record
+    return record
+
+
+  def _ttl(self, entry):
+    """
+    Returns the time to keep the specified entry in the cache: the
+    negative TTL for entries with no locations (or None), or the TTL.
+    """
+    if(entry and entry.locations):   return self.ttl
+    else:                            return self.negativeTtl
+
+
+  def _store(self, key, entry, expires):
+    """
+    Stores the specified entry (or None, for a FileBlock not returned, or
+    a list of entries, for a getFileBlocks query) in the cache, until the
+    specified expiration time, replacing any previous one for the same
+    key, and drops the least recently used records if the memory limit is
+    exceeded. To be called with self.lock held.
+    """
+    old = self.records.get(key)
+    if(old != None):
+       self._remove(old)
+
+    if(expires <= time.time()):
+       return
+
+    last = self.root[_PREV]
+    record = [last, self.root, key, entry, expires, _recordSize(key, entry)]
+    last[_NEXT] = self.root[_PREV] = record
+    self.records[key] = record
+    if(key[0] == None):
+       self.fileBlocksKeys[key] = None
+    else:
+       self.keysByName.setdefault(_normName(key[0]), []).append(key)
+    self.memory += record[_SIZE]
+
+    while(self.memory > self.maxMemory) and self.records:
+       self._remove(self.root[_NEXT])
+       self.evictions += 1
+
+
+  def _remove(self, record):
+    """
+    Removes the specified record from the cache. To be called with
+    self.lock held.
+    """
+    record[_PREV][_NEXT] = record[_NEXT]
+    record[_NEXT][_PREV] = record[_PREV]
+    key = record[_KEY]
+    del self.records[key]
+    if(key[0] == None):
+       del self.fileBlocksKeys[key]
+    else:
+       norm = _normName(key[0])
+       keys = self.keysByName.get(norm)
+       if(keys != None):
+          keys.remove(key)
+          if(not keys): del self.keysByName[norm]
+    self.memory -= record[_SIZE]
+
+
+  def _invalidateEntries(self, dlsEntryList):
+    """
+    Removes the cache records (for any flags) of the FileBlocks of the
+    specified DlsEntry objects (or DlsFileBlock objects or FileBlock names,
+    or lists of those), and all the getFileBlocks records.
+    """
+    if (isinstance(dlsEntryList, list)):
+       theList = dlsEntryList
+    else:
+       theList = [dlsEntryList]
+
+    names = []
+    for item in theList:
+       if(isinstance(item, DlsEntry)):        names.append(item.fileBlock.name)
+       elif(isinstance(item, DlsFileBlock)):  names.append(item.name)
+       else:                                  names.append(item)
+
+    self.lock.acquire()
+    try:
+       for name in names:
+          for key in list(self.keysByName.get(_normName(name), [])):
+             self._remove(self.records[key])
+       for key in self.fileBlocksKeys.keys():
+          self._remove(self.records[key])
+    finally:
+       self.lock.release()
+
+    if(self.disk):
+       self._diskCall(self.disk.invalidate, map(_normName, names))
+
+
+  def _diskCall(self, method, *args):
+    """
+    Calls the specified method of the on-disk cache with the specified
+    arguments, and returns its result. On errors, a warning is printed,
+    the on-disk cache is not used any more, and None is returned.
+    """
+    try:
+       return method(*args)
+    except DlsDiskCacheError, inst:
+       self._warn("Not using the on-disk cache any more: %s" % inst)
+       self.disk = None
+       return None
+
+
+
+#########################################
+# DlsDiskCache class
+#########################################
+
+class DlsDiskCacheError(dlsApi.DlsApiError):
+  """
+  Exception class for errors in the use of the on-disk cache file.
+  """
+
+
+class DlsDiskCache(object):
+  """
+  This class implements the on-disk cache of FileBlock locations used by
+  the DlsCacheApi class. The entries are stored in a sqlite file, with
+  their expiration time, keyed by DLS endpoint (back-end type, server,
+  root path and format), getLocations flags and FileBlock name. The
+  DlsEntry objects are stored as JSON text (the FileBlock name, GUID and
+  attributes in a column, and the list of locations in another; both are
+  NULL for FileBlocks with no locations), and built again when read. No
+  code is run on reading, so the file may be shared by different users.
+
+  The results of getFileBlocks queries are stored in another table, keyed
+  by DLS endpoint, getFileBlocks flags and list of locations, with the
+  whole list of DlsEntry objects as JSON text.
+
+  The file may be used by several processes (and threads) at the same
+  time, since sqlite locks it for each transaction (waiting up to
+  DLS_CACHE_FILE_TIMEOUT seconds for other processes).
+
+  All methods raise DlsDiskCacheError on errors using the file.
+  """
+
+  def __init__(self, fname, endpoint):
+    """
+    Constructor of the class. It opens (or creates) the cache file, and
+    removes its expired entries.
+
+    @param fname: the path of the cache file
+    @param endpoint: the DLS endpoint the entries are for, as a string
+    """
+    if(sqlite3 == None):
+       raise DlsDiskCacheError("The sqlite3 module is not available")
+    self.fname = fname
+    self.endpoint = endpoint
+    self.lock = threading.Lock()
+    try:
+       self.conn = sqlite3.connect(fname, timeout = DLS_CACHE_FILE_TIMEOUT,
+                                   check_same_thread = False)
+       self.conn.text_factory = str
+       self.conn.execute("""CREATE TABLE IF NOT EXISTS replicas (
+                               endpoint TEXT, flags TEXT, name TEXT,
+                               expires REAL, fileblock TEXT, locations TEXT,
+                               PRIMARY KEY (endpoint, flags, name))""")
+       self.conn.execute("""CREATE TABLE IF NOT EXISTS fileblocks (
+                               endpoint TEXT, flags TEXT, hosts TEXT,
+                               expires REAL, entries TEXT,
+                               PRIMARY KEY (endpoint, flags, hosts))""")
+       self.conn.execute("DELETE FROM replicas WHERE expires <= ?", (time.time(),))
+       self.conn.execute("DELETE FROM fileblocks WHERE expires <= ?", (time.time(),))
+       self.conn.commit()
+    except sqlite3.Error, inst:
+       raise DlsDiskCacheError("Error opening the cache file %s: %s" % (fname, inst))
+
+
+  def get(self, flags, names, now):
+    """
+    Returns the non-expired entries for the specified getLocations flags
+    and FileBlock names, as a dictionary whose keys are the names and its
+    values are (DlsEntry object or None, expiration time) pairs.
+
+    @param flags: the getLocations flags, as a tuple
+    @param names: list of FileBlock names
+    @param now: current time
+    """
+    result = {}
+    flagStr = _flagString(flags)
+    self.lock.acquire()
+    try:
+       try:
+          for i in xrange(0, len(names), _SQL_MAX_VARS):
+             chunk = [_normName(name) for name in names[i:i+_SQL_MAX_VARS]]
+             rows = self.conn.execute("""SELECT name, expires, fileblock, locations FROM replicas
+                                         WHERE endpoint = ? AND flags = ? AND expires > ?
+                                         AND name IN (%s)""" % ','.join('?' * len(chunk)),
+                                      [self.endpoint, flagStr, now] + chunk)
+             for name, expires, fileblock, locations in rows:
+                try:
+                   entry = None
+                   if(fileblock != None):
+                      entry = _entryFromJson(_fromJson(json.loads(fileblock)),
+                                             _fromJson(json.loads(locations)))
+                   result[name] = (entry, expires)
+                except (ValueError, TypeError, IndexError, DlsDataObjectError):
+                   # Unreadable entry (e.g. from another client version): ignored
+                   pass
+          self.conn.commit()
+       except sqlite3.Error, inst:
+          raise DlsDiskCacheError("Error reading the cache file %s: %s" % (self.fname, inst))
+    finally:
+       self.lock.release()
+    return result
+
+
+  def put(self, flags, items, now):
+    """
+    Stores the specified entries for the specified getLocations flags (in
+    a single transaction), replacing the previous ones for the same
+    FileBlocks.
+
+    @param flags: the getLocations flags, as a tuple
+    @param items: list of (FileBlock name, DlsEntry object or None, expiration time)
+    @param now: current time
+    """
+    flagStr = _flagString(flags)
+    rows = []
+    for name, entry, expires in items:
+       if(expires > now):
+          fileblock = locations = None
+          if(entry != None):
+             fileblock, locations = [json.dumps(x, default = str) for x in _entryToJson(entry)]
+          rows.append((self.endpoint, flagStr, name, expires, fileblock, locations))
+    self.lock.acquire()
+    try:
+       try:
+          self.conn.executemany("INSERT OR REPLACE INTO replicas VALUES (?, ?, ?, ?, ?, ?)", rows)
+          self.conn.commit()
+       except sqlite3.Error, inst:
+          self._rollback()
+          raise DlsDiskCacheError("Error writing the cache file %s: %s" % (self.fname, inst))
+    finally:
+       self.lock.release()
+
+
+  def getFileBlocks(self, flags, hosts, now):
+    """
+    Returns the non-expired result of a getFileBlocks query for the
+    specified flags and locations, as a (list of DlsEntry objects,
+    expiration time) pair, or None if it is not stored.
+
+    @param flags: the getFileBlocks flags, as a tuple
+    @param hosts: list of locations (hosts)
+    @param now: current time
+    """
+    flagStr = _flagString(flags, _FILEBLOCKS_FLAGS)
+    self.lock.acquire()
+    try:
+       try:
+          row = self.conn.execute("""SELECT expires, entries FROM fileblocks
+                                     WHERE endpoint = ? AND flags = ? AND hosts = ?
+                                     AND expires > ?""",
+                                  (self.endpoint, flagStr, json.dumps(hosts), now)).fetchone()
+          self.conn.commit()
+       except sqlite3.Error, inst:
+          raise DlsDiskCacheError("Error reading the cache file %s: %s" % (self.fname, inst))
+    finally:
+       self.lock.release()
+    if(row == None):
+       return None
+    try:
+       entries = []
+       for fileblock, locations in _fromJson(json.loads(row[1])):
+          entries.append(_entryFromJson(fileblock, locations))
+       return (entries, row[0])
+    except (ValueError, TypeError, IndexError, DlsDataObjectError):
+       # Unreadable entry (e.g. from another client version): ignored
+       return None
+
+
+  def putFileBlocks(self, flags, hosts, entries, expires, now):
+    """
+    Stores the result of a getFileBlocks query for the specified flags and
+    locations, replacing the previous one.
+
+    @param flags: the getFileBlocks flags, as a tuple
+    @param hosts: list of locations (hosts)
+    @param entries: list of DlsEntry objects
+    @param expires: expiration time
+    @param now: current time
+    """
+    if(expires <= now):
+       return
+    data = json.dumps([_entryToJson(entry) for entry in entries], default = str)
+    row = (self.endpoint, _flagString(flags, _FILEBLOCKS_FLAGS), json.dumps(hosts), expires, data)
+    self.lock.acquire()
+    try:
+       try:
+          self.conn.execute("INSERT OR REPLACE INTO fileblocks VALUES (?, ?, ?, ?, ?)", row)
+          self.conn.commit()
+       except sqlite3.Error, inst:
+          self._rollback()
+          raise DlsDiskCacheError("Error writing the cache file %s: %s" % (self.fname, inst))
+    finally:
+       self.lock.release()
+
+
+  def invalidate(self, names):
+    """
+    Removes the entries (for any flags) of the specified FileBlock names,
+    and all the getFileBlocks results (in a single transaction).
+    """
+    self._delete([("replicas", "name = ?", [(name,) for name in names]),
+                  ("fileblocks", "1", [()])])
+
+
+  def clear(self):
+    """
+    Removes all the entries of the endpoint.
+    """
+    self._delete([("replicas", "1", [()]), ("fileblocks", "1", [()])])
+
+
+  def _delete(self, deletions):
+    """
+    Runs (in a single transaction) the specified deletions, as a list of
+    (table, condition, list of argument tuples), on the entries of the
+    endpoint.
+    """
+    self.lock.acquire()
+    try:
+       try:
+          for table, condition, argList in deletions:
+             self.conn.executemany("DELETE FROM %s WHERE endpoint = ? AND %s" % (table, condition),
+                                   [(self.endpoint,) + args for args in argList])
+          self.conn.commit()
+       except sqlite3.Error, inst:
+          self._rollback()
+          raise DlsDiskCacheError("Error writing the cache file %s: %s" % (self.fname, inst))
+    finally:
+       self.lock.release()
+
+
+  def _rollback(self):
+    try:
+       self.conn.rollback()
+    except sqlite3.Error:
+       pass
+
+
+
+#########################################
+# Some local utilities
+#########################################
+
+def _normName(name):
+  """
+  Returns the FileBlock name without leading or trailing '/' (since some
+  back-ends return relative names for absolute ones).
+  """
+  return name.strip('/')
+
+
+def _endpointKey(api):
+  """
+  Returns the string that identifies the DLS endpoint of the specified
+  back-end API object in the on-disk cache: its type, server, root path
+  (LFC and DLI, whose FileBlock names are relative to it) and reply
+  format (PhEDEx), e.g. "DlsLfcApi:lfc.host:/grid/cms/DLS/LFC:".
+  """
+  return "%s:%s:%s:%s" % (type(api).__name__, api.server,
+                          getattr(api, 'root', ''), getattr(api, 'format', ''))
+
+
+def _isPattern(name):
+  """
+  Returns True if the specified FileBlock name may stand for several
+  FileBlocks in some back-end (it has '*' or '%', or it is '/').
+  """
+  return (name == '/') or (name.find('*') != -1) or (name.find('%') != -1)
+
+
+def _flagString(flags, names = _RESULT_FLAGS):
+  """
+  Returns the string stored in the on-disk cache for the specified
+  getLocations (or getFileBlocks, with their names) flags (e.g.
+  "longList=0,showProd=1,...").
+  """
+  return ','.join(['%s=%d' % (names[i], flags[i]) for i in xrange(len(flags))])
+
+
+def _entryToJson(entry):
+  """
+  Returns the (fileblock, locations) pair of JSON-serializable values
+  stored in the on-disk cache for the specified DlsEntry object. The
+  FileBlock is stored as [name, GUID, attributes], and each location as
+  [host, attributes, SURL] (or just the host, for shared locations).
+  """
+  fB = entry.fileBlock
+  locList = []
+  for loc in entry.locations:
+     if(isinstance(loc, DlsSharedLocation)):
+        locList.append(loc.host)
+     else:
+        locList.append([loc.host, loc._attr, loc.getSurl()])
+  return ([fB.name, fB.getGuid(), fB._attr], locList)
+
+
+def _entryFromJson(fileblock, locations):
+  """
+  Returns the DlsEntry object for the specified values read from the
+  on-disk cache (see _entryToJson), with strings instead of unicode (see
+  _fromJson).
+
+  @exception ValueError, TypeError, IndexError, DlsDataObjectError: if they are not valid
+  """
+  name, guid, attrs = fileblock
+  locList = []
+  for item in locations:
+     if(isinstance(item, str)):
+        locList.append(internLocation(item))
+     else:
+        host, locAttrs, surl = item
+        locList.append(DlsLocation(internHost(host), locAttrs, surl))
+  return DlsEntry(DlsFileBlock(name, attrs, guid), locList)
+
+
+def _fromJson(value):
+  """
+  Returns the specified value decoded from JSON with its unicode strings
+  (also in lists and dictionaries) turned into (UTF-8) strings.
+  """
+  if(isinstance(value, unicode)):
+     return value.encode('utf-8')
+  if(isinstance(value, list)):
+     return [_fromJson(item) for item in value]
+  if(isinstance(value, dict)):
+     result = {}
+     for key in value:
+        result[_fromJson(key)] = _fromJson(value[key])
+     return result
+  return value
+
+
+def _recordSize(key, entry):
+  """
+  Returns the estimated memory (bytes) taken by a cache record for the
+  specified key and DlsEntry (or None), or list of DlsEntry objects (for
+  a getFileBlocks query).
+  """
+  if(key[0] == None):
+     size = _RECORD_SIZE + sys.getsizeof(key[1]) + sys.getsizeof(entry)
+     for item in entry:
+        size += _entrySize(item)
+     return size
+  return _RECORD_SIZE + sys.getsizeof(key[0]) + _entrySize(entry)
+
+
+def _entrySize(entry):
+  """
+  Returns the estimated memory (bytes) taken by the specified DlsEntry
+  (0 for None).
+  """
+  size = 0
+  if(entry != None):
+     size += _ENTRY_SIZE + sys.getsizeof(entry.locations)
+     size += sys.getsizeof(entry.fileBlock.name)
+     if(entry.fileBlock._attr):
+        size += sys.getsizeof(entry.fileBlock._attr)
+     for loc in entry.locations:
+        size += _LOCATION_SIZE + sys.getsizeof(loc.host)
+        if(loc._attr):
+           size += sys.getsizeof(loc._attr)
+  return size
@@ -73,6 +73,18 @@ def getDlsApi(dls_type=None, dls_endpoint=None, verbosity=DLS_VERB_WARN, **kwd):
 
   The other arguments (dls_endpoint, verbosity and **kwd) are passed to the constructor 
   of the DLS API as they are. See the dlsApi.DlsApi documentation for details.
+
+  If the cache (**kwd) flag is set to True, the DLS API object is wrapped in a
+  dlsCacheApi.DlsCacheApi object, which caches the results of getLocations
+  and getFileBlocks. In that case, the cacheTtl, cacheNegativeTtl,
+  cacheMaxMemory and cacheFile (**kwd) arguments are passed to the
+  DlsCacheApi constructor (as ttl, negativeTtl, maxMemory and cacheFile),
+  and not to the DLS API.
+
+  If the DLS_CACHE_FILE environmental variable is set (and the cacheFile
+  argument is not specified), the cache is used (unless the cache flag
+  is explicitly set to False), with that file as on-disk cache, which
+  may be shared by several processes (e.g. successive CLI invocations).
       
   @exception dlsApi.DlsValueError: if the specified value is not one of the admitted ones
   @exception SetupError (from the implementation class): on errors instantiating the interface
@@ -80,8 +92,11 @@ def getDlsApi(dls_type=None, dls_endpoint=None, verbosity=DLS_VERB_WARN, **kwd):
   @param dls_type: the type of API that should be retrieved, see supported values
   @param dls_endpoint: the DLS server, as a string "hname[:port][/path/to/DLS]"
   @param verbosity: value for the verbosity level, from the supported values
-  @param kwd: Flags: any other parameters for the DLS server
-                e.g. a dbs_client_config file or version for DLS with DBS back-end
+  @param kwd: Flags:
+     - cache: boolean (default False) for caching the results of getLocations and getFileBlocks
+     - cacheTtl, cacheNegativeTtl, cacheMaxMemory, cacheFile: settings of the cache
+     - any other parameters for the DLS server
+       e.g. a dbs_client_config file or version for DLS with DBS back-end
       
   @return: a DLS API implementation object
   """
@@ -111,5 +126,23 @@ def getDlsApi(dls_type=None, dls_endpoint=None, verbosity=DLS_VERB_WARN, **kwd):
      from dlsDliClient import DlsDliClient as api
   if(candidate == DLS_TYPE_MYSQL):
      from dlsMySQLApi import DlsMySQLApi as api
+
+  # Cache settings (not for the DLS API)
+  cacheArgs = {}
+  for flag, arg in [("cacheTtl", "ttl"), ("cacheNegativeTtl", "negativeTtl"),
+                    ("cacheMaxMemory", "maxMemory"), ("cacheFile", "cacheFile")]:
+     if(kwd.has_key(flag)):
+        cacheArgs[arg] = kwd.pop(flag)
+  if((not cacheArgs.has_key("cacheFile")) and environ.get("DLS_CACHE_FILE")):
+     cacheArgs["cacheFile"] = environ.get("DLS_CACHE_FILE")
+  cache = cacheArgs.has_key("cacheFile")
+  if(kwd.has_key("cache")):
+     cache = kwd.pop("cache")
                                                                                                  
-  return api(dls_endpoint, verbosity, **kwd)
+  iface = api(dls_endpoint, verbosity, **kwd)
+
+  if(cache):
+     from dlsCacheApi import DlsCacheApi
+     iface = DlsCacheApi(iface, **cacheArgs)
+
+  return iface
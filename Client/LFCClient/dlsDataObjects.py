@@ -20,11 +20,21 @@
 #########################################
 import dlsApi   # for the parent exception
 import socket   # for the hostname check
+import time
+from dlsDefaults import DLS_HOST_CHECK_TTL, DLS_HOST_CHECK_NEGATIVE_TTL, DLS_HOST_CHECK_THREADS
+from dlsWorkerPool import runInPool
 
 #########################################
 # Module globals
 #########################################
 
+# Tables of interned hosts (see internHost and internLocation)
+_hostTable = {}
+_locTable = {}
+
+# Cache of hostname checks: host -> (expiration time, error message or None)
+_checkedHosts = {}
+
 
 #########################################
 # DlsDataObejctError class
@@ -35,11 +45,38 @@ from dlsApiExceptions import DlsDataObjectTypeError as TypeError
 from dlsApiExceptions import DlsDataObjectValueError as ValueError
 
 
+#########################################
+# Common base class
+#########################################
+
+class _DlsSlotsObject(object):
+  """
+  Base class of the data containers of this module. These use __slots__
+  instead of a per-instance __dict__, since large numbers of them may be
+  held in memory. This class provides the pickle support that classes
+  with __slots__ lack by default.
+  """
+  __slots__ = ()
+
+  def __getstate__(self):
+    state = {}
+    for cls in type(self).__mro__:
+      for key in getattr(cls, '__slots__', ()):
+        if hasattr(self, key):
+          state[key] = getattr(self, key)
+    return state
+
+  def __setstate__(self, state):
+    for key, val in state.items():
+      object.__setattr__(self, key, val)
+
+
+
 #########################################
 # DlsFileBlock class
 #########################################
 
-class DlsFileBlock(object):
+class DlsFileBlock(_DlsSlotsObject):
   """
   Container of the information relative to a DLS FileBlock. It includes the
   FileBlock name in the catalog and possibly a list of attributes. Internally,
@@ -71,6 +108,8 @@ class DlsFileBlock(object):
   concept, then the GUID variable is of not use at all.
   """
 
+  __slots__ = ('name', '_attr', '_guid')
+
   ############################################
   # Methods defining the public interface
   ############################################
@@ -138,19 +177,22 @@ class DlsFileBlock(object):
     """
 #    return self.name + str(self.attribs)
     result = self.name + ' {'
-    for key in self.attribs: 
-       result = result + "%s: %s, " % (key, self.attribs[key])
-    if(self.attribs): result = result[:-2] + '}'
-    else:             result = result + '}'
-    return result
+    if(self._attr):
+       for key in self._attr: 
+          result = result + "%s: %s, " % (key, self._attr[key])
+       result = result[:-2]
+    return result + '}'
     
   ###################################################################
   # Private: setters and getters (properties) for the shared {} issue
   ###################################################################
-  def _getAttr(self): return self._attr
+  def _getAttr(self):
+    # The empty dictionary is only created when first needed
+    if(self._attr == None): self._attr = {}
+    return self._attr
     
   def _setAttr(self, value):
-    if(value == None): self._attr = {}
+    if(value == None): self._attr = None
     else:
        if(isinstance(value, dict)):  self._attr = value 
        else:   raise TypeError("attribs data member should be a dictionary")
@@ -168,7 +210,7 @@ class DlsFileBlock(object):
 # DlsLocation class
 #########################################
 
-class DlsLocation(object):
+class DlsLocation(_DlsSlotsObject):
   """
   Container of the information relative to a DLS location. It includes the
   Storage Element name in which a copy of FileBlock is stored, and possibly
@@ -206,6 +248,8 @@ class DlsLocation(object):
   at all.
   """
 
+  __slots__ = ('checkHost', '_host', '_attr', '_surl')
+
   ############################################
   # Methods defining the public interface
   ############################################
@@ -280,19 +324,22 @@ class DlsLocation(object):
     """
 #    return self.host + str(self.attribs)
     result = self.host + ' {'
-    for key in self.attribs: 
-       result = result + "%s: %s, " % (key, self.attribs[key])
-    if(self.attribs): result = result[:-2] + '}'
-    else:             result = result + '}'
-    return result
+    if(self._attr):
+       for key in self._attr: 
+          result = result + "%s: %s, " % (key, self._attr[key])
+       result = result[:-2]
+    return result + '}'
     
   ###################################################################
   # Private: setters and getters (properties) for the shared {} issue
   ###################################################################
-  def _getAttr(self): return self._attr
+  def _getAttr(self):
+    # The empty dictionary is only created when first needed
+    if(self._attr == None): self._attr = {}
+    return self._attr
     
   def _setAttr(self, value):
-    if(value == None): self._attr = {}
+    if(value == None): self._attr = None
     else:
        if(isinstance(value, dict)):  self._attr = value 
        else:   raise TypeError("attribs data member should be a dictionary")
@@ -321,11 +368,60 @@ class DlsLocation(object):
   host = property(_getHost, _setHost, _delHost, hostDocstr)
 
 
+#########################################
+# DlsSharedLocation class
+#########################################
+
+class DlsSharedLocation(DlsLocation):
+  """
+  Read-only DlsLocation, with a host and no attributes or SURL. A single
+  object of this class is shared by all the users of the same host (they
+  should be obtained with the internLocation function, not created
+  directly), so that large results (e.g. file replicas) do not hold a
+  different object per replica.
+
+  Any attempt to modify the object raises a DlsDataObjectError. The
+  attribs data member returns a new empty dictionary each time. If a
+  modifiable location is needed, a new DlsLocation should be created
+  with the same host.
+  """
+
+  __slots__ = ()
+
+  def __init__(self, host):
+    """
+    Constructor of the class.
+
+    @param host: the location holding a copy of a FileBlock, as a string. Required.
+    """
+    object.__setattr__(self, 'checkHost', False)
+    object.__setattr__(self, '_host', host)
+    object.__setattr__(self, '_attr', None)
+    object.__setattr__(self, '_surl', "")
+
+  def __setattr__(self, name, value):
+    raise DlsDataObjectError("Shared DlsLocation objects (%s) cannot be modified" % self._host)
+
+  def __delattr__(self, name):
+    raise DlsDataObjectError("Shared DlsLocation objects (%s) cannot be modified" % self._host)
+
+  def __reduce__(self):
+    return (internLocation, (self._host,))
+
+  def setSurl(self, surl):
+    self.__setattr__('_surl', surl)
+
+  def _getAttr(self): return {}
+
+  docstr = "Attributes of the location (empty, read-only)"
+  attribs = property(_getAttr, DlsLocation._setAttr, DlsLocation._delAttr, docstr)
+
+
 #########################################
 # DlsEntry class
 #########################################
 
-class DlsEntry(object):
+class DlsEntry(_DlsSlotsObject):
   """
   Container of the information relative to a DLS entry: association between a
   FileBlock name and that FileBlock copies on different locations. It is
@@ -348,6 +444,8 @@ class DlsEntry(object):
   empty list ([]).
   """
 
+  __slots__ = ('_fB', '_loc')
+
   ############################################
   # Methods defining the public interface
   ############################################
@@ -490,7 +588,7 @@ class DlsEntry(object):
 # DlsFile class
 #########################################
 
-class DlsFile(object):
+class DlsFile(_DlsSlotsObject):
   """
   Container of the information relative to a DLS file. It includes the file
   name in the catalog and possibly a list of attributes.
@@ -512,6 +610,8 @@ class DlsFile(object):
 
   """
 
+  __slots__ = ('name', '_attr')
+
   ############################################
   # Methods defining the public interface
   ############################################
@@ -534,19 +634,22 @@ class DlsFile(object):
     """
 #    return self.name + str(self.attribs)
     result = self.name + ' {'
-    for key in self.attribs: 
-       result = result + "%s: %s, " % (key, self.attribs[key])
-    if(self.attribs): result = result[:-2] + '}'
-    else:             result = result + '}'
-    return result
+    if(self._attr):
+       for key in self._attr: 
+          result = result + "%s: %s, " % (key, self._attr[key])
+       result = result[:-2]
+    return result + '}'
     
   ###################################################################
   # Private: setters and getters (properties) for the shared {} issue
   ###################################################################
-  def _getAttr(self): return self._attr
+  def _getAttr(self):
+    # The empty dictionary is only created when first needed
+    if(self._attr == None): self._attr = {}
+    return self._attr
     
   def _setAttr(self, value):
-    if(value == None): self._attr = {}
+    if(value == None): self._attr = None
     else:
        if(isinstance(value, dict)):  self._attr = value 
        else:   raise TypeError("attribs data member should be a dictionary")
@@ -562,6 +665,101 @@ class DlsFile(object):
 
 
 
+#########################################
+# Interning of hosts
+#########################################
+
+def internHost(host):
+  """
+  Returns a canonical copy of the specified host (SE name) string, so that
+  all the objects created for the same host can share a single string,
+  rather than holding one copy each (as it happens when they come from
+  a parser, or from a catalog reply).
+
+  Plain strings are interned with the intern built-in, and unicode
+  strings (e.g. from the XML and JSON parsers) are kept in a process-wide
+  table. The number of different SEs is small, so the table is never
+  cleaned. Other values (e.g. None) are returned as they are.
+
+  @param host: the host, as a string or unicode string
+
+  @return: the canonical copy of the host
+  """
+  if type(host) is str:
+     return intern(host)
+  if type(host) is unicode:
+     return _hostTable.setdefault(host, host)
+  return host
+
+
+def internLocation(host):
+  """
+  Returns the DlsSharedLocation object for the specified host (creating it
+  the first time it is asked for). This is a read-only DlsLocation, with no
+  attributes nor SURL, which is shared by all the callers asking for the
+  same host. Its host string is the one returned by internHost.
+
+  @param host: the host, as a string or unicode string
+
+  @return: the DlsSharedLocation object for the host
+  """
+  loc = _locTable.get(host)
+  if loc is None:
+     loc = _locTable.setdefault(host, DlsSharedLocation(internHost(host)))
+  return loc
+
+
+
+#########################################
+# Hostname checks
+#########################################
+
+def preResolveHosts(hostList, nThreads = DLS_HOST_CHECK_THREADS):
+  """
+  Checks (resolves) all the distinct hosts in the specified list at once,
+  using up to nThreads concurrent resolutions, and stores the outcome in
+  the process-wide cache of hostname checks. Later checks of these hosts
+  (e.g. by DlsLocation objects with checkHost = True) are then answered
+  from the cache, while it does not expire (see DLS_HOST_CHECK_TTL and
+  DLS_HOST_CHECK_NEGATIVE_TTL in dlsDefaults).
+
+  The list may contain host strings, DlsLocation objects or DlsEntry
+  objects (the hosts of whose locations are checked).
+
+  @param hostList: list of hosts, DlsLocation or DlsEntry objects
+  @param nThreads: maximum number of concurrent resolutions
+
+  @return: a dict with the hosts that could not be resolved as keys, and
+  the error messages as values
+  """
+  hosts = {}
+  for item in hostList:
+     if(isinstance(item, DlsEntry)):
+        for loc in item.locations:
+           hosts[loc.host] = None
+     elif(isinstance(item, DlsLocation)):
+        hosts[item.host] = None
+     else:
+        hosts[item] = None
+  hosts = hosts.keys()
+
+  failed = {}
+  results = runInPool(_checkHname, hosts, nThreads)
+  for i in xrange(len(hosts)):
+     exc = results[i][1]
+     if(exc is not None):
+        failed[hosts[i]] = getattr(exc, 'msg', str(exc))
+  return failed
+
+
+def clearHostCache():
+  """
+  Empties the process-wide cache of hostname checks.
+  """
+  _checkedHosts.clear()
+
+
+
 #########################################
 # Some local utilities
 #########################################
@@ -572,7 +770,20 @@ def _checkHname(hname):
      msg = "Empty hostname"
      raise ValueError(msg)
 
-  try:
-     socket.gethostbyname(hname)
-  except socket.error,inst:
-     raise ValueError(str(inst))
+  # Use the cached outcome, if not expired
+  now = time.time()
+  cached = _checkedHosts.get(hname)
+  if(cached and (cached[0] > now)):
+     error = cached[1]
+  else:
+     error = None
+     try:
+        socket.gethostbyname(hname)
+     except socket.error,inst:
+        error = str(inst)
+     if(error):  ttl = DLS_HOST_CHECK_NEGATIVE_TTL
+     else:       ttl = DLS_HOST_CHECK_TTL
+     _checkedHosts[hname] = (now + ttl, error)
+
+  if(error):
+     raise ValueError(error)
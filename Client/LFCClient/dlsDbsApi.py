@@ -35,6 +35,7 @@ import dlsApi
 from dlsApiExceptions import *
 #import dlsDliClient   # for a fast getLocations implementation
 from dlsDataObjects import DlsLocation, DlsFileBlock, DlsEntry, DlsDataObjectError
+from dlsDataObjects import internHost, preResolveHosts
 # TODO: From what comes next, should not import whole modules, but what is needed...
 import warnings
 warnings.filterwarnings("ignore","Python C API version mismatch for module _lfc",RuntimeWarning)
@@ -49,6 +50,9 @@ from DBSAPI.dbsApiException import *
 from DBSAPI.dbsException import *
 from DBSAPI.dbsStorageElement import *
 from DBSAPI.dbsFileBlock import *
+from dlsDefaults import DLS_DBS_QUERY_THREADS, DLS_DBS_MAX_THREADS_PER_ENDPOINT
+from dlsDefaults import DLS_DBS_MIN_BLOCKS_PER_DATASET_QUERY
+from dlsWorkerPool import runInPool, getEndpointSemaphore
 #########################################
 # Module globals
 #########################################
@@ -116,6 +120,17 @@ class DlsDbsApi(dlsApi.DlsApi):
     checked. This makes sense where more than one query are to be made next.
     For simple queries, any error in the endpoint will be noticed in the query
     itself, so the check would be redundant and not efficient.
+
+    The queryThreads argument (**kwd) sets the number of DBS queries that
+    may be run concurrently by a single method call (see setQueryThreads).
+    In any case, there will not be more than DLS_DBS_MAX_THREADS_PER_ENDPOINT
+    (see the dlsDefaults module) concurrent queries to the same server in
+    the process.
+
+    The minBlocksPerDatasetQuery argument (**kwd) sets the number of 
+    FileBlocks of the same dataset from which getLocations retrieves the
+    whole dataset with a single query, rather than the blocks one by one
+    (see getLocations). Use 0 to always query for the blocks one by one.
       
     @exception DlsConfigError: if the DBS interface object cannot be set up correctly 
 
@@ -123,6 +138,8 @@ class DlsDbsApi(dlsApi.DlsApi):
     @param verbosity: value for the verbosity level
     @param kwd: Flags:
       - checkEndpoint: Boolean (default False) for testing of the DLS endpoint
+      - queryThreads: Integer, number of concurrent DBS queries per method call
+      - minBlocksPerDatasetQuery: Integer (default DLS_DBS_MIN_BLOCKS_PER_DATASET_QUERY)
       - URL: DLS server (DBS) endpoint
       - version: DBS client version
       - dbs_client_config: config file for DBS interface to use
@@ -134,6 +151,14 @@ class DlsDbsApi(dlsApi.DlsApi):
     if(kwd.has_key("checkEndpoint")):
        checkEndpoint = kwd.get("checkEndpoint")
 
+    queryThreads = DLS_DBS_QUERY_THREADS
+    if(kwd.has_key("queryThreads")):
+       queryThreads = kwd.get("queryThreads")
+
+    self.minBlocksPerDatasetQuery = DLS_DBS_MIN_BLOCKS_PER_DATASET_QUERY
+    if(kwd.has_key("minBlocksPerDatasetQuery")):
+       self.minBlocksPerDatasetQuery = max(0, kwd.get("minBlocksPerDatasetQuery"))
+
     # Let the parent set the server endpoint (if possible) and verbosity
     dlsApi.DlsApi.__init__(self, dls_endpoint, verbosity)
 
@@ -163,6 +188,12 @@ class DlsDbsApi(dlsApi.DlsApi):
     # Set the server in our own variable (will this be needed?)
     self.server = self.dbsapi.url()
 
+    # The DBS interface object is not thread-safe. For concurrent queries,
+    # more of them are built when needed, and kept for reuse (see _getDbsApi)
+    self.dbsArgs = kwd
+    self.freeDbsApis = []
+    self.setQueryThreads(queryThreads)
+
     # Check that the provided URL is OK (by listing an inexisting fileblock)
     if(checkEndpoint):
       try:
@@ -218,6 +249,10 @@ class DlsDbsApi(dlsApi.DlsApi):
     else:
        theList = [dlsEntryList]
 
+    # Resolve all the distinct locations at once (checks below use the cache)
+    if(checkLocations):
+       preResolveHosts(theList)
+
 
     # Loop on the entries
     for entry in theList:
@@ -443,6 +478,17 @@ class DlsDbsApi(dlsApi.DlsApi):
     In the current implementation the cost of doing a long listing
     is the same as doing a normal one.
 
+    When self.minBlocksPerDatasetQuery (see the constructor) or more 
+    FileBlocks (not patterns) of the same dataset are asked for, the blocks
+    of the whole dataset are retrieved with a single query, and filtered
+    here. Since the size of the dataset is not known in advance, this
+    threshold should be high enough for the dataset query not to be more
+    costly than the block queries it replaces. The rest
+    of FileBlocks (and patterns) are queried for one by one. All these
+    queries are run concurrently (see setQueryThreads), but the results
+    are anyway returned in the same order as the FileBlocks. If errorTolerant
+    is False, no new queries are started after one has failed.
+
     The showProd flag is taken into account and if not set to True some 
     FileBlock replicas are filtered out. The showCAF flag is ignored.
 
@@ -471,7 +517,8 @@ class DlsDbsApi(dlsApi.DlsApi):
     else:
        self.dbsapi.configDict['clienttype'] = "NORMAL"
 
-    # Loop on the entries
+    # Loop on the entries to build the list of FileBlock names
+    lfnList = []
     for fB in theList:
        # Check what was passed (DlsFileBlock or string)
        if(isinstance(fB, DlsFileBlock)):
@@ -482,17 +529,56 @@ class DlsDbsApi(dlsApi.DlsApi):
        # If '/' is given, we want all blocks back
        if(lfn=='/'): lfn = '*'
 
-       # Get the locations for the given FileBlock
-       dbsList = None
-       self._debug("dbs.listBlocks(block_name=%s)" % lfn)
-       try:  
-          dbsList = self.dbsapi.listBlocks(block_name=lfn) 
-       except DbsApiException, inst:
+       lfnList.append(lfn)
+
+    # Decide the queries (a query per dataset, if many of its blocks are asked for)
+    perDataset = {}
+    for lfn in lfnList:
+       if((lfn.find('*') == -1) and (lfn.find('#') != -1)):
+          perDataset.setdefault(lfn.split('#')[0], {})[lfn] = None
+    queries = []
+    queryIndex = {}
+    lfnQuery = []
+    for lfn in lfnList:
+       if((lfn.find('*') == -1) and (lfn.find('#') != -1)):
+          dataset = lfn.split('#')[0]
+          nblocks = len(perDataset[dataset])
+          if(self.minBlocksPerDatasetQuery and (nblocks >= self.minBlocksPerDatasetQuery)):
+             key = ('dataset', dataset)
+          else:
+             key = ('block_name', lfn)
+       else:
+          key = ('block_name', lfn)
+       if(not queryIndex.has_key(key)):
+          queryIndex[key] = len(queries)
+          queries.append(key)
+       lfnQuery.append(queryIndex[key])
+
+    # Run them
+    results = self._listBlocksConcurrently(queries, stopOnError = (not errorTolerant))
+
+    # Build the result (in the order of the arguments)
+    byName = {}
+    for lfn, iquery in zip(lfnList, lfnQuery):
+       # Never started (after a failure)
+       if(results[iquery] is None): continue
+
+       dbsList, inst = results[iquery]
+       if(inst is not None):
+          if(not isinstance(inst, DbsApiException)): raise inst
           msg = "Error retrieving locations for %s" % (lfn)
           msg_w = msg + ". Skipping"
           self._mapException(inst, msg, msg_w, errorTolerant)
-       
-       # Build the result
+          dbsList = None
+
+       # Keep only the requested block, if the whole dataset was retrieved
+       elif(queries[iquery][0] == 'dataset'):
+          if(not byName.has_key(iquery)):
+             byName[iquery] = {}
+             for dbsFb in dbsList:  byName[iquery][dbsFb["Name"]] = dbsFb
+          if(byName[iquery].has_key(lfn)):  dbsList = [byName[iquery][lfn]]
+          else:                             dbsList = None
+
        if(dbsList):
           for dbsFb in dbsList:
              entry = self._mapEntryFromDbs(dbsFb)
@@ -520,6 +606,12 @@ class DlsDbsApi(dlsApi.DlsApi):
     locations. If '*' is provided, FileBlocks with no associated location
     are also returned (with no DlsLocation object in their composing list).
 
+    The locations are queried for concurrently (see setQueryThreads), and
+    the DBS replies are translated into DlsEntry objects as they arrive.
+    The entries are returned in the order of the locations, and each 
+    FileBlock is returned only once (with all its locations), even if it
+    is in several of the specified locations.
+
     The showProd flag is taken into account and if not set to True some 
     FileBlock replicas are filtered out. The showCAF flag is ignored.
 
@@ -543,7 +635,8 @@ class DlsDbsApi(dlsApi.DlsApi):
     else:
        self.dbsapi.configDict['clienttype'] = "NORMAL"
 
-    # Loop on the entries
+    # Loop on the entries to build the list of queries
+    queries = []
     for loc in theList:
        
        # Check what was passed (DlsLocation or string)
@@ -552,20 +645,28 @@ class DlsDbsApi(dlsApi.DlsApi):
        else:
          host = loc
 
-       # Retrieve list of locations 
-       dbsList = None
-       self._debug("dbs.listBlocks(storage_element_name=%s)" % host)
-       try:
-          dbsList = self.dbsapi.listBlocks(storage_element_name=host)
-       except DbsApiException, inst:
-          msg = "Error retrieving locations for %s" % (host)
+       queries.append(('storage_element_name', host))
+
+    # Retrieve (and translate) the FileBlocks of each location
+    results = self._listBlocksConcurrently(queries, stopOnError = True, translate = True)
+
+    # Build the result (each FileBlock only once)
+    seen = {}
+    for i in xrange(len(queries)):
+       # Never started (after a failure)
+       if(results[i] is None): continue
+
+       partList, inst = results[i]
+       if(inst is not None):
+          if(not isinstance(inst, DbsApiException)): raise inst
+          msg = "Error retrieving locations for %s" % (queries[i][1])
           self._mapException(inst, msg, msg, False)
 
-       # Build the result
-       if(dbsList != None):
-          for dbsFb in dbsList:
-             entry = self._mapEntryFromDbs(dbsFb)
-             entryList.append(entry)
+       if(partList != None):
+          for entry in partList:
+             if(not seen.has_key(entry.fileBlock.name)):
+                seen[entry.fileBlock.name] = None
+                entryList.append(entry)
 
     # Return what we got
     return entryList
@@ -675,6 +776,58 @@ class DlsDbsApi(dlsApi.DlsApi):
     return result
 
 
+  def iterEntries(self, dir = "/", **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterEntries method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The same remarks as for the dumpEntries method apply.
+
+    The DBS API returns the whole list of matching blocks at once, so 
+    this only saves building the list of DlsEntry objects: each block
+    is translated (and released) as the iteration goes.
+    """
+
+    # Keywords
+    showProd = False
+    if(kwd.has_key("showProd")):   showProd = kwd.get("showProd")
+
+    if showProd:
+       self.dbsapi.configDict['clienttype'] = "SUPER"
+    else:
+       self.dbsapi.configDict['clienttype'] = "NORMAL"
+
+    # Check what was passed (DlsFileBlock or string)
+    if(isinstance(dir, DlsFileBlock)):
+      lfn = dir.name
+    else:
+      lfn = dir
+
+    # If '/' is given, we want all blocks back
+    if(lfn=='/'): lfn = '*'
+
+    # Get the locations for the given FileBlock pattern
+    dbsList = None
+    self._debug("dbs.listBlocks(block_name=%s)" % lfn)
+    try:  
+       dbsList = self.dbsapi.listBlocks(block_name=lfn) 
+    except DbsApiException, inst:
+       msg = "Error retrieving locations for %s" % (lfn)
+       msg_w = msg + ". Skipping"
+       self._mapException(inst, msg, msg_w, True)
+       
+    # Translate the blocks, dropping them as we go
+    if(dbsList):
+       dbsList.reverse()
+       while(dbsList):
+          yield self._mapEntryFromDbs(dbsList.pop())
+    else:
+       msg = "No existing fileblock matching %s" % (lfn)
+       self._warn(msg + ". Skipping")
+
+
 
   def startSession(self):
     """
@@ -781,10 +934,92 @@ class DlsDbsApi(dlsApi.DlsApi):
 
 
 
+  def setQueryThreads(self, nthreads):
+    """
+    Sets the number of DBS queries that may be run concurrently by each
+    getLocations or getFileBlocks call (when several queries are needed). The results are
+    anyway returned in the same order as the arguments. Use 1 for serial
+    querying.
+
+    Notice that, regardless of this value, no more than 
+    DLS_DBS_MAX_THREADS_PER_ENDPOINT queries are sent at the same time
+    to the same server from this process.
+    
+    @param nthreads: number of DBS queries to run concurrently
+
+    @exception: raises DlsValueError, if nthreads is not a positive integer
+    """
+    if not ((type(nthreads) == int) and (nthreads > 0)):
+       raise DlsValueError("Argument of setQueryThreads must be a positive integer")
+    self.queryThreads = nthreads
+
+
+
   ##################################
   # Private methods
   ##################################
 
+  def _getDbsApi(self):
+    """
+    Returns a DBS interface object for exclusive use of the calling thread,
+    until it is given back with _putDbsApi. It is one of the previously
+    given back, or a new one (with the same arguments as self.dbsapi). In
+    any case, it is set to the current client type of self.dbsapi.
+
+    @return: a DbsApi object
+    """
+    try:
+       dbsapi = self.freeDbsApis.pop()
+    except IndexError:
+       self._debug("Creating additional DBS interface object")
+       dbsapi = DbsApi(self.dbsArgs)
+    dbsapi.configDict['clienttype'] = self.dbsapi.configDict.get('clienttype')
+    return dbsapi
+
+
+  def _putDbsApi(self, dbsapi):
+    """
+    Gives back a DBS interface object got with _getDbsApi, for reuse.
+    """
+    self.freeDbsApis.append(dbsapi)
+
+
+  def _listBlocksConcurrently(self, queries, stopOnError = False, translate = False):
+    """
+    Runs a dbs.listBlocks query for each of the specified (argument name,
+    value) pairs (e.g. ('block_name', '/a/b/c#1')), not more than 
+    self.queryThreads at a time, and returns a list with a [result,
+    exception] pair (or None, if it was never started) per query, in the
+    same order (see dlsWorkerPool.runInPool).
+
+    If translate is True, the DbsFileBlock objects of each reply are
+    translated into DlsEntry objects (see _mapEntryFromDbs) by the thread
+    that got the reply, while other queries are still running.
+
+    @param queries: list of (argument name, value) pairs
+    @param stopOnError: boolean (default False) for not starting queries after a failure
+    @param translate: boolean (default False) for translating the results to DlsEntry objects
+
+    @return: list of [list of DbsFileBlock (or DlsEntry), exception] pairs (or None)
+    """
+    def query(arg):
+       self._debug("dbs.listBlocks(%s=%s)" % arg)
+       dbsapi = self._getDbsApi()
+       try:
+          dbsList = dbsapi.listBlocks(**{arg[0]: arg[1]})
+       finally:
+          self._putDbsApi(dbsapi)
+       if(translate and (dbsList != None)):
+          dbsList = map(self._mapEntryFromDbs, dbsList)
+       return dbsList
+
+    sem = getEndpointSemaphore(self.server, DLS_DBS_MAX_THREADS_PER_ENDPOINT)
+    self._debug("Running %d DBS queries (up to %d concurrently)" % \
+                (len(queries), self.queryThreads))
+    return runInPool(query, queries, self.queryThreads, stopOnError, sem)
+
+
+
   def _mapEntryFromDbs(self, dbsFb):
     """
     Builds and returns a DlsEntry object based on the specified DbsFileBlock 
@@ -819,7 +1054,8 @@ class DlsDbsApi(dlsApi.DlsApi):
   def _mapLocFromDbs(self, dbsSE):
     """
     Builds and returns a DlsLocation object based on the specified DbsStorageElement
-    object.  It copies location host and all present attributes.
+    object.  It copies location host (interned, see dlsDataObjects.internHost)
+    and all present attributes.
 
     @param dbsSE: the DbsStorageElement object to be translated
 
@@ -836,10 +1072,10 @@ class DlsDbsApi(dlsApi.DlsApi):
           if(key == "Name"): continue
           attrs[key] = str(dbsSE[key])
           
-       loc = DlsLocation(dbsSE["Name"], attrs)
+       loc = DlsLocation(internHost(dbsSE["Name"]), attrs)
     # Argument is a string (just SE host)
     else: 
-       loc = DlsLocation(dbsSE)
+       loc = DlsLocation(internHost(dbsSE))
     
     return loc
 
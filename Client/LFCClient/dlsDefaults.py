@@ -17,6 +17,32 @@
 DLS_PHEDEX_MAX_BLOCKS_PER_QUERY = 100
 DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY = 50
 DLS_PHEDEX_MAX_SES_PER_QUERY = 10
+DLS_PHEDEX_QUERY_THREADS = 4
+DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT = 8
+DLS_PHEDEX_READ_SIZE = 65536
+DLS_PHEDEX_SYNC_OVERLAP = 300
+DLS_PHEDEX_SYNC_FULL_PERIOD = 86400
+DLS_HOST_CHECK_TTL = 3600
+DLS_HOST_CHECK_NEGATIVE_TTL = 60
+DLS_HOST_CHECK_THREADS = 16
+DLS_LFC_INDEX_MAX_AGE = 3600
+DLS_LFC_QUERY_THREADS = 1
+DLS_LFC_BULK_TRANS_SIZE = 100
+DLS_LFC_WALKER_MAX_AHEAD = 1000
+DLS_DBS_QUERY_THREADS = 4
+DLS_DBS_MAX_THREADS_PER_ENDPOINT = 8
+DLS_DBS_MIN_BLOCKS_PER_DATASET_QUERY = 50
+DLS_MYSQL_PIPELINE_DEPTH = 32
+DLS_MYSQL_SEND_COPY_MAX = 65536
+DLS_MYSQL_BATCH_SIZE = 1000
+DLS_MYSQL_MAX_MESSAGE_SIZE = 1024 * 1024 * 1024
+DLS_MYSQL_PROBE_TIMEOUT = 10
+DLS_DLI_QUERY_THREADS = 4
+DLS_DLI_MAX_THREADS_PER_ENDPOINT = 8
+DLS_CACHE_TTL = 300
+DLS_CACHE_NEGATIVE_TTL = 60
+DLS_CACHE_MAX_MEMORY = 64 * 1024 * 1024
+DLS_CACHE_FILE_TIMEOUT = 30
 
 DLS_API_VERSION = "DLS_1_1_3"
 
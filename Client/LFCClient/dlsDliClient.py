@@ -37,6 +37,8 @@ DLS_VERB_WARN = dlsApi.DLS_VERB_WARN
 from dlsDataObjects import *
 import dliClient
 from os import environ
+from dlsWorkerPool import runInPool, getEndpointSemaphore
+from dlsDefaults import DLS_DLI_QUERY_THREADS, DLS_DLI_MAX_THREADS_PER_ENDPOINT
 
 #########################################
 # Module globals
@@ -95,14 +97,26 @@ class DlsDliClient(dlsApi.DlsApi):
  
     The verbosity level affects invocations of all methods in this object. See
     the dlsApi.DlsApi.setVerbosity method for information on accepted values.
+
+    The queryThreads argument (**kwd) sets the number of DLI queries that
+    may be run concurrently by a getLocations call (see setQueryThreads).
+    In any case, there will not be more than DLS_DLI_MAX_THREADS_PER_ENDPOINT
+    (see the dlsDefaults module) concurrent queries to the same DLI in the
+    process.
       
     @exception SetupError: if no DLI can be found.
 
     @param dli_endpoint: the DLI endpoint, as a string "hname[:port][/path/to/DLS]"
     @param verbosity: value for the verbosity level
-    @param kwd: Flags (currently none, only for compatibility with DlsApi)
+    @param kwd: Flags:
+      - queryThreads: Integer, number of concurrent DLI queries per method call
     """
 
+    # Keywords
+    queryThreads = DLS_DLI_QUERY_THREADS
+    if(kwd.has_key("queryThreads")):
+       queryThreads = kwd.get("queryThreads")
+
     # Let the parent set the server (if possible) and verbosity
     dlsApi.DlsApi.__init__(self, dli_endpoint, verbosity)
    
@@ -136,6 +150,12 @@ class DlsDliClient(dlsApi.DlsApi):
     except dliClient.SetupError, inst:
        raise SetupError("Error creating the binding with the DLI interface: "+str(inst))
 
+    # A binding cannot be used by several threads at a time. For concurrent
+    # queries, more of them are created when needed, and kept for reuse
+    # (see _getIface)
+    self.freeIfaces = [self.iface]
+    self.setQueryThreads(queryThreads)
+
 
   ############################################
   # Methods defining the main public interface
@@ -155,6 +175,10 @@ class DlsDliClient(dlsApi.DlsApi):
     exception is raised. If the error is a SOAP fault, the code field 
     stores the SOAP "faultcode" element.
 
+    The DLI is queried for the specified FileBlocks concurrently (see
+    setQueryThreads), but the results are returned in the same order. If
+    errorTolerant is False, no new query is started after one fails.
+
     @exception DlsDliClientError: On errors in the interaction with the DLI interface
     """
 
@@ -170,25 +194,41 @@ class DlsDliClient(dlsApi.DlsApi):
     else:
        theList = [fileBlockList]
 
-    # Query the DLI
+    # Get the LFNs to query for
+    lfnList = []
     for fB in theList:
       # Check what was passed (DlsFileBlock or string)
       if(isinstance(fB, DlsFileBlock)):
         lfn = fB.name
       else:
         lfn = fB
-      lfn = self._checkDlsHome(lfn)
+      lfnList.append(self._checkDlsHome(lfn))
+
+    # Query the DLI (concurrently, if several LFNs and threads)
+    def query(lfn):
+      if(self.verb >= DLS_VERB_HIGH):
+         print "--DliClient.listLocations(%s)" % lfn
+      iface = self._getIface()
+      try:
+         return iface.listLocations(lfn, fileType = "lfn")
+      finally:
+         self._putIface(iface)
+
+    sem = getEndpointSemaphore(self.server, DLS_DLI_MAX_THREADS_PER_ENDPOINT)
+    replies = runInPool(query, lfnList, self.queryThreads, not errorTolerant, sem)
+
+    # Process the replies (in the order of the arguments)
+    for lfn, reply in zip(lfnList, replies):
       userlfn = self._removeRootPath(lfn)
       entry = DlsEntry(DlsFileBlock(userlfn))
+      hosts, inst = reply
 
       # Get the list of locations
       locList = []
-      if(self.verb >= DLS_VERB_HIGH):
-         print "--DliClient.listLocations(%s)" % lfn
-      try:    
-         for host in self.iface.listLocations(lfn, fileType = "lfn"):
+      if(inst == None):
+         for host in hosts:
             locList.append(DlsLocation(host))
-      except dliClient.DliClientError, inst:
+      elif(isinstance(inst, dliClient.DliClientError)):
         msg = inst.msg
         msg = "Error querying for %s: %s" % (userlfn, inst.msg)
         if(isinstance(inst, dliClient.SoapError)):
@@ -207,6 +247,8 @@ class DlsDliClient(dlsApi.DlsApi):
               else:
                  if(inst.faultstring):  e.code = inst.faultstring
            raise e
+      else:
+        raise inst
       if(locList != None):
          entry.locations = locList
          result.append(entry)
@@ -242,10 +284,64 @@ class DlsDliClient(dlsApi.DlsApi):
       print "--Ending session with %s (no action)" % (self.server)
 
 
+  ##################################
+  # Other public methods (utilities)
+  ##################################
+
+  def setQueryThreads(self, nthreads):
+    """
+    Sets the number of DLI queries that may be run concurrently by each
+    getLocations call (when several FileBlocks are queried for). The
+    results are anyway returned in the same order as the arguments. Use 1
+    for serial querying.
+
+    Notice that, regardless of this value, no more than
+    DLS_DLI_MAX_THREADS_PER_ENDPOINT queries are sent at the same time
+    to the same DLI from this process.
+
+    @param nthreads: number of DLI queries to run concurrently
+
+    @exception: raises DlsValueError, if nthreads is not a positive integer
+    """
+    if not ((type(nthreads) == int) and (nthreads > 0)):
+       raise dlsApi.DlsValueError("Argument of setQueryThreads must be a positive integer")
+    self.queryThreads = nthreads
+
+
   #########################
   # Internal methods 
   #########################
   
+  def _getIface(self):
+    """
+    Returns a DLI interface object (with its own binding) for exclusive
+    use of the calling thread, until it is given back with _putIface. It
+    is one of the previously given back (initially, self.iface), or a new
+    one (for the same server).
+
+    @exception DlsDliClientError: if a new binding cannot be created
+
+    @return: a dliClient.DliClient object
+    """
+    try:
+       return self.freeIfaces.pop()
+    except IndexError:
+       pass
+    if(self.verb >= DLS_VERB_HIGH):
+       print "--DliClient.init(%s)" % self.server
+    try:
+       return dliClient.DliClient(self.server)
+    except dliClient.SetupError, inst:
+       raise DlsDliClientError("Error creating the binding with the DLI interface: "+str(inst))
+
+
+  def _putIface(self, iface):
+    """
+    Gives back a DLI interface object got with _getIface, for reuse.
+    """
+    self.freeIfaces.append(iface)
+
+  
 
   def _checkDlsHome(self, fileBlock, working_dir=None):
     """
@@ -0,0 +1,228 @@
+#
+# $Id$
+#
+# DLS JSON parser (for PhEDEx back-end). $Name: DLS_1_1_3 $.
+# Antonio Delgado Peris. CIEMAT. CMS.
+#
+
+"""
+This module implements the JSON parser for the reponses from
+a PhEDEx back-end for DLS API consumption. It is an alternative
+to the XML parser of the dlsXmlParser module, for use with the
+JSON flavour of the PhEDEx data service, and it returns exactly
+the same objects. All methods and classes here included are for
+internal DLS use only (no public interface).
+"""
+
+############
+# Imports
+############
+import json
+from dlsDataObjects import DlsLocation, DlsFileBlock, DlsEntry, DlsDataObjectError, DlsFile
+from dlsDataObjects import internHost, internLocation
+from dlsApiExceptions import DlsErrorWithServer
+
+
+
+############################################
+# Helper functions
+############################################
+
+def _load(jsonSource):
+  """
+  Decodes the JSON source and returns the contents of its "phedex" object
+  (raising the appropriate exception if an error was returned instead).
+  """
+  if isinstance(jsonSource, basestring):
+    reply = json.load(open(jsonSource))
+  else:
+    reply = json.load(jsonSource)
+
+  if not isinstance(reply, dict):
+    raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
+  if reply.has_key("error"):
+    raise DlsErrorWithServer(unicode(reply["error"]).strip())
+  phedex = reply.get("phedex")
+  if not isinstance(phedex, dict):
+    raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
+  if phedex.has_key("error"):
+    raise DlsErrorWithServer(unicode(phedex["error"]).strip())
+  return phedex
+
+
+def _attrs(obj, nameKey):
+  """
+  Returns the (name, attributes) pair for the specified JSON object. The
+  attributes are its simple values (nested lists and objects are skipped),
+  as unicode strings, like the XML attributes returned by the SAX parser.
+  """
+  name = None
+  attrs = {}
+  for key, val in obj.iteritems():
+    if key == nameKey:
+      name = val
+    elif isinstance(val, (list, dict)):
+      continue
+    elif val is None:
+      attrs[key] = u""
+    elif isinstance(val, unicode):
+      attrs[key] = val
+    else:
+      attrs[key] = unicode(val)
+  return name, attrs
+
+
+
+############################################
+# Class DlsJsonParser
+############################################
+
+class DlsJsonParser:
+  """
+  Parser of JSON replies of the PhEDEx data service. It offers the
+  same methods as the dlsXmlParser.DlsXmlParser class (despite the
+  names), so that both can be used indistinctly. That includes the
+  interning of SE names and the shareLocations option.
+  """
+
+  def __init__(self, shareLocations = False):
+    """
+    Constructor of the class.
+
+    @param shareLocations: boolean (default False) for sharing file replica locations
+    """
+    self.shareLocations = shareLocations
+
+
+  def xmlToEntries(self, jsonSource):
+    """
+    Returns a list of DlsEntry objects holding the FileBlock and location
+    information contained in the specified JSON source (in PhEDEx's
+    blockReplicas format)
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: a list of DlsEntry objects with FileBlock and locations information
+    """
+    return list(self.iterEntries(jsonSource))
+
+
+  def iterEntries(self, jsonSource):
+    """
+    Generator version of xmlToEntries, yielding each DlsEntry object of
+    the specified JSON source (in PhEDEx's blockReplicas format).
+
+    NOTE: The JSON source is decoded at once, so this only saves the
+    creation of the result objects before they are consumed.
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: an iterator on DlsEntry objects with FileBlock and locations information
+    """
+    for block in _load(jsonSource).get("block", []):
+      fbName, fbAttrs = _attrs(block, "name")
+      ses = []
+      locs = []
+      for replica in block.get("replica", []):
+        seName, seAttrs = _attrs(replica, "se")
+        if seName and (seName not in ses):
+          ses.append(seName)
+          locs.append(DlsLocation(internHost(seName), seAttrs))
+      yield DlsEntry(DlsFileBlock(fbName, fbAttrs), locs)
+
+
+  def xmlToBlocks(self, jsonSource):
+    """
+    Returns a list of DlsFileBlock objects holding the FileBlock information
+    contained in the specified JSON source (in PhEDEx's blockReplicas format)
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: a list of DlsFileBlock objects with FileBlock information
+    """
+    mapping = []
+    for block in _load(jsonSource).get("block", []):
+      fbName, fbAttrs = _attrs(block, "name")
+      mapping.append(DlsFileBlock(fbName, fbAttrs))
+    return mapping
+
+
+  def xmlToLocations(self, jsonSource):
+    """
+    Returns a list of DlsLocation objects holding the location information
+    contained in the specified JSON source (in PhEDEx's "nodes" format)
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: a list of DlsLocation objects with location information
+    """
+    result = []
+    for node in _load(jsonSource).get("node", []):
+      host, seAttrs = _attrs(node, "se")
+      result.append(DlsLocation(internHost(host or u""), seAttrs))
+    return result
+
+
+  def xmlToFileLocs(self, jsonSource):
+    """
+    Returns a list of dict objects holding a DlsFile as key and a list of
+    DlsLocation objects as values for each DlsFile.
+    contained in the specified JSON source (in PhEDEx's "fileReplicas" format)
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: a list of dicts associating DlsFile objects and locations
+    """
+    mapping = []
+    for block in _load(jsonSource).get("block", []):
+      fbName, fbAttrs = _attrs(block, "name")
+      files = {}
+      for f in block.get("file", []):
+        ses = []
+        locs = []
+        for replica in f.get("replica", []):
+          seName = replica.get("se")
+          if seName and (seName not in ses):
+            ses.append(seName)
+            locs.append(self._location(seName))
+        files[DlsFile(f["name"])] = locs
+      mapping.append([DlsFileBlock(fbName, fbAttrs), files])
+    return mapping
+
+
+  def iterFileLocs(self, jsonSource):
+    """
+    Generator version of xmlToFileLocs, yielding a (DlsFileBlock, DlsFile,
+    [DlsLocation]) tuple per file in the specified JSON source (in PhEDEx's
+    "fileReplicas" format). The files of a FileBlock share the same
+    DlsFileBlock object.
+
+    NOTE: The JSON source is decoded at once, so this only saves the
+    creation of the result objects before they are consumed.
+
+    @param jsonSource: JSON source file name or file object
+
+    @return: an iterator on (DlsFileBlock, DlsFile, list of DlsLocation) tuples
+    """
+    for block in _load(jsonSource).get("block", []):
+      fbName, fbAttrs = _attrs(block, "name")
+      fileBlock = DlsFileBlock(fbName, fbAttrs)
+      for f in block.get("file", []):
+        ses = []
+        locs = []
+        for replica in f.get("replica", []):
+          seName = replica.get("se")
+          if seName and (seName not in ses):
+            ses.append(seName)
+            locs.append(self._location(seName))
+        yield (fileBlock, DlsFile(f["name"]), locs)
+
+
+  def _location(self, seName):
+    """
+    Returns the (attribute-less) location of a file replica in the
+    specified SE, shared or not depending on the shareLocations option.
+    """
+    if self.shareLocations:
+      return internLocation(seName)
+    return DlsLocation(internHost(seName))
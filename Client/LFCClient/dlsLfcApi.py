@@ -27,21 +27,40 @@ DLS_VERB_HIGH = dlsApi.DLS_VERB_HIGH
 DLS_VERB_WARN = dlsApi.DLS_VERB_WARN
 #import dlsDliClient   # for a fast getLocations implementation
 from dlsDataObjects import DlsLocation, DlsFileBlock, DlsEntry, DlsDataObjectError
+from dlsDataObjects import internHost, preResolveHosts
 # TODO: From what comes next, should not import whole modules, but what is needed...
 import warnings
 warnings.filterwarnings("ignore","Python C API version mismatch for module _lfc",RuntimeWarning)
 import lfc
+# Thread-safe binding, required for the parallel read mode (if available)
+try:
+   import lfcthr
+   lfcthr.init()
+except ImportError:
+   lfcthr = None
 import sys
 import commands
 import time
 import getopt
-from os import environ, putenv
+import threading
+import cPickle
+import fcntl
+from errno import ENOENT
+from os import environ, putenv, rename, unlink, getpid
+from os.path import dirname
+from heapq import heappush, heappop
 from stat import S_IFDIR
+from dlsDefaults import DLS_LFC_INDEX_MAX_AGE, DLS_LFC_QUERY_THREADS, DLS_LFC_BULK_TRANS_SIZE
+from dlsDefaults import DLS_LFC_WALKER_MAX_AHEAD
+from dlsWorkerPool import runInPool
 #########################################
 # Module globals
 #########################################
 #S_IFDIR = 0x4000
 
+# Version of the format of the location index (see _loadLocationIndex)
+DLS_LFC_INDEX_FORMAT = 2
+
 #########################################
 # DlsLfcApiError class
 #########################################
@@ -78,6 +97,208 @@ class NotAccessibleError(DlsLfcApiError):
   Exception class for errors when trying to access a FileBlock (or directory).
   """
 
+#########################################
+# Helper classes
+#########################################
+
+class DlsLfcWalker:
+  """
+  Traverses (recursively) a directory tree of the FileBlocks namespace, 
+  yielding the contents of each directory as soon as it has been read, in
+  depth-first order (the same order as a plain recursive listing).
+
+  The contents of each directory are obtained with the readDir(binding,
+  userdir) function, which must return a list of [name, isDir, data] 
+  elements (one per entry of the directory). The data of a subdirectory
+  are returned again together with its contents (see walk).
+
+  If more than one query thread is set in the API object (see 
+  DlsLfcApi.setQueryThreads) and the thread-safe LFC python binding
+  (lfcthr) is available, up to that number of directories are read
+  concurrently, by threads with their own LFC session. Not more than
+  DLS_LFC_WALKER_MAX_AHEAD directories are read ahead of the consumer.
+  Otherwise, the directories are read in the calling thread (and session).
+  """
+
+  def __init__(self, api, readDir, statSubdirs = False):
+    """
+    Constructor of the class.
+
+    @param api: the DlsLfcApi object using the walker
+    @param readDir: the function reading each directory, as explained above
+    @param statSubdirs: boolean (default False) for stat'ing each subdirectory before reading it
+    """
+    self.api = api
+    self.readDir = readDir
+    self.statSubdirs = statSubdirs
+    self.nThreads = api.queryThreads
+    if(not lfcthr): self.nThreads = 1
+
+
+  def walk(self, userdir):
+    """
+    Generator that traverses the specified directory tree and yields a
+    (userdir, rel, data, items) tuple for each directory, where userdir is
+    the directory (without root path), rel the directory relative to the
+    specified one ("" for this one), data the data of the directory as
+    returned by the readDir function for its parent (None for the specified
+    directory), and items the list returned by readDir for the directory.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param userdir: the directory to traverse, as a string (without root path)
+
+    @return: an iterator on (userdir, rel, data, items) tuples
+    """
+    if(self.nThreads <= 1):
+       return self._walkSerial(userdir, "", None, False)
+    return self._walkParallel(userdir)
+
+
+  def _read(self, binding, userdir, isSubdir):
+    if(isSubdir and self.statSubdirs):
+       # Stat subdir (just to avoid the 60 seconds timeout!)
+       fstat = binding.lfc_filestatg()
+       if(binding.lfc_statg(self.api._checkDlsHome(userdir), "", fstat)<0):
+          code = binding.cvar.serrno
+          msg = "Error accessing FileBlock %s: %s" % (userdir, binding.sstrerror(code))
+          if(self.api.verb >= DLS_VERB_WARN):
+             print "Warning: %s" % (msg)
+    return self.readDir(binding, userdir)
+
+
+  def _walkSerial(self, userdir, rel, data, isSubdir):
+    items = self._read(lfc, userdir, isSubdir)
+    yield (userdir, rel, data, items)
+    for name, isDir, subdata in items:
+       if(isDir):
+          for item in self._walkSerial(_joinPath(userdir, name), _joinPath(rel, name),
+                                       subdata, True):
+             yield item
+
+
+  def _walkParallel(self, userdir):
+    # Shared state (protected by self.cond). The directories are identified by
+    # a key (tuple of entry indexes from the top) whose order is the 
+    # depth-first order, so that the workers read first those needed first
+    self.cond = threading.Condition()
+    self.todo = [((), userdir)]
+    self.done = {}
+    self.active = 0
+    self.needed = None
+    self.stop = False
+    self.failure = None
+    self.workers = self.nThreads
+
+    for i in xrange(self.nThreads):
+       t = threading.Thread(target = self._worker)
+       t.setDaemon(True)
+       t.start()
+
+    stack = [((), userdir, "", None)]
+    try:
+       while stack:
+          key, dir, rel, data = stack.pop()
+          self.cond.acquire()
+          try:
+             self.needed = key
+             self.cond.notifyAll()
+             while((not self.done.has_key(key)) and (not self.failure)):
+                self.cond.wait(1)
+             if(not self.done.has_key(key)):
+                raise self.failure
+             items, inst = self.done.pop(key)
+             self.needed = None
+             self.cond.notifyAll()
+          finally:
+             self.cond.release()
+          if(inst is not None):
+             raise inst
+
+          yield (dir, rel, data, items)
+
+          for i in xrange(len(items)-1, -1, -1):
+             name, isDir, subdata = items[i]
+             if(isDir):
+                stack.append((key + (i,), _joinPath(dir, name), _joinPath(rel, name), subdata))
+    finally:
+       self.cond.acquire()
+       self.stop = True
+       self.cond.notifyAll()
+       self.cond.release()
+
+
+  def _worker(self):
+    if(self.api.verb >= DLS_VERB_HIGH):
+       print "--Starting session with "+self.api.server
+    if(lfcthr.lfc_startsess("", "")):
+       code = lfcthr.cvar.serrno
+       msg = "Error starting session with LFC-based DLS: %s" % (lfcthr.sstrerror(code))
+       if(self.api.verb >= DLS_VERB_WARN):
+          print "Warning: " + msg
+       # The walk fails only if no worker could start
+       self.cond.acquire()
+       self.workers -= 1
+       if(not self.workers):
+          self.failure = DlsLfcApiError(msg, code)
+       self.cond.notifyAll()
+       self.cond.release()
+       return
+
+    try:
+       while(True):
+          # Get the next directory (if we are not too far ahead)
+          self.cond.acquire()
+          try:
+             while(True):
+                if(self.stop or self.failure): return
+                if(self.todo and ((len(self.done) < DLS_LFC_WALKER_MAX_AHEAD)
+                                  or (self.todo[0][0] == self.needed))):
+                   key, userdir = heappop(self.todo)
+                   self.active += 1
+                   break
+                if((not self.todo) and (not self.active)): return
+                self.cond.wait(1)
+          finally:
+             self.cond.release()
+
+          # Read it
+          try:
+             result = [self._read(lfcthr, userdir, len(key) > 0), None]
+          except Exception, inst:
+             result = [None, inst]
+
+          # Store it, and queue its subdirectories
+          self.cond.acquire()
+          try:
+             self.active -= 1
+             self.done[key] = result
+             if(result[0]):
+                for i in xrange(len(result[0])):
+                   name, isDir, data = result[0][i]
+                   if(isDir):
+                      heappush(self.todo, (key + (i,), _joinPath(userdir, name)))
+             self.cond.notifyAll()
+          finally:
+             self.cond.release()
+    finally:
+       if(self.api.verb >= DLS_VERB_HIGH):
+          print "--Ending session with "+self.api.server
+       lfcthr.lfc_endsess()
+
+
+
+#########################################
+# Some local utilities
+#########################################
+
+def _joinPath(dir, name):
+  if(not dir): return name
+  if(dir.endswith('/')): return dir + name
+  return dir + '/' + name
+
+
+
 #########################################
 # DlsLfcApi class
 #########################################
@@ -111,14 +332,39 @@ class DlsLfcApi(dlsApi.DlsApi):
  
     The verbosity level affects invocations of all methods in this object. See
     the dlsApi.DlsApi.setVerbosity method for information on accepted values.
+
+    If locationIndex (**kwd) is set to a file name (or, otherwise, if the 
+    DLS_LFC_LOCATION_INDEX environmental variable is set), the getFileBlocks
+    method keeps there an index of the replicas of all the FileBlocks, and
+    refreshes it incrementally in later calls (see getFileBlocks).
+
+    The queryThreads argument (**kwd) sets the number of parallel LFC
+    sessions used by getLocations (see setQueryThreads).
       
     @exception SetupError: if no DLS server can be found.
 
     @param dls_endpoint: the DLS server to be used, as a string "hname[:port]/path/to/DLS"
     @param verbosity: value for the verbosity level
-    @param kwd: Flags (currently none, only for compatibility with DlsApi)
+    @param kwd: Flags:
+     - locationIndex: string, file holding the location index of getFileBlocks (default None)
+     - indexMaxAge: integer, maximum age (in seconds) of the index contents (default 3600)
+     - queryThreads: integer, number of parallel sessions of getLocations (default 1)
     """
 
+    # Keywords
+    self.locationIndex = environ.get("DLS_LFC_LOCATION_INDEX")
+    if(kwd.has_key("locationIndex")):
+       self.locationIndex = kwd.get("locationIndex")
+
+    self.indexMaxAge = DLS_LFC_INDEX_MAX_AGE
+    if(kwd.has_key("indexMaxAge")):
+       self.indexMaxAge = kwd.get("indexMaxAge")
+
+    queryThreads = DLS_LFC_QUERY_THREADS
+    if(kwd.has_key("queryThreads")):
+       queryThreads = kwd.get("queryThreads")
+    self.setQueryThreads(queryThreads)
+
     # Let the parent set the server (if possible) and verbosity
     dlsApi.DlsApi.__init__(self, dls_endpoint, verbosity)
 
@@ -151,6 +397,9 @@ class DlsLfcApi(dlsApi.DlsApi):
     dlspath = '/'+dlspath.strip('/')
     self.root = dlspath
 
+    # Directories known to exist (see _checkAndCreateDir)
+    self._knownDirs = {}
+
     
 
   ############################################
@@ -183,6 +432,29 @@ class DlsLfcApi(dlsApi.DlsApi):
     composing DlsLocation objects include the SURL of the FileBlock copies,
     that value is also used. Notice that both uses are discouraged as they may
     lead to catalog corruption if used without care.
+
+    If bulk (**kwd) is set to True, a bulk insertion mode, meant for large
+    lists of entries, is used instead:
+     - The parent directories of all the FileBlocks are checked (and created,
+       with mode 0775, if createParent is True) first, once per directory.
+     - The FileBlocks and their locations are added in transactions of up to
+       transSize (**kwd) entries (DLS_LFC_BULK_TRANS_SIZE by default). If one 
+       of the operations of a transaction fails, it is rolled back and its
+       entries are added again one by one (without transaction), so that only
+       the failing ones are affected.
+     - The method returns a list with the outcome of each entry, in the order
+       of dlsEntryList. Each element is a pair [DlsEntry, error], where error
+       is None if everything went well, or the DlsLfcApiError for the entry
+       otherwise (entries with no locations left are also included). If
+       errorTolerant is True, the failure of a location does not prevent the
+       other locations of the entry from being added.
+    In this mode the trans and session flags are ignored. If errorTolerant is 
+    False, the method stops at the first failure and raises its exception.
+
+    Additional parameters:
+    @param kwd: Flags:
+     - bulk: boolean (default False) for using the bulk insertion mode
+     - transSize: integer, maximum number of entries per transaction in bulk mode
     """
 
     # Keywords
@@ -210,6 +482,14 @@ class DlsLfcApi(dlsApi.DlsApi):
     if(kwd.has_key("session")):
        session = kwd.get("session")
 
+    bulk = False 
+    if(kwd.has_key("bulk")):
+       bulk = kwd.get("bulk")
+
+    transSize = DLS_LFC_BULK_TRANS_SIZE
+    if(kwd.has_key("transSize")):
+       transSize = kwd.get("transSize")
+
     if(trans):
       errorTolerant = False
       session = False
@@ -220,6 +500,18 @@ class DlsLfcApi(dlsApi.DlsApi):
     else:
        theList = [dlsEntryList]
 
+    # The locations of these FileBlocks are about to change
+    self._invalidateLocationIndex(theList)
+
+    # Resolve all the distinct locations at once (checks below use the cache)
+    if(checkLocations):
+       preResolveHosts(theList)
+
+    # Bulk insertion mode
+    if(bulk):
+       return self._addBulk(theList, createParent, allowEmptyBlocks, checkLocations,
+                            errorTolerant, max(1, transSize))
+
     # Start transaction/session
     if(trans): self.startTrans()
     else:
@@ -470,6 +762,9 @@ class DlsLfcApi(dlsApi.DlsApi):
     else:
        theList = [dlsEntryList]
 
+    # The locations of these FileBlocks are about to change
+    self._invalidateLocationIndex(theList)
+
     # Start session
     if(session): self.startSession()
 
@@ -646,6 +941,12 @@ class DlsLfcApi(dlsApi.DlsApi):
     In the current implementation the cost of doing a long listing
     is the same as doing a normal one.
 
+    If more than one query thread was set (see setQueryThreads) and the
+    thread-safe LFC python binding (lfcthr) is available, the FileBlocks
+    are split among that number of threads, each of them with its own LFC
+    session. The results (and errors) are the same as with the serial mode.
+    The session (**kwd) flag is ignored in this case.
+
     NOTE: Normally, it makes no sense to use this method within a transaction,
     so please avoid it. 
     """
@@ -669,54 +970,32 @@ class DlsLfcApi(dlsApi.DlsApi):
 
     # We always query LFC directly (faster than DLI right now)
 
+    # Parallel mode (sessions are started by the worker threads)
+    if((self.queryThreads > 1) and (len(theList) > 1) and lfcthr):
+       return self._getLocationsParallel(theList, longList, errorTolerant)
+
       # Start session
     if(session): self.startSession()
 
     # Loop on the entries
     for fB in theList:
-       # Check what was passed (DlsFileBlock or string)
-       if(isinstance(fB, DlsFileBlock)):
-         lfn = fB.name
-       else:
-         lfn = fB
-       lfn = self._checkDlsHome(lfn)
        try:
-          userlfn = self._removeRootPath(lfn, strict = True)
+          entry = self._getBlockReplicas(fB, longList)
        except ValueError, inst:
           if(not errorTolerant): 
              if(session): self.endSession()
              raise 
           else: continue
-
-       entry = DlsEntry(DlsFileBlock(userlfn))
- 
-       # Get the locations for the given FileBlock
-       if(self.verb >= DLS_VERB_HIGH):
-           print "--lfc.lfc_getreplica(\""+lfn+"\", \"\", \"\")"   
-       err, filerepList = lfc.lfc_getreplica(lfn, "", "")
-       if(err):
-          code = lfc.cvar.serrno
-          msg = "Error retrieving locations for %s: %s" % (userlfn, lfc.sstrerror(code))
+       except DlsLfcApiError, inst:
           if(not errorTolerant): 
              if(session): self.endSession()
-             raise DlsLfcApiError(msg, code)
+             raise
           else:
              if(self.verb >= DLS_VERB_WARN):
-                print "Warning: " + msg
-             filerepList = None
+                print "Warning: " + inst.msg
+             entry = None
 
-       
-       # Build the result
-       if(filerepList != None):
-          locList = []
-          for filerep in filerepList:
-             attrs = {}
-             if(longList):
-                attrs = {"atime": filerep.atime, "ptime": filerep.ptime,
-                      "f_type": filerep.f_type, "sfn": filerep.sfn}
-             loc = DlsLocation(filerep.host, attrs)
-             locList.append(loc)
-          entry.locations = locList
+       if(entry):
           entryList.append(entry)
 
     # End session
@@ -736,6 +1015,20 @@ class DlsLfcApi(dlsApi.DlsApi):
 
     Implementation specific remarks:
 
+    The FileBlocks namespace is traversed only once for all the specified
+    locations. 
+
+    If a location index was set (see the constructor), the replicas of all
+    the FileBlocks found in the traversal are stored there, and later calls
+    (from this or other processes) reuse them. Only the directories that have
+    been modified since (FileBlocks created, removed or renamed), or whose
+    contents are older than indexMaxAge seconds, are read again. The add and
+    delete methods of this class remove the affected directories from the
+    index, but changes in the replicas of existing FileBlocks by other clients 
+    may take up to indexMaxAge seconds to be noticed. Updates of the index are
+    serialized with a lock file ("<index>.lock"), and a traversal does not
+    store its results if the index was invalidated while it was running.
+
     NOTE: This method may be quite more expensive (slow) than the getLocations
     method.
 
@@ -754,29 +1047,61 @@ class DlsLfcApi(dlsApi.DlsApi):
     else:
        theList = [locationList]
 
-    entryList = []
+    # Check what was passed (DlsLocation or string)
+    hostList = []
+    for loc in theList:
+       if(isinstance(loc, DlsLocation)):
+         hostList.append(loc.host)
+       else:
+         hostList.append(loc)
+
+    # The FileBlocks found for each location
+    byHost = {}
+    for host in hostList:
+       byHost[host] = []
 
     # Start session
     if(session): self.startSession()
 
     try:
-       # Loop on the entries
-       for loc in theList:
-          
-          # Check what was passed (DlsLocation or string)
-          if(isinstance(loc, DlsLocation)):
-            host = loc.host
-          else:
-            host = loc
-
-          # Retrieve list for each location and add it to the general list
-          partialList = self._getEntriesFromDir("/", host, True)
-          for i in partialList:
-#AF-begin: add starting slash to fileblock name
-            if(not i.fileBlock.name.startswith('/')): i.fileBlock.name = '/' + i.fileBlock.name
-#AF-end
-            entryList.append(i)
-       
+       # Without index, look only for the specified locations
+       index = None
+       visited = None
+       hosts = byHost
+       if(self.locationIndex):
+          lock = self._lockLocationIndex()
+          try:
+             index = self._loadLocationIndex(lock)
+          finally:
+             self._unlockLocationIndex(lock)
+          visited = {}
+          hosts = None
+
+       # Single traversal for all the locations
+       for lfn, record in self._walkReplicas("/", hosts, index, visited):
+          name, filemode, guid, filesize, repList = record
+          locs = {}
+          for host, sfn in repList:
+             if(byHost.has_key(host)):
+                loc = DlsLocation(internHost(host))
+                loc.setSurl(sfn)
+                locs.setdefault(host, []).append(loc)
+          for host in locs:
+             fB = DlsFileBlock(lfn, {"filemode": filemode, "filesize": filesize}, guid)
+             byHost[host].append(DlsEntry(fB, locs[host]))
+
+       # (if the index could not be locked when loaded, it is not stored)
+       if((index is not None) and (index["generation"] != None)):
+          index["dirs"] = visited
+          lock = self._lockLocationIndex()
+          try:
+             # (if it cannot be locked now, _lockLocationIndex warns)
+             if(lock and (self._indexGeneration(lock) == index["generation"])):
+                self._saveLocationIndex(index)
+             elif(lock and (self.verb >= DLS_VERB_WARN)):
+                print "Warning: Not storing location index %s (modified concurrently)" % (self.locationIndex)
+          finally:
+             self._unlockLocationIndex(lock)
 
     except DlsLfcApiError, inst:
        if(session): self.endSession() 
@@ -785,7 +1110,10 @@ class DlsLfcApi(dlsApi.DlsApi):
     # End session
     if(session): self.endSession()
     
-    # Return what we got
+    # Return what we got (per location, in the specified order)
+    entryList = []
+    for host in hostList:
+       entryList.extend(byHost[host])
     return entryList
 
 
@@ -977,7 +1305,7 @@ class DlsLfcApi(dlsApi.DlsApi):
 
     # Build the list of DlsLocation objects
     for i in hostList:
-       locList.append(DlsLocation(i))
+       locList.append(DlsLocation(internHost(i)))
 
     # Return what we got
     return locList
@@ -1032,6 +1360,37 @@ class DlsLfcApi(dlsApi.DlsApi):
     return result
 
 
+  def iterEntries(self, dir = "/", **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterEntries method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The same remarks as for the dumpEntries method apply. 
+
+    The entries of each directory are yielded as soon as the directory 
+    has been read. For recursive listings, the subdirectories are read 
+    concurrently if several query threads are set (see setQueryThreads).
+    """
+    # Keywords
+    session = False
+    if(kwd.has_key("session")):    session = kwd.get("session")
+
+    recursive = False
+    if(kwd.has_key("recursive")):    recursive = kwd.get("recursive")
+
+    # Start session
+    if(session): self.startSession()
+
+    # Call the internal method that does the work (end session anyway)
+    try:
+       for entry in self._iterEntriesFromDir(dir, "", recursive):
+          yield entry
+    finally:
+       if(session): self.endSession()
+
+
 
   def startSession(self):
     """
@@ -1044,6 +1403,8 @@ class DlsLfcApi(dlsApi.DlsApi):
     """
     if(self.verb >= DLS_VERB_HIGH):
       print "--Starting session with "+self.server
+    # Forget the directories seen in previous sessions (they might be gone)
+    self._knownDirs.clear()
     if(lfc.lfc_startsess("", "")):
       code = lfc.cvar.serrno
       msg = "Error starting session with LFC-based DLS: %s" % (lfc.sstrerror(code))
@@ -1156,6 +1517,29 @@ class DlsLfcApi(dlsApi.DlsApi):
   # Other public methods (implementation specific)
   ################################################
 
+  def setQueryThreads(self, nthreads):
+    """
+    Sets the number of threads (each with its own LFC session) among which
+    the FileBlocks of a getLocations call are split. The results are anyway
+    returned in the same order as the FileBlocks. Use 1 for serial querying
+    (within the session of the caller, if any).
+
+    The parallel mode requires the thread-safe LFC python binding (lfcthr).
+    If it is not available, the queries are always serial.
+
+    The same number of threads (and sessions) is used to read concurrently
+    the directories of recursive traversals of the FileBlocks namespace
+    (dumpEntries, getAllLocations, recursive listFileBlocks and getFileBlocks).
+    
+    @param nthreads: number of concurrent LFC sessions
+
+    @exception: raises ValueError, if nthreads is not a positive integer
+    """
+    if not ((type(nthreads) == int) and (nthreads > 0)):
+       raise ValueError("Argument of setQueryThreads must be a positive integer")
+    self.queryThreads = nthreads
+
+
   def getGUID(self, fileBlock):
     """
     Returns the GUID used in the DLS for the specified FileBlock, by querying
@@ -1357,6 +1741,10 @@ class DlsLfcApi(dlsApi.DlsApi):
     correctly. Otherwise (there is an error creating the specified dir or one of its
     parents), the method returns raises an exception.
 
+    The directories found or created are remembered (in self._knownDirs), and
+    not checked again, until they are removed or renamed by this object (see
+    _forgetDirs) or a new session is started.
+
     @exception DlsLfcApiError: On error with the DLS catalog
 
     @param dir: the directory tree to be created, as a string
@@ -1367,6 +1755,9 @@ class DlsLfcApi(dlsApi.DlsApi):
     if(dir == ""):
        # The root directory is already there
        return
+
+    if(self._knownDirs.has_key(dir)):
+       return
     
     parentdir = dir[0:dir.rfind('/')+1]  
     fstat = lfc.lfc_filestatg()
@@ -1375,10 +1766,29 @@ class DlsLfcApi(dlsApi.DlsApi):
        guid = commands.getoutput('uuidgen')         
        if(self.verb >= DLS_VERB_HIGH):
           print "--lfc.lfc_mkdirg(",dir,",",guid,",",filemode,")"
-       if(lfc.lfc_mkdirg(dir, guid, filemode) < -1):
+       err = lfc.lfc_mkdirg(dir, guid, filemode)
+       if(err < -1):
           code = lfc.cvar.serrno
           msg = "Error creating parent directory %s: %s" % (dir, lfc.sstrerror(code))
           raise DlsLfcApiError(msg, code)
+       if(err < 0):
+          return
+
+    self._knownDirs[dir] = None
+
+
+  def _forgetDirs(self, dir):
+    """
+    Removes the specified directory and all its subdirectories from the
+    directories known to exist (see _checkAndCreateDir).
+
+    @param dir: the directory, as a string (including the root path)
+    """
+    dir = dir.rstrip('/')
+    prefix = dir + '/'
+    for known in self._knownDirs.keys():
+       if((known == dir) or known.startswith(prefix)):
+          del self._knownDirs[known]
 
 
   def _addFileBlock(self, dlsFileBlock, **kwd):  
@@ -1467,7 +1877,14 @@ class DlsLfcApi(dlsApi.DlsApi):
           guid=commands.getoutput('uuidgen')         
        if(self.verb >= DLS_VERB_HIGH):
           print "--lfc.lfc_creatg(\""+lfn+"\", \""+guid+"\",",filemode,")"   
-       if(lfc.lfc_creatg(lfn, guid, filemode) < 0):
+       err = lfc.lfc_creatg(lfn, guid, filemode)
+       if((err < 0) and (lfc.cvar.serrno == ENOENT) and createParent and lfn.startswith('/')):
+          # The parent might have been removed by someone else: check again
+          parentdir = lfn[0:lfn.rfind('/')+1]
+          self._forgetDirs(parentdir)
+          self._checkAndCreateDir(parentdir, filemode)
+          err = lfc.lfc_creatg(lfn, guid, filemode)
+       if(err < 0):
           code = lfc.cvar.serrno
           msg = "Error creating the FileBlock %s: %s" % (userlfn, lfc.sstrerror(code))
           if(self.verb >= DLS_VERB_WARN):
@@ -1794,6 +2211,7 @@ class DlsLfcApi(dlsApi.DlsApi):
        if(self.verb >= DLS_VERB_WARN):
           print "Warning: "+msg
        raise DlsLfcApiError(msg, code)
+    self._forgetDirs(lfn)
 
        
   def _listFileBlock(self, lfn, longList = True):
@@ -1884,6 +2302,22 @@ class DlsLfcApi(dlsApi.DlsApi):
 
     @return: the list of FileBlock objects for the specified directory
     """
+    return list(self._iterListDir(dir, longList, recursive))
+
+
+  def _iterListDir(self, dir, longList = False, recursive = False):
+    """
+    Generator version of the _listDir method (see that method), which yields
+    the FileBlock objects as the directories are read. The subdirectories
+    are traversed by a DlsLfcWalker object (concurrently, if so set).
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+    
+    @param dir: the directory to be listed, as a string
+    @param longList: boolean (default False) for adding attrs to the FileBlocks
+
+    @return: an iterator on the FileBlock objects for the specified directory
+    """
     # Check what was passed (DlsFileBlock or string)
     if(isinstance(dir, DlsFileBlock)):
       lfn = dir.name
@@ -1892,113 +2326,27 @@ class DlsLfcApi(dlsApi.DlsApi):
     dir = self._checkDlsHome(lfn)
     userdir = self._removeRootPath(dir, strict = True)
 
-    if(recursive):
-       subdirlist = [] # Subdirectories to remove when we are done with current one
-
-    # Open dir 
-    dir_p = lfc.lfc_DIR()
-    dir_entry = lfc.lfc_direnstatg()
-    if(self.verb >= DLS_VERB_HIGH):
-       print "--lfc.lfc_opendirg(%s, \"\")"  % (dir)
-    dir_p = lfc.lfc_opendirg(dir , "")
-    if(not dir_p):
-       code = lfc.cvar.serrno
-       msg = "Error opening specified dir %s: %s" % (userdir, lfc.sstrerror(code))
-       raise DlsLfcApiError(msg, code)
-
-    # Loop on dir
-    fBList = []
-    dir_entry = lfc.lfc_readdirg(dir_p)
-    if(not dir_entry):
-       code = lfc.cvar.serrno
-       if(code != 0):
-          lfc.lfc_closedir(dir_p)
-          msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
-          raise DlsLfcApiError(msg, code)
-
-       
-    while(dir_entry):
-
-      # Set always the name and GUID
-      fB = DlsFileBlock(dir_entry.d_name)
-      fB.setGuid(dir_entry.guid)
+    def readDir(binding, userdir):
+       return self._readDirStat(binding, userdir, longList)
 
-      if(longList):
-         # Long listing
-         fB.attribs["filemode"] =  dir_entry.filemode
-         fB.attribs["nlink"] =  dir_entry.nlink
-         fB.attribs["uid"] =  dir_entry.uid
-         fB.attribs["gid"] =  dir_entry.gid
-         fB.attribs["filesize"] =  dir_entry.filesize
-         fB.attribs["mtime"] =  dir_entry.mtime
-         fB.attribs["csumtype"] =  dir_entry.csumtype
-         fB.attribs["csumvalue"] =  dir_entry.csumvalue
-       
-      # Check for subdirectories (if recursive)
-      if(dir_entry.filemode & S_IFDIR):
-         if(recursive):
-            if(not userdir.endswith('/')):
-               subdir = userdir + '/' + dir_entry.d_name
-            else:
-               subdir = userdir + dir_entry.d_name
-            fB.name = subdir
-            subdirlist.append(fB)
-         else:
-            fB.name += "/"
-            fBList.append(fB)
-
-      # Normal FileBlock -> append it
-      else:
-         fBList.append(fB)
-
-                 
-      # Next entry
-      dir_entry = lfc.lfc_readdirg(dir_p)
-      if(not dir_entry):
-         code = lfc.cvar.serrno
-         if(code != 0):
-            lfc.lfc_closedir(dir_p)
-            msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
-            raise DlsLfcApiError(msg, code)
-
-           
-    # Close the directory
-    if(self.verb >= DLS_VERB_HIGH):
-       print "--lfc.lfc_closedir(%s, \"\")"  % (dir)
-    if(lfc.lfc_closedir(dir_p) < 0):
-       code = lfc.cvar.serrno
-       msg = "Error closing dir %s: %s" % (userdir, lfc.sstrerror(code))
-       if(self.verb >= DLS_VERB_WARN):
-          print "Warning: %s" % (msg)
-
-
-    # Now loop on the subdirectories (if recursive)
-    if(recursive):
-       for subdir in subdirlist:
-          # Stat subdir (just to avoid the 60 seconds timeout!)
-          fstat = lfc.lfc_filestatg()
-          if(lfc.lfc_statg(self._checkDlsHome(subdir.name), "", fstat)<0):
-             code = lfc.cvar.serrno
-             msg = "Error accessing FileBlock %s: %s" % (subdir.name, lfc.sstrerror(code))
-             if(self.verb >= DLS_VERB_WARN):
-                print "Warning: %s" % (msg)
-          # List subdir
-          subList = self._listDir(subdir, longList, recursive)
-          subdir_tokens = (subdir.name).split('/')
-          bare_subdir = subdir_tokens.pop()
-
-          # If the directory was empty, append just itself
-          if(not subList):
-              subdir.name = bare_subdir + '/'
-              fBList.append(subdir)
-          # Otherwise, append its contents
-          else:
-            for i in subList:
-                i.name = bare_subdir + '/' + i.name
-                fBList.append(i)
+    if(not recursive):
+       for name, isDir, fB in readDir(lfc, userdir):
+          if(isDir): fB.name += "/"
+          yield fB
+       return
 
-    # Return
-    return fBList
+    # The subdirectories are not stat'ed (we already have their stat data)
+    for subdir, rel, data, items in DlsLfcWalker(self, readDir).walk(userdir):
+       # If the directory is empty, return just itself
+       if(not items):
+          if(data):
+             data.name = rel + '/'
+             yield data
+       # Otherwise, its FileBlocks (the subdirectories come later)
+       for name, isDir, fB in items:
+          if(not isDir):
+             fB.name = _joinPath(rel, name)
+             yield fB
 
 
   def _renameFileBlock(self, oldPath, newPath, **kwd):
@@ -2044,6 +2392,9 @@ class DlsLfcApi(dlsApi.DlsApi):
        if(self.verb >= DLS_VERB_WARN):
          print "Warning: " + msg
        raise DlsLfcApiError(msg, code)
+
+    # If it was a directory, it (and its subdirectories) are not there anymore
+    self._forgetDirs(oldLfn)
           
 
 
@@ -2057,7 +2408,8 @@ class DlsLfcApi(dlsApi.DlsApi):
     The directory is specified as a string.
 
     If recursive is used, the list contains information on the FileBlocks
-    contained under the specified directory and its subdirectories.
+    contained under the specified directory and its subdirectories (which
+    are traversed by a DlsLfcWalker object, concurrently if so set).
 
     The method will raise an exception in the case that there is an error
     listing the directory. 
@@ -2076,91 +2428,17 @@ class DlsLfcApi(dlsApi.DlsApi):
     dir = self._checkDlsHome(lfn)
     userdir = self._removeRootPath(dir, strict = True)
 
-    locList = {}
     if(recursive):
-       subdirlist = [] # Subdirectories to remove when we are done with current one
-
-    # Open dir 
-    dir_p = lfc.lfc_DIR()
-    if(self.verb >= DLS_VERB_HIGH):
-       print "--lfc.lfc_opendirg(%s, \"\")"  % (dir)
-    dir_p = lfc.lfc_opendirg(dir , "")
-    if(not dir_p):
-       code = lfc.cvar.serrno
-       msg = "Error opening specified dir %s: %s" % (userdir, lfc.sstrerror(code))
-       raise DlsLfcApiError(msg, code)
-
-    # Loop on dir
-    dir_entry = lfc.lfc_direnrep()
-    dir_read = lfc.lfc_readdirxr(dir_p, "")
-    if(not dir_read):
-       code = lfc.cvar.serrno
-       if(code != 0):
-          lfc.lfc_closedir(dir_p)
-          msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
-          raise DlsLfcApiError(msg, code)
+       walk = DlsLfcWalker(self, self._readDirReplicas, statSubdirs = True).walk(userdir)
     else:
-       dir_entry, repList = dir_read
-       
-    while(dir_read):
-    
-      if(self.verb >= DLS_VERB_HIGH):    
-         print "--Read:",dir_entry.d_name
-
-      # Is it a subdirectory?
-      if(dir_entry.filemode & S_IFDIR):
-         if(recursive):
-            if(not userdir.endswith('/')):
-               subdir = userdir + '/' + dir_entry.d_name
-            else:
-               subdir = userdir + dir_entry.d_name
-            fB = DlsFileBlock(subdir)
-            subdirlist.append(fB)
-            
-      # Normal FileBlock -> add its locations (dict will avoid repetitions)
-      else:
-         if(repList):
-            for rep in repList:
-               locList[rep.host] = 1
-               if(self.verb >= DLS_VERB_HIGH):    
-                  print "--Added:",rep.host
-      
-      # Next entry
-      dir_read = lfc.lfc_readdirxr(dir_p, "")
-      if(not dir_read):
-         code = lfc.cvar.serrno
-         if(code != 0):
-            lfc.lfc_closedir(dir_p)
-            msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
-            raise DlsLfcApiError(msg, code)
-      else:
-         dir_entry, repList = dir_read
-
-           
-    # Close the directory
-    if(self.verb >= DLS_VERB_HIGH):
-       print "--lfc.lfc_closedir(%s, \"\")"  % (dir)
-    if(lfc.lfc_closedir(dir_p) < 0):
-       code = lfc.cvar.serrno
-       msg = "Error closing dir %s: %s" % (userdir, lfc.sstrerror(code))
-       if(self.verb >= DLS_VERB_WARN):
-          print "Warning: %s" % (msg)
-
+       walk = [(userdir, "", None, self._readDirReplicas(lfc, userdir))]
 
-    # Now loop on the subdirectories (if recursive)
-    if(recursive):
-       for subdir in subdirlist:
-          # Stat subdir (just to avoid the 60 seconds timeout!)
-          fstat = lfc.lfc_filestatg()
-          if(lfc.lfc_statg(self._checkDlsHome(subdir.name), "", fstat)<0):
-             code = lfc.cvar.serrno
-             msg = "Error accessing FileBlock %s: %s" % (subdir.name, lfc.sstrerror(code))
-             if(self.verb >= DLS_VERB_WARN):
-                print "Warning: %s" % (msg)
-          # List subdir
-          subList = self._getLocsFromDir(subdir, recursive)
-          for loc in subList:
-             locList[loc]=1
+    # Add the locations of the FileBlocks (dict will avoid repetitions)
+    locList = {}
+    for subdir, rel, data, items in walk:
+       for name, isDir, record in items:
+          for host, sfn in record[4]:
+             locList[host] = 1
 
     # Return
     return locList.keys()
@@ -2191,7 +2469,24 @@ class DlsLfcApi(dlsApi.DlsApi):
     
     @return: the list of DlsEntry objects for the specified dirs and location
     """
+    return list(self._iterEntriesFromDir(dir, location, recursive))
+
 
+  def _iterEntriesFromDir(self, dir, location = "", recursive = False):
+    """
+    Generator version of the _getEntriesFromDir method (see that method),
+    which yields the DlsEntry objects as the directories are read. The
+    subdirectories are traversed by a DlsLfcWalker object (concurrently,
+    if so set).
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+    
+    @param dir: the directory to be listed, as a string or DlsFileBlock object
+    @param location: only FileBlocks of this location will be returned, as a string,
+                     or "" for FileBlocks in any location
+    
+    @return: an iterator on the DlsEntry objects for the specified dirs and location
+    """
     # Check what was passed (DlsFileBlock or string)
     if(isinstance(dir, DlsFileBlock)):
       lfn = dir.name
@@ -2200,130 +2495,656 @@ class DlsLfcApi(dlsApi.DlsApi):
     dir = self._checkDlsHome(lfn)
     userdir = self._removeRootPath(dir, strict = True)
 
-    entryList = []
-    if(recursive):
-       subdirlist = [] # Subdirectories to remove when we are done with current one
+    # Only the replicas in the specified location (if any) are read
+    hosts = None
+    if(location):
+       hosts = {location: None}
+
+    def readDir(binding, userdir):
+       return self._readDirReplicas(binding, userdir, hosts)
+
+    if(not recursive):
+       for name, isDir, record in readDir(lfc, userdir):
+          if(isDir):
+             yield DlsEntry(self._recordToFileBlock(name + "/", record))
+          else:
+             yield self._recordToEntry(name, record)
+       return
+
+    for subdir, rel, data, items in DlsLfcWalker(self, readDir, statSubdirs = True).walk(userdir):
+       # If the directory is empty, append just itself (for the location ="" case)
+       if((not items) and data and (not location)):
+          yield DlsEntry(self._recordToFileBlock(rel + '/', data))
+       # Otherwise, its FileBlocks (the subdirectories come later)
+       for name, isDir, record in items:
+          if(not isDir):
+             yield self._recordToEntry(_joinPath(rel, name), record)
+
+
+  def _addBulk(self, entryList, createParent, allowEmptyBlocks, checkLocations,
+               errorTolerant, transSize):
+    """
+    Bulk insertion mode of the add method (see that method for details).
+
+    @exception DlsLfcApiError: On error with the DLS catalog (if not errorTolerant)
+
+    @param entryList: list of DlsEntry objects to add
+    @param createParent: boolean for creating the missing parent directories
+    @param allowEmptyBlocks: boolean for adding FileBlocks with no locations
+    @param checkLocations: boolean for checking the hosts of the locations
+    @param errorTolerant: boolean for going on after a failed entry
+    @param transSize: maximum number of entries per transaction
+
+    @return: list of [DlsEntry, error] pairs, in the order of entryList
+    """
+    status = []
+    pending = []
 
-    # Open dir 
+    # Check locations (the hosts are already cached) and empty blocks
+    for entry in entryList:
+      error = None
+      locList = entry.locations
+      if(checkLocations):
+         locList = []
+         for loc in entry.locations:
+            try:
+               loc.checkHost = True
+               loc.host = loc.host
+               locList.append(loc)
+            except DlsDataObjectError, inst:
+               msg = "Error in location %s for "%(loc.host)
+               msg += "FileBlock %s: %s" % (entry.fileBlock.name, inst.msg)
+               if(self.verb >= DLS_VERB_WARN):
+                  print "Warning: " + msg
+               if(not errorTolerant):
+                  raise DlsLfcApiError(msg)
+               error = DlsLfcApiError(msg)
+
+      item = [entry, error]
+      status.append(item)
+      if((not allowEmptyBlocks) and (not locList)):  
+         msg = "No locations for fileblock %s. Skipping." % (entry.fileBlock.name)
+         if(self.verb >= DLS_VERB_WARN):
+             print "Warning: " + msg
+         if(not error): item[1] = DlsLfcApiError(msg)
+         continue
+      pending.append([item, locList])
+
+    # Parent directories (once per directory)
+    failedDirs = {}
+    if(createParent):
+       dirs = {}
+       for item, locList in pending:
+          lfn = self._checkDlsHome(item[0].fileBlock.name)
+          dirs[lfn[0:lfn.rfind('/')+1]] = None
+       dirList = dirs.keys()
+       dirList.sort()
+       if(self.verb >= DLS_VERB_HIGH):
+          print "--Checking %d parent directories" % (len(dirList))
+       for dir in dirList:
+          try:
+             self._checkAndCreateDir(dir, 0775)
+          except DlsLfcApiError, inst:
+             if(not errorTolerant): raise
+             failedDirs[dir] = inst
+
+    todo = []
+    for item, locList in pending:
+       lfn = self._checkDlsHome(item[0].fileBlock.name)
+       inst = failedDirs.get(lfn[0:lfn.rfind('/')+1])
+       if(inst): item[1] = inst
+       else:     todo.append([item, locList])
+
+    # FileBlocks and locations (in transactions)
+    for i in xrange(0, len(todo), transSize):
+       batch = todo[i:i+transSize]
+       if(self.verb >= DLS_VERB_HIGH):
+          print "--Adding FileBlocks %d to %d of %d" % (i+1, i+len(batch), len(todo))
+       self.startTrans()
+       try:
+          # Any failure aborts the transaction, so do not go on with the batch
+          for item, locList in batch:
+             self._addEntry(item, locList, False)
+       except DlsLfcApiError, inst:
+          self.abortTrans()
+          if(self.verb >= DLS_VERB_WARN):
+             print "Warning: Transaction rolled back (%s). Adding its entries one by one" % (inst.msg)
+          for item, locList in batch:
+             try:
+                self._addEntry(item, locList, errorTolerant)
+             except DlsLfcApiError, inst:
+                if(not errorTolerant): raise
+                item[1] = inst
+       else:
+          self.endTrans()
+
+    # Report
     if(self.verb >= DLS_VERB_HIGH):
-       print "--lfc.lfc_opendirg(%s, \"\")"  % (dir)
-    dir_p = lfc.lfc_opendirg(dir , "")
-    if(not dir_p):
-       code = lfc.cvar.serrno
-       msg = "Error opening specified dir %s: %s" % (userdir, lfc.sstrerror(code))
-       raise DlsLfcApiError(msg, code)
+       failed = [item for item in status if item[1]]
+       print "--Bulk add: %d entries added, %d failed" % (len(status) - len(failed), len(failed))
+       for entry, inst in failed:
+          print "--  %s: %s" % (entry.fileBlock.name, inst.msg)
+    return status
 
-    # Loop on dir
-    # TODO: The location should be specified, but we get a strange abort
-    #       However, results are performance are basically the same
-#    dir_read = lfc.lfc_readdirxr(dir_p, location)
-    dir_read = lfc.lfc_readdirxr(dir_p, "")
-    if(not dir_read):
-       code = lfc.cvar.serrno
-       if(code != 0):
-          lfc.lfc_closedir(dir_p)
-          msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
+
+  def _addEntry(self, item, locList, errorTolerant):
+    """
+    Adds the FileBlock of the entry of the specified status item (if it does
+    not exist yet), and the specified locations for it. The parent directory
+    must exist already.
+
+    If errorTolerant is True, a failure adding one of the locations does not
+    prevent the others from being added: its exception is stored as the error
+    of the status item instead. A failure adding the FileBlock is always raised.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param item: the [DlsEntry, error] status item of the entry to add
+    @param locList: the list of DlsLocation objects to add
+    @param errorTolerant: boolean for going on after a failed location
+    """
+    entry = item[0]
+    guid = self._addFileBlock(entry.fileBlock, createParent = False)
+    for loc in locList:
+       try:
+          self._addLocationToGuid(guid, loc, entry.fileBlock.name)
+       except DlsLfcApiError, inst:
+          if(not errorTolerant): raise
+          item[1] = inst
+
+
+  def _getLocationsParallel(self, fileBlockList, longList, errorTolerant):
+    """
+    Parallel version of getLocations (see that method). The FileBlocks are
+    split in self.queryThreads consecutive chunks, each of which is read by
+    a different thread, within its own LFC session (using the thread-safe
+    lfcthr binding). Since each thread stops at its first error (unless
+    errorTolerant is True), the error raised is that of the first failing
+    FileBlock, as in the serial mode.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param fileBlockList: list of FileBlock names or DlsFileBlock objects
+    @param longList: boolean for including replica attributes
+    @param errorTolerant: boolean for skipping (with a warning) failed FileBlocks
+
+    @return: the list of DlsEntry objects, in the order of the FileBlocks
+    """
+    nThreads = min(self.queryThreads, len(fileBlockList))
+    size = (len(fileBlockList) + nThreads - 1) / nThreads
+    chunks = []
+    for i in xrange(0, len(fileBlockList), size):
+       chunks.append(fileBlockList[i:i+size])
+
+    def readChunk(chunk):
+       if(self.verb >= DLS_VERB_HIGH):
+          print "--Starting session with "+self.server
+       if(lfcthr.lfc_startsess("", "")):
+          code = lfcthr.cvar.serrno
+          msg = "Error starting session with LFC-based DLS: %s" % (lfcthr.sstrerror(code))
           raise DlsLfcApiError(msg, code)
+       try:
+          results = []
+          for fB in chunk:
+             try:
+                results.append([self._getBlockReplicas(fB, longList, lfcthr), None])
+             except DlsLfcApiError, inst:
+                results.append([None, inst])
+                if(not errorTolerant): break
+          return results
+       finally:
+          if(self.verb >= DLS_VERB_HIGH):
+             print "--Ending session with "+self.server
+          lfcthr.lfc_endsess()
+
+    if(self.verb >= DLS_VERB_HIGH):
+       print "--Reading %d FileBlocks in %d parallel sessions" % (len(fileBlockList), len(chunks))
+    entryList = []
+    for chunkResult in runInPool(readChunk, chunks, nThreads):
+       result, inst = chunkResult
+       if(inst is not None):
+          raise inst
+       for entry, inst in result:
+          if(inst is None):
+             if(entry): entryList.append(entry)
+          elif(not errorTolerant):
+             raise inst
+          elif(not isinstance(inst, ValueError)):
+             if(self.verb >= DLS_VERB_WARN):
+                print "Warning: " + inst.msg
+
+    return entryList
+
+
+  def _getBlockReplicas(self, fB, longList = False, binding = lfc):
+    """
+    Returns a DlsEntry object with the locations of the specified FileBlock,
+    read from the catalog with the specified LFC python binding (lfc or
+    lfcthr). If longList is True, the replica attributes are included (see
+    getLocations).
+
+    @exception ValueError: If the FileBlock is not under the root path
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param fB: the FileBlock, as a string or DlsFileBlock object
+    @param longList: boolean (default False) for including replica attributes
+    @param binding: the LFC python module to use (default lfc)
+
+    @return: the DlsEntry object for the FileBlock (or None if no replica list was returned)
+    """
+    # Check what was passed (DlsFileBlock or string)
+    if(isinstance(fB, DlsFileBlock)):
+      lfn = fB.name
     else:
-       dir_entry, repList = dir_read
+      lfn = fB
+    lfn = self._checkDlsHome(lfn)
+    userlfn = self._removeRootPath(lfn, strict = True)
 
+    # Get the locations for the given FileBlock
+    if(self.verb >= DLS_VERB_HIGH):
+        print "--lfc.lfc_getreplica(\""+lfn+"\", \"\", \"\")"   
+    err, filerepList = binding.lfc_getreplica(lfn, "", "")
+    if(err):
+       code = binding.cvar.serrno
+       msg = "Error retrieving locations for %s: %s" % (userlfn, binding.sstrerror(code))
+       raise DlsLfcApiError(msg, code)
+    if(filerepList == None):
+       return None
 
-    while(dir_read):
-    
-      if(self.verb >= DLS_VERB_HIGH):    
-         print "--Read:",dir_entry.d_name
+    # Build the result
+    locList = []
+    for filerep in filerepList:
+       attrs = {}
+       if(longList):
+          attrs = {"atime": filerep.atime, "ptime": filerep.ptime,
+                "f_type": filerep.f_type, "sfn": filerep.sfn}
+       locList.append(DlsLocation(internHost(filerep.host), attrs))
+    return DlsEntry(DlsFileBlock(userlfn), locList)
+
+
+  def _readDirStat(self, binding, userdir, longList = False):
+    """
+    Reads the specified directory (not recursively) with lfc_readdirg, and
+    returns a list with a [name, isDir, DlsFileBlock] element per entry. The
+    DlsFileBlock objects hold the entry name, GUID and, if longList is True,
+    the attributes described in the listFileBlocks method.
 
-      locList = []
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param binding: the LFC python module to use (lfc or lfcthr)
+    @param userdir: the directory to be read, as a string (without root path)
+    @param longList: boolean (default False) for adding attrs to the FileBlocks
+
+    @return: the list of [name, isDir, DlsFileBlock] elements
+    """
+    dir = self._checkDlsHome(userdir)
+    dir_p = self._openDir(binding, dir, userdir)
+
+    result = []
+    while(True):
+      dir_entry = binding.lfc_readdirg(dir_p)
+      if(not dir_entry):
+         self._checkReadDir(binding, dir_p, userdir)
+         break
+
+      # Set always the name and GUID
       fB = DlsFileBlock(dir_entry.d_name)
-      fB.attribs["filemode"] =  dir_entry.filemode
       fB.setGuid(dir_entry.guid)
-      fB.attribs["filesize"] =  dir_entry.filesize
-       
-      # Check for subdirectories (if recursive)
-      if(dir_entry.filemode & S_IFDIR):
-         if(recursive):
-            if(not userdir.endswith('/')):
-               subdir = userdir + '/' + dir_entry.d_name
-            else:
-               subdir = userdir + dir_entry.d_name
-            fB.name = subdir
-            subdirlist.append(fB)
-         else:
-            fB.name += "/"
-            entryList.append(DlsEntry(fB))
 
-      # Normal FileBlock 
-      else:
-         # Append the entry only for the specified location
-         # If location = "", append all the found entries
-         if(repList):
-            if (not (isinstance(repList, list) or isinstance(repList, tuple))):
-               repList = [repList]
-            for i in repList:
-               if((location == i.host) or (not location)):
-                  loc = DlsLocation(i.host)
-                  loc.setSurl(i.sfn)
-                  locList.append(loc)                  
-
-         if(locList or (not location)):
-            entry = DlsEntry(fB, locList)
-            entryList.append(entry)
-            if(self.verb >= DLS_VERB_HIGH):    
-               print "--Added:",entry.fileBlock.name
-            
-      # Next entry
-      # TODO: The location should be specified, but we get a strange abort
-      #       However, results and performance are basically the same
-#      dir_read = lfc.lfc_readdirxr(dir_p, location)
-      dir_read = lfc.lfc_readdirxr(dir_p, "")
+      if(longList):
+         # Long listing
+         fB.attribs["filemode"] =  dir_entry.filemode
+         fB.attribs["nlink"] =  dir_entry.nlink
+         fB.attribs["uid"] =  dir_entry.uid
+         fB.attribs["gid"] =  dir_entry.gid
+         fB.attribs["filesize"] =  dir_entry.filesize
+         fB.attribs["mtime"] =  dir_entry.mtime
+         fB.attribs["csumtype"] =  dir_entry.csumtype
+         fB.attribs["csumvalue"] =  dir_entry.csumvalue
+
+      result.append([dir_entry.d_name, bool(dir_entry.filemode & S_IFDIR), fB])
+
+    self._closeDir(binding, dir_p, dir, userdir)
+    return result
+
+
+  def _readDirReplicas(self, binding, userdir, hosts = None):
+    """
+    Reads the specified directory (not recursively) with lfc_readdirxr, and 
+    returns a list with a [name, isDir, record] element per entry. Each record
+    is a tuple: (name, filemode, guid, filesize, [(host, sfn), ...]).
+
+    If hosts is not None, it must be a dict whose keys are the only locations
+    to consider (FileBlocks with no replicas in them are not returned, but
+    subdirectories are).
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param binding: the LFC python module to use (lfc or lfcthr)
+    @param userdir: the directory to be read, as a string (without root path)
+    @param hosts: dict of locations to consider, or None for all of them
+
+    @return: the list of [name, isDir, record] elements
+    """
+    dir = self._checkDlsHome(userdir)
+    dir_p = self._openDir(binding, dir, userdir)
+
+    # TODO: The location should be specified, but we get a strange abort
+    #       However, results are performance are basically the same
+    result = []
+    while(True):
+      dir_read = binding.lfc_readdirxr(dir_p, "")
       if(not dir_read):         
-         code = lfc.cvar.serrno
-         if(code != 0):
-            lfc.lfc_closedir(dir_p)
-            msg = "Error reading dir %s: %s" % (userdir, lfc.sstrerror(code))
-            raise DlsLfcApiError(msg, code)
-      else:
-         dir_entry, repList = dir_read
+         self._checkReadDir(binding, dir_p, userdir)
+         break
+      dir_entry, repList = dir_read
+
+      if(self.verb >= DLS_VERB_HIGH):    
+         print "--Read:",dir_entry.d_name
 
-           
-    # Close the directory
+      isDir = bool(dir_entry.filemode & S_IFDIR)
+      reps = []
+      if(repList and (not isDir)):
+         if (not (isinstance(repList, list) or isinstance(repList, tuple))):
+            repList = [repList]
+         for i in repList:
+            if((hosts is None) or hosts.has_key(i.host)):
+               reps.append((internHost(i.host), i.sfn))
+      if(isDir or reps or (hosts is None)):
+         record = (dir_entry.d_name, dir_entry.filemode, dir_entry.guid,
+                   dir_entry.filesize, reps)
+         result.append([dir_entry.d_name, isDir, record])
+
+    self._closeDir(binding, dir_p, dir, userdir)
+    return result
+
+
+  def _openDir(self, binding, dir, userdir):
+    """
+    Opens the specified directory and returns the lfc_DIR object.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+    """
+    if(self.verb >= DLS_VERB_HIGH):
+       print "--lfc.lfc_opendirg(%s, \"\")"  % (dir)
+    dir_p = binding.lfc_opendirg(dir , "")
+    if(not dir_p):
+       code = binding.cvar.serrno
+       msg = "Error opening specified dir %s: %s" % (userdir, binding.sstrerror(code))
+       raise DlsLfcApiError(msg, code)
+    return dir_p
+
+
+  def _checkReadDir(self, binding, dir_p, userdir):
+    """
+    Checks whether the last (empty) read of the specified directory was due
+    to an error (then the directory is closed and an exception raised) or to
+    the end of the directory.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+    """
+    code = binding.cvar.serrno
+    if(code != 0):
+       binding.lfc_closedir(dir_p)
+       msg = "Error reading dir %s: %s" % (userdir, binding.sstrerror(code))
+       raise DlsLfcApiError(msg, code)
+
+
+  def _closeDir(self, binding, dir_p, dir, userdir):
+    """
+    Closes the specified directory (only warning on error).
+    """
     if(self.verb >= DLS_VERB_HIGH):
        print "--lfc.lfc_closedir(%s, \"\")"  % (dir)
-    if(lfc.lfc_closedir(dir_p) < 0):
-       code = lfc.cvar.serrno
-       msg = "Error closing dir %s: %s" % (userdir, lfc.sstrerror(code))
+    if(binding.lfc_closedir(dir_p) < 0):
+       code = binding.cvar.serrno
+       msg = "Error closing dir %s: %s" % (userdir, binding.sstrerror(code))
        if(self.verb >= DLS_VERB_WARN):
           print "Warning: %s" % (msg)
 
 
-    # Now loop on the subdirectories (if recursive)
-    if(recursive):
-       for subdir in subdirlist:
-          # Stat subdir (just to avoid the 60 seconds timeout!)
-          fstat = lfc.lfc_filestatg()
-          if(lfc.lfc_statg(self._checkDlsHome(subdir.name), "", fstat)<0):
-             code = lfc.cvar.serrno
-             msg = "Error accessing FileBlock %s: %s" % (subdir.name, lfc.sstrerror(code))
-             if(self.verb >= DLS_VERB_WARN):
-                print "Warning: %s" % (msg)
-          # List subdir
-          subList = self._getEntriesFromDir(subdir, location, recursive)
-          subdir_tokens = (subdir.name).split('/')
-          bare_subdir = subdir_tokens.pop()
-
-          # If the directory was empty, append just itself (for the location ="" case)
-          if((not subList) and (not location)):
-              subdir.name = bare_subdir + '/'
-              entryList.append(DlsEntry(subdir))
-          # Otherwise, append its contents
-          else:
-            for i in subList:
-                i.fileBlock.name = bare_subdir + '/' + i.fileBlock.name
-                entryList.append(i)
+  def _recordToFileBlock(self, name, record):
+    """
+    Returns a DlsFileBlock object with the specified name and the attributes
+    (filemode, filesize) and GUID of the specified record (see _readDirReplicas).
+    """
+    fB = DlsFileBlock(name)
+    fB.attribs["filemode"] = record[1]
+    fB.setGuid(record[2])
+    fB.attribs["filesize"] = record[3]
+    return fB
 
-    # Return
-    return entryList
 
+  def _recordToEntry(self, name, record):
+    """
+    Returns a DlsEntry object with the specified FileBlock name and the data
+    and locations (with their SURLs) of the specified record (see _readDirReplicas).
+    """
+    locList = []
+    for host, sfn in record[4]:
+       loc = DlsLocation(host)
+       loc.setSurl(sfn)
+       locList.append(loc)
+    return DlsEntry(self._recordToFileBlock(name, record), locList)
+
+
+  def _walkReplicas(self, userdir, hosts = None, index = None, visited = None):
+    """
+    Generator that traverses (recursively) the FileBlocks namespace under
+    the specified directory, and yields a (FileBlock name, record) pair for
+    each FileBlock with replicas (in the specified hosts, if not None). The
+    records are those returned by _readDirReplicas. The traversal is done by
+    a DlsLfcWalker object (concurrently, if so set).
+
+    If an index (as returned by _loadLocationIndex) is specified, the contents
+    of the directories in it are reused, unless the directory has been 
+    modified or the contents are older than self.indexMaxAge. The data of all
+    the traversed directories (for a new index) are stored in the visited dict.
+
+    @exception DlsLfcApiError: On error with the DLS catalog
+
+    @param userdir: the directory to traverse, as a string (without root path)
+    @param hosts: dict of locations to consider, or None for all of them
+    @param index: location index to reuse, or None
+    @param visited: dict to store the data of the traversed directories, or None
+
+    @return: an iterator on (FileBlock name, record) pairs
+    """
+    def readDir(binding, userdir):
+       # Stat dir (for its modification time, and to avoid the 60 seconds timeout!)
+       mtime = None
+       fstat = binding.lfc_filestatg()
+       if(binding.lfc_statg(self._checkDlsHome(userdir), "", fstat)<0):
+          code = binding.cvar.serrno
+          msg = "Error accessing FileBlock %s: %s" % (userdir, binding.sstrerror(code))
+          if(self.verb >= DLS_VERB_WARN):
+             print "Warning: %s" % (msg)
+       else:
+          mtime = fstat.mtime
+
+       # Read it (unless it is in the index, unmodified and not too old)
+       now = time.time()
+       cached = None
+       if(index is not None):
+          cached = index["dirs"].get(userdir)
+       if(cached and (mtime is not None) and (cached[0] == mtime)
+                 and (now - cached[1] < self.indexMaxAge)):
+          readTime, items = cached[1:]
+       else:
+          readTime = now
+          items = self._readDirReplicas(binding, userdir, hosts)
+       if(visited is not None):
+          visited[userdir] = (mtime, readTime, items)
+       return items
+
+    for subdir, rel, data, items in DlsLfcWalker(self, readDir).walk(userdir):
+       base = _joinPath(subdir, "")
+       for name, isDir, record in items:
+          if((not isDir) and record[4]):
+             yield (base + name, record)
+
+
+  def _lockLocationIndex(self):
+    """
+    Locks (exclusively) the location index, by means of the "<index>.lock"
+    file, which also holds the generation number of the index (increased
+    every time the index is invalidated, see _invalidateLocationIndex).
+    Any read-modify-write of the index must be done holding this lock.
+
+    @return: the locked file (to be passed to _unlockLocationIndex), or None
+    if it could not be locked
+    """
+    lockName = "%s.lock" % (self.locationIndex)
+    try:
+       f = open(lockName, 'a+')
+    except IOError, inst:
+       if(self.verb >= DLS_VERB_WARN):
+          print "Warning: Could not open location index lock %s: %s" % (lockName, inst)
+       return None
+    try:
+       fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    except IOError, inst:
+       f.close()
+       if(self.verb >= DLS_VERB_WARN):
+          print "Warning: Could not lock location index %s: %s" % (lockName, inst)
+       return None
+    return f
+
+
+  def _unlockLocationIndex(self, lock):
+    """
+    Releases the lock returned by _lockLocationIndex (if not None).
+
+    @param lock: the locked file, or None
+    """
+    if(lock):
+       lock.close()
+
+
+  def _indexGeneration(self, lock):
+    """
+    Returns the generation number of the location index, as stored in the
+    specified (locked) lock file, or None if there is no lock.
+
+    @param lock: the locked file, as returned by _lockLocationIndex, or None
+
+    @return: the generation number, as an integer (or None)
+    """
+    if(not lock):
+       return None
+    lock.seek(0)
+    try:
+       return int(lock.read().strip() or 0)
+    except ValueError:
+       return 0
+
+
+  def _loadLocationIndex(self, lock):
+    """
+    Returns the location index stored in the self.locationIndex file, or a
+    new empty index if it does not exist or is not valid (e.g. it belongs
+    to another DLS server or has an old format). The index is a dict with the
+    DLS server and root path ("endpoint"), the format version ("format"), and the contents of each directory ("dirs") as
+    stored in the visited argument of the _walkReplicas method. The
+    "generation" of the index at the time it is read is also set, so that
+    later invalidations can be detected before storing it again.
+
+    @param lock: the locked file, as returned by _lockLocationIndex, or None
+
+    @return: the location index, as a dict
+    """
+    endpoint = (self.server, self.root)
+    generation = self._indexGeneration(lock)
+    try:
+       f = open(self.locationIndex, 'rb')
+       try:
+          index = cPickle.load(f)
+       finally:
+          f.close()
+       if(isinstance(index, dict) and (index.get("endpoint") == endpoint)
+                                  and (index.get("format") == DLS_LFC_INDEX_FORMAT)):
+          index["generation"] = generation
+          return index
+       if(self.verb >= DLS_VERB_WARN):
+          print "Warning: Ignoring location index %s (not for this DLS server or old format)" % (self.locationIndex)
+    except IOError:
+       pass
+    except Exception, inst:
+       if(self.verb >= DLS_VERB_WARN):
+          print "Warning: Ignoring unreadable location index %s: %s" % (self.locationIndex, inst)
+    return {"endpoint": endpoint, "format": DLS_LFC_INDEX_FORMAT, "dirs": {},
+            "generation": generation}
+
+
+  def _saveLocationIndex(self, index):
+    """
+    Stores the specified location index in the self.locationIndex file. It is
+    written to a temporary file first and then renamed, so that concurrent
+    readers never see a partially written index. The caller must hold the
+    lock of the index (see _lockLocationIndex).
+
+    @param index: the location index, as a dict
+    """
+    tmpName = "%s.%d" % (self.locationIndex, getpid())
+    try:
+       f = open(tmpName, 'wb')
+       try:
+          cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+       finally:
+          f.close()
+       rename(tmpName, self.locationIndex)
+    except (IOError, OSError), inst:
+       if(self.verb >= DLS_VERB_WARN):
+          print "Warning: Could not store location index %s: %s" % (self.locationIndex, inst)
+
+
+  def _invalidateLocationIndex(self, dlsEntryList):
+    """
+    Removes from the location index (if used) the directories holding the
+    FileBlocks of the specified entries (and the FileBlocks themselves, in
+    case they are directories), so that they are read again by the next
+    getFileBlocks, and increases the generation number of the index, so
+    that a getFileBlocks running concurrently does not store the contents
+    it read before. This is all done holding the lock of the index; if it
+    cannot be locked, the whole index is removed instead.
+
+    @param dlsEntryList: list of DlsEntry objects
+    """
+    if(not self.locationIndex):
+       return
+    lock = self._lockLocationIndex()
+    if(not lock):
+       try:
+          unlink(self.locationIndex)
+       except OSError, inst:
+          if((inst.errno != ENOENT) and (self.verb >= DLS_VERB_WARN)):
+             print "Warning: Could not remove location index %s: %s" % (self.locationIndex, inst)
+       return
+    try:
+       index = self._loadLocationIndex(lock)
+       index["generation"] += 1
+       try:
+          lock.seek(0)
+          lock.truncate()
+          lock.write("%d\n" % (index["generation"]))
+          lock.flush()
+       except IOError, inst:
+          if(self.verb >= DLS_VERB_WARN):
+             print "Warning: Could not update location index lock: %s" % (inst)
+       removed = False
+       for entry in dlsEntryList:
+          userlfn = self._removeRootPath(self._checkDlsHome(entry.fileBlock.name))
+          if(userlfn is None):
+             continue
+          userlfn = '/' + userlfn.strip('/')
+          for key in [userlfn, dirname(userlfn)]:
+             if(index["dirs"].has_key(key)):
+                del index["dirs"][key]
+                removed = True
+       if(removed):
+          self._saveLocationIndex(index)
+    finally:
+       self._unlockLocationIndex(lock)
 
 
 ##################################################333
@@ -27,10 +27,16 @@ import dlsApi
 #import dlsDataObjects
 from dlsDataObjects import *
 import socket
+import select
 import string
+from dlsDefaults import DLS_MYSQL_PIPELINE_DEPTH, DLS_MYSQL_SEND_COPY_MAX, DLS_MYSQL_BATCH_SIZE
+from dlsDefaults import DLS_MYSQL_MAX_MESSAGE_SIZE, DLS_MYSQL_PROBE_TIMEOUT
 #########################################
 # Module globals
 #########################################
+# Flag for recv to wait for the whole requested size (if supported)
+_MSG_WAITALL = getattr(socket, "MSG_WAITALL", 0)
+
 #DLS_VERB_NONE = 0    # print nothing
 #DLS_VERB_INFO = 5    # print info
 #DLS_VERB_WARN = 10   # print only warnings (to stdout)
@@ -91,11 +97,22 @@ class DlsMySQLApi(dlsApi.DlsApi):
     The verbosity level affects invocations of all methods in this object. See
     the dlsApi.DlsApi.setVerbosity method for information on accepted values.
       
+    The pipelineDepth argument (**kwd) sets the maximum number of requests
+    sent to the server through a connection before reading their replies
+    (see dls_requests). Use 1 for no pipelining.
+
+    The batchSize argument (**kwd) sets the maximum number of replicas
+    (block/SE pairs, or blocks for getLocations) sent in a single batched
+    request, if the server supports them (see _replicaRequests). Use 0 to
+    always use the one-replica requests.
+      
     @exception SetupError: if no DLS server can be found.
 
     @param dls_endpoint: the DLS server to be used, as a string of form "hostname[:port]"
     @param verbosity: value for the verbosity level
-    @param kwd: Flags (currently none, only for compatibility with DlsApi)
+    @param kwd: Flags:
+      - pipelineDepth: Integer (default DLS_MYSQL_PIPELINE_DEPTH), max requests in flight
+      - batchSize: Integer (default DLS_MYSQL_BATCH_SIZE), max replicas per batched request
     """
 
     dlsApi.DlsApi.__init__(self, dls_endpoint, verbosity)    
@@ -111,6 +128,22 @@ class DlsMySQLApi(dlsApi.DlsApi):
     dlsserver = self.server.split('/')[0]
     self.server = dlsserver
 
+    # Connection (kept open within a session)
+    self.__client = None
+    self.session = False
+    self.__replies = 0
+    self.reuseConnection = True
+    self.serverKeepAlive = None
+    self.pipelineDepth = DLS_MYSQL_PIPELINE_DEPTH
+    if(kwd.has_key("pipelineDepth")):
+       self.pipelineDepth = max(1, kwd.get("pipelineDepth"))
+
+    # Batched requests (server support checked with the first use)
+    self.batchSize = DLS_MYSQL_BATCH_SIZE
+    if(kwd.has_key("batchSize")):
+       self.batchSize = max(0, kwd.get("batchSize"))
+    self.batchSupport = None
+
   ############################################
   # Methods defining the main public interface
   ############################################
@@ -130,19 +163,15 @@ class DlsMySQLApi(dlsApi.DlsApi):
     else:
        theList = [dlsEntryList]
 
+    msgList = []
     for entry in theList:
       fb=entry.fileBlock.name
       for location in entry.locations:
             se=location.host
-            #print "fb %s"%fb
-            #print "ses %s"%se
-            self.dls_connect()
-            msg='add_replica?%s?%s'%(fb,se)
-            if ( self.verb > 10 ) :
-                print "Send:%s"%(msg)
-            self.dls_send(msg)           
-            msg=self.dls_receive()
-            
+            msgList.append('%s?%s'%(fb,se))
+
+    # All the requests are sent through the same connection
+    for msg in self._replicaRequests('add_replica', 'add_replicas', msgList):
             if ( self.verb > 10 ):
                 if msg=="0":
                     print "Replica Registered"
@@ -151,8 +180,6 @@ class DlsMySQLApi(dlsApi.DlsApi):
                 else:
                     msg="2"
                     print "Replica not registered"
-            self.__client.close()
-            #return int(msg)
 #TODO : error code
     return 
 
@@ -170,19 +197,15 @@ class DlsMySQLApi(dlsApi.DlsApi):
     else:
        theList = [dlsEntryList]
 
+    msgList = []
     for entry in theList:
       fb=entry.fileBlock.name
       for location in entry.locations:
             se=location.host
-            #print "fb %s"%fb
-            #print "ses %s"%se
-            self.dls_connect()
-            msg='remove_replica?%s?%s'%(fb,se)
-            if ( self.verb > 10 ):
-                print "Send:%s"%(msg)
-            self.dls_send(msg)
-            msg=self.dls_receive()
-            
+            msgList.append('%s?%s'%(fb,se))
+
+    # All the requests are sent through the same connection
+    for msg in self._replicaRequests('remove_replica', 'remove_replicas', msgList):
             if ( self.verb > 10 ):
                 if msg=="0":
                     print "Replica Deleted"
@@ -191,9 +214,6 @@ class DlsMySQLApi(dlsApi.DlsApi):
                 else:
                     print "error: %s not Stored"%(msg) 
                     msg="2"
-            
-            self.__client.close()
-            #return int(msg)
 #TODO : error code
     return
 
@@ -213,26 +233,25 @@ class DlsMySQLApi(dlsApi.DlsApi):
     else:
        theList = [fileBlockList]
 
-    entryList = []
+    fbList = []
     for fblock in theList:
             # Check what was passed (DlsFileBlock or string)
             if(isinstance(fblock, DlsFileBlock)):
               fb = fblock.name
             else:
               fb = fblock
+            fbList.append(fb)
+
+    # All the requests are sent through the same connection
+    replies = self._replicaRequests('show_replica_by_db', 'show_replicas_by_db', fbList)
+
+    entryList = []
+    for fb, msg in zip(fbList, replies):
             entry = DlsEntry(DlsFileBlock(fb))
-            self.dls_connect()
-            msg='show_replica_by_db?%s'%(fb)
-            self.dls_send(msg)
-            if ( self.verb > 10 ):
-                print "Send: %s"%(msg)
-            msg=self.dls_receive()
-            if ( self.verb > 10 ):
-                print "Received from server:"
-            #print msg
-            ses=string.split(msg,'\n')
+            # (SEs separated by new lines, or spaces in batched replies)
+            ses=string.split(msg)
             locList = []
-            if ses == ['']:
+            if not ses:
               msg=" No locations found for %s"%fb
               code=4
               raise DlsMySQLApiError(msg, code)
@@ -241,8 +260,6 @@ class DlsMySQLApi(dlsApi.DlsApi):
              locList.append(loc)
             entry.locations = locList
             entryList.append(entry)
-            self.__client.close()
-            #return 0
     return entryList
     
 
@@ -261,22 +278,20 @@ class DlsMySQLApi(dlsApi.DlsApi):
     else:
        theList = [locationList]
 
-    entryList = []
+    seList = []
     for loc in theList:
             # Check what was passed (DlsLocation or string)
             if(isinstance(loc, DlsLocation)):
               se = loc.host
             else:
               se = loc 
-            self.dls_connect()
-            msg='show_replica_by_se?%s'%(se)
-            self.dls_send(msg)
-            if ( self.verb > 10 ):
-                print "Send: %s"%(msg) 
-            msg=self.dls_receive()
-            if ( self.verb > 10 ):
-                print "Received from server:"
-            #print msg
+            seList.append(se)
+
+    # All the requests are sent through the same connection
+    replies = self.dls_requests(['show_replica_by_se?%s'%(se) for se in seList])
+
+    entryList = []
+    for se, msg in zip(seList, replies):
             fblocks=string.split(msg,'\n')
             if fblocks == ['']:
               msg=" No fileblocks found for %s"%se
@@ -285,8 +300,6 @@ class DlsMySQLApi(dlsApi.DlsApi):
             for fb in fblocks:
               entry = DlsEntry(DlsFileBlock(fb),[DlsLocation(se)])
               entryList.append(entry)
-            self.__client.close()
-            #return 0
     return entryList
 
   def getAllLocations(self,**kwd):
@@ -296,15 +309,7 @@ class DlsMySQLApi(dlsApi.DlsApi):
     """
     locList = []
 
-    self.dls_connect()
-    msg='show_allreplicas?'
-    self.dls_send(msg)
-    if ( self.verb > 10 ):
-       print "Send: %s"%(msg)
-    msg=self.dls_receive()
-    if ( self.verb > 10 ):
-        print "Received from server:"
-    #print msg
+    msg=self.dls_request('show_allreplicas?')
     ses=string.split(msg,'\n')
     if ses == ['']:
       msg=" No locations found "
@@ -316,10 +321,33 @@ class DlsMySQLApi(dlsApi.DlsApi):
     return locList 
 
   def startSession(self):
-     pass
+    """
+    Implementation of the dlsApi.DlsApi.startSession method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    Within a session, the connection to the DLS server is kept open between
+    method calls (it is opened with the first request). Outside a session,
+    a connection is used only for the requests of a single method call.
+    """
+    if ( self.verb > 10 ):
+        print "Starting session with %s"%(self.server)
+    self.session = True
  
   def endSession(self):
-     pass
+    """
+    Implementation of the dlsApi.DlsApi.endSession method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The connection to the DLS server (if open) is closed.
+    """
+    if ( self.verb > 10 ):
+        print "Ending session with %s"%(self.server)
+    self.session = False
+    self.dls_close()
  
 
   def renameFileBlock(self, oldFileBlock, newFileBlock, **kwd):
@@ -338,12 +366,7 @@ class DlsMySQLApi(dlsApi.DlsApi):
        newLfn = newFileBlock
 
 
-    self.dls_connect()
-    msg='rename_db?%s?%s'%(oldLfn,newLfn)
-    if ( self.verb > 10 ) :
-        print "Send:%s"%(msg)
-    self.dls_send(msg)
-    msg=self.dls_receive()
+    msg=self.dls_request('rename_db?%s?%s'%(oldLfn,newLfn))
      
     if msg=="0":
           if ( self.verb > 10 ): print "Fileblock renamed"
@@ -361,8 +384,6 @@ class DlsMySQLApi(dlsApi.DlsApi):
           print "Warning: "+ msgtxt
           raise DlsMySQLApiError(msgtxt, msg)
 
-    self.__client.close()
-
 
 
   ##################################
@@ -383,6 +404,262 @@ class DlsMySQLApi(dlsApi.DlsApi):
   # Internal methods
   #########################
 
+  def dls_request(self, msg):
+        """
+        Sends the specified request to the DLS server and returns its reply
+        (see dls_requests).
+        """
+        return self.dls_requests([msg])[0]
+
+  def dls_requests(self, msgList):
+        """
+        Sends the specified requests to the DLS server and returns the list
+        of their replies (in the same order).
+
+        The requests are sent through the open connection (if within a 
+        session) or a new one. Up to self.pipelineDepth requests are sent
+        before reading their replies. Until the server is known to keep the
+        connections open (i.e. once a connection has served two replies),
+        requests that are not idempotent (see _isIdempotent) are not
+        pipelined on a new connection.
+
+        Before reusing an open connection, it is checked (without waiting)
+        that the server has not closed it (e.g. because it was idle within a
+        session); if so, a new one is opened before sending anything.
+
+        If the connection breaks, a new one is opened and the requests with
+        no reply yet are sent again, as long as they are idempotent. If some
+        of them are not, they may have been applied by the server or not, so
+        they are not sent again, and an exception is raised instead. If a new
+        connection breaks with no reply, the requests are tried once more
+        without pipelining (within this call).
+
+        If the server closes a new connection after its first reply, it is
+        considered not to keep the connections open, and the requests are
+        sent one by one, each through a new connection, from then on (if
+        the connection was reset rather than closed, only within this call).
+        Outside a session, the connection is closed at the end.
+
+        @exception DlsMySQLApiError: if the connection cannot be established, 
+        it breaks with no reply through a new connection, or it breaks with
+        non idempotent requests with no reply
+
+        @param msgList: list of requests, as strings
+
+        @return: list of replies, as strings
+        """
+        replies = []
+        depth = self.pipelineDepth
+        reuse = self.reuseConnection
+        retried = False
+        try:
+           while len(replies) < len(msgList):
+              if self.__client == None:
+                 self.dls_connect()
+              elif (self.__replies > 0) and self._peerClosed():
+                 self.dls_close()
+                 if (self.serverKeepAlive == None) and (self.__replies == 1):
+                    # Closed by the server after its first reply
+                    if ( self.verb > 10 ):
+                       print "Connection closed by the server after 1 reply. Not reusing connections"
+                    self._noKeepAlive()
+                    depth = 1
+                    reuse = False
+                 elif ( self.verb > 10 ):
+                    print "Connection closed by the server (e.g. idle). Reconnecting"
+                 continue
+              fresh = (self.__replies == 0)
+              window = msgList[len(replies):len(replies)+depth]
+              if fresh and (not self.serverKeepAlive):
+                 for msg in window:
+                    if not self._isIdempotent(msg):
+                       window = window[:1]
+                       break
+              sent = 0
+              got = 0
+              try:
+                 # (if the server closed the connection after a reply, the
+                 # sending may fail, but the replies already sent can be read)
+                 try:
+                    for msg in window:
+                       if ( self.verb > 10 ):
+                          print "Send:%s"%(msg)
+                       self.dls_send(msg)
+                       sent += 1
+                 except (socket.error, RuntimeError), inst:
+                    if not sent: raise
+                 while got < sent:
+                    replies.append(self.dls_receive())
+                    got += 1
+                    self.__replies += 1
+                 if sent < len(window): raise inst
+              except (socket.error, RuntimeError), inst:
+                 self.dls_close()
+                 for msg in window[got:sent]:
+                    if not self._isIdempotent(msg):
+                       msg="DLS Server connection broken after %d of %d replies "%(len(replies), len(msgList))
+                       msg+="(the next requests may have been applied or not). Server: %s (%s)"%(self.server, inst)
+                       code=3
+                       raise DlsMySQLApiError(msg, code)
+                 if fresh and (not got):
+                    if (depth > 1) and (not retried):
+                       if ( self.verb > 10 ):
+                          print "Connection broken with no reply (%s). Retrying without pipelining"%(inst)
+                       retried = True
+                       depth = 1
+                       continue
+                    msg="DLS Server connection broken. Server: %s (%s)"%(self.server, inst)
+                    code=3
+                    raise DlsMySQLApiError(msg, code)
+                 if fresh and (got == 1) and (not self.serverKeepAlive):
+                    if ( self.verb > 10 ):
+                       print "Connection closed by the server after 1 reply (%s). Not reusing it"%(inst)
+                    if isinstance(inst, RuntimeError):
+                       self._noKeepAlive()
+                    depth = 1
+                    reuse = False
+                 if ( self.verb > 10 ):
+                    print "Connection broken (%s). Reconnecting"%(inst)
+                 continue
+              except DlsMySQLApiError:
+                 self.dls_close()
+                 raise
+              if self.__replies > 1:
+                 self.serverKeepAlive = True
+              if not reuse:
+                 self.dls_close()
+        finally:
+           if not self.session:
+              self.dls_close()
+        return replies
+
+  def _isIdempotent(self, msg):
+        """
+        Returns True if the specified request can be safely sent again (i.e.
+        it is a query: "show_*" or "capabilities" requests).
+        """
+        verb = string.split(string.split(msg, '\n', 1)[0], '?', 1)[0]
+        return (verb[:5] == 'show_') or (verb == 'capabilities')
+
+  def _noKeepAlive(self):
+        """
+        Records that the server does not keep the connections open after a
+        reply: the requests will be sent one by one, each through a new
+        connection.
+        """
+        self.serverKeepAlive = False
+        self.pipelineDepth = 1
+        self.reuseConnection = False
+
+  def _peerClosed(self):
+        """
+        Returns True if the open connection has been closed (or reset) by
+        the server, as far as can be told without waiting.
+        """
+        try:
+           if not select.select([self.__client], [], [], 0)[0]:
+              return False
+           return (self.__client.recv(1, socket.MSG_PEEK) == '')
+        except (socket.error, select.error):
+           return True
+
+  def _replicaRequests(self, verb, batchVerb, argList):
+        """
+        Sends the one-replica request verb (add_replica, remove_replica or
+        show_replica_by_db) for each of the specified arguments ("block?se",
+        or "block" for show_replica_by_db) and returns the list of their
+        replies (in the same order).
+
+        If the server supports batched requests (see _checkBatchSupport),
+        the arguments are sent in groups of up to self.batchSize, each as a
+        single batchVerb request ("<batchVerb>?<n>\n<arg1>\n<arg2>..."), whose
+        reply holds the reply for each argument in a line (in the same
+        order). Otherwise, the one-replica requests are sent (pipelined, see
+        dls_requests).
+
+        @exception DlsMySQLApiError: on connection errors, or if the reply of
+        a batched request has a wrong number of items
+
+        @param verb: the one-replica request verb, as a string
+        @param batchVerb: the corresponding batched request verb, as a string
+        @param argList: list of request arguments, as strings
+
+        @return: list of replies, as strings
+        """
+        if not argList:
+           return []
+
+        if not self._checkBatchSupport():
+           return self.dls_requests(['%s?%s'%(verb,arg) for arg in argList])
+
+        msgList = []
+        for i in xrange(0, len(argList), self.batchSize):
+           batch = argList[i:i+self.batchSize]
+           msgList.append('%s?%d\n%s'%(batchVerb, len(batch), string.join(batch, '\n')))
+
+        replies = []
+        for msg, reply in zip(msgList, self.dls_requests(msgList)):
+           items = string.split(reply, '\n')
+           expected = msg.count('\n')
+           if len(items) != expected:
+              msg="Wrong reply to a %s request: %d items (expected %d)"%(batchVerb, len(items), expected)
+              code=2
+              raise DlsMySQLApiError(msg, code)
+           replies.extend(items)
+        return replies
+
+  def _checkBatchSupport(self):
+        """
+        Returns True if batched replica requests can be used (they are not
+        disabled by the batchSize and the server supports them). The server
+        is asked for its capabilities (request "capabilities?", whose reply
+        holds the names of the supported features) only the first time.
+        Servers not knowing that request (or failing to answer it) are
+        considered not to support batched requests.
+
+        The request is sent through a dedicated connection (closed right
+        after), so that servers dropping the connection on an unknown request
+        do not affect the session connection nor the pipelining settings.
+        The reply is awaited for DLS_MYSQL_PROBE_TIMEOUT seconds at most (old
+        servers may just ignore the request); on timeout, batched requests
+        are not used.
+        """
+        if not self.batchSize:
+           return False
+
+        if self.batchSupport == None:
+           saved = [self.__client, self.__replies]
+           self.__client = None
+           try:
+              try:
+                 self.dls_connect()
+                 self.__client.settimeout(DLS_MYSQL_PROBE_TIMEOUT)
+                 self.dls_send('capabilities?')
+                 reply = self.dls_receive()
+                 self.batchSupport = ('batch' in string.split(reply))
+              except (socket.error, RuntimeError, DlsMySQLApiError), inst:
+                 if ( self.verb > 10 ):
+                    print "Could not get the server capabilities: %s"%(inst)
+                 self.batchSupport = False
+           finally:
+              self.dls_close()
+              self.__client, self.__replies = saved
+           if ( self.verb > 10 ):
+              print "Batched requests supported by the server: %s"%(self.batchSupport)
+
+        return self.batchSupport
+
+  def dls_close(self):
+        """
+        Closes the connection to the DLS server (if open).
+        """
+        if self.__client != None:
+           try:
+              self.__client.close()
+           except socket.error:
+              pass
+           self.__client = None
+
   def clientsocket(self):
         """
         """
@@ -404,6 +681,7 @@ class DlsMySQLApi(dlsApi.DlsApi):
             print "Connecting to host: %s port: %d"%(host,int(port))
 
         self.clientsocket()
+        self.__replies = 0
         
         try:
             self.__client.connect ( (host, int(port)) )
@@ -414,38 +692,68 @@ class DlsMySQLApi(dlsApi.DlsApi):
 
   def dls_send(self,msg):
         """
+        Sends the specified message to the DLS server, preceded by its
+        length (as a zero-filled 16 characters string). Small messages are
+        sent together with the length prefix (in a single packet); big ones
+        are sent after it, as they are (without copying them).
         """
-        totalsent=0
         MSGLEN=len(msg)
-        sent=  sent=self.__client.send(str(MSGLEN).zfill(16))
-        #print "Sent %s"%(str(MSGLEN).zfill(16))
-        if sent == 0:
-            raise RuntimeError,"Socket connection broken"
+        header=str(MSGLEN).zfill(16)
+        if MSGLEN < DLS_MYSQL_SEND_COPY_MAX:
+            self.__client.sendall(header + msg)
         else:
-            while totalsent < MSGLEN:
-                sent = self.__client.send(msg[totalsent:])
-                #print "Sent %s"%(msg[totalsent:])
-                if sent == 0:
-                    raise RuntimeError,"Socket connection broken"
-                totalsent = totalsent + sent
+            self.__client.sendall(header)
+            self.__client.sendall(msg)
 
 
   def dls_receive(self):
         """
+        Receives a message from the DLS server (as sent by dls_send) and
+        returns it (see _recv_exactly).
+
+        @exception DlsMySQLApiError: if the length prefix is not a number, or
+        it is bigger than DLS_MYSQL_MAX_MESSAGE_SIZE (e.g. corrupt data)
+        """
+        header = self._recv_exactly(16)
+        try:
+            MSGLEN = int(header)
+        except Exception:
+            MSGLEN = -1
+        if (MSGLEN < 0) or (MSGLEN > DLS_MYSQL_MAX_MESSAGE_SIZE):
+            msg="Wrong message length prefix from DLS Server %s: %s"%(self.server, repr(header))
+            code=2
+            raise DlsMySQLApiError(msg, code)
+        return self._recv_exactly(MSGLEN)
+
+
+  def _recv_exactly(self, size):
+        """
+        Reads exactly size bytes from the connection and returns them. They
+        are asked for at once, with MSG_WAITALL (if supported), so that the
+        kernel fills directly the string allocated by recv with the whole
+        size. If fewer bytes are got (e.g. on signals), the rest are read
+        into a buffer preallocated with the whole size (via a memoryview).
+        Note that in that (uncommon) case the buffer is copied into the
+        returned string once more.
         """
-        chunk =  self.__client.recv(16)
-        #print "Received %s"%(chunk)
-        if chunk == '':
+        # (a recv of 0 bytes may block until some data arrive)
+        if size == 0:
+            return ''
+        data = self.__client.recv(size, _MSG_WAITALL)
+        got = len(data)
+        if got == size:
+            return data
+        if got == 0:
             raise RuntimeError,"Socket connection broken"
-        MSGLEN= int(chunk)
-        msg = ''
-        while len(msg) < MSGLEN:
-            chunk =  self.__client.recv(MSGLEN-len(msg))
-            #print "Received %s"%(chunk)
-            if chunk == '':
+        buf = bytearray(size)
+        buf[:got] = data
+        view = memoryview(buf)
+        while got < size:
+            nbytes = self.__client.recv_into(view[got:], size-got)
+            if nbytes == 0:
                 raise RuntimeError,"Socket connection broken"
-            msg = msg + chunk
-        return msg
+            got = got + nbytes
+        return str(buf)
 
 
 ##################################################333
@@ -33,16 +33,30 @@ from dlsDataObjects import DlsLocation, DlsFileBlock, DlsEntry, DlsDataObjectErr
 import warnings
 warnings.filterwarnings("ignore","Python C API version mismatch for module _lfc",RuntimeWarning)
 import sys
-from os import environ, uname
+import time
+import cPickle
+from os import environ, uname, rename, getpid
 from stat import S_IFDIR
-from dlsXmlParser import DlsXmlParser
+from dlsXmlParser import DlsXmlParser, DLS_XML_EXPAT
+from dlsJsonParser import DlsJsonParser
 from xml.sax import SAXException, SAXParseException
+from xml.parsers.expat import ExpatError
 from urllib2 import (HTTPError, URLError, urlopen, build_opener, 
-                     Request, HTTPRedirectHandler)
+                     Request, HTTPRedirectHandler, HTTPHandler, HTTPSHandler,
+                     AbstractHTTPHandler)
 from urllib2 import __version__ as urllibversion
-from urllib import urlencode
+from urllib import urlencode, addinfourl
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+import socket
+import threading
+import zlib
+from urlparse import urlparse
+from dlsWorkerPool import runInPool, getEndpointSemaphore
 from dlsDefaults import DLS_PHEDEX_MAX_BLOCKS_PER_QUERY, DLS_PHEDEX_MAX_SES_PER_QUERY, \
-                        DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY, getApiVersion
+                        DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY, DLS_PHEDEX_QUERY_THREADS, \
+                        DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT, DLS_PHEDEX_READ_SIZE, \
+                        DLS_PHEDEX_SYNC_OVERLAP, DLS_PHEDEX_SYNC_FULL_PERIOD, \
+                        getApiVersion
 
 #########################################
 # Module globals
@@ -51,6 +65,10 @@ DLS_PHEDEX_BLOCKS = "DLS_PHEDEX_BLOCKS"
 DLS_PHEDEX_FILES = "DLS_PHEDEX_FILES"
 DLS_PHEDEX_ALL_LOCS = "DLS_PHEDEX_ALL_LOCS"
 
+# Formats of the data service replies
+DLS_PHEDEX_FORMAT_XML = "xml"
+DLS_PHEDEX_FORMAT_JSON = "json"
+
 #unamev = uname()
 #USERAGENT = {'User-Agent': 'dls-client/%s (CMS) urllib2/%s %s/%s (%s)' %\
 #             (getApiVersion(), urllibversion, unamev[0], unamev[2], unamev[4])}
@@ -103,6 +121,321 @@ class DlsRedirectHandler(HTTPRedirectHandler):
             raise HTTPError(req.get_full_url(), code, msg, headers, fp)
 
 
+class DlsConnectionPool:
+    """
+    Pool of idle persistent (keep-alive) HTTP(S) connections, indexed by
+    scheme and host. Connections are taken from the pool to send a request
+    and given back once its response has been completely read. Up to
+    maxIdle idle connections per host are kept; the rest are closed.
+
+    The pool can be safely used from several threads at the same time.
+    """
+
+    def __init__(self, maxIdle):
+        self.maxIdle = maxIdle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host):
+        """
+        Returns an idle connection to the specified host, or None if
+        there is none in the pool.
+        """
+        self._lock.acquire()
+        try:
+            conns = self._idle.get((scheme, host))
+            if conns:
+                return conns.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, scheme, host, conn):
+        """
+        Gives an (idle) connection back to the pool.
+        """
+        self._lock.acquire()
+        try:
+            conns = self._idle.setdefault((scheme, host), [])
+            if len(conns) < self.maxIdle:
+                conns.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+        if conn:
+            conn.close()
+
+    def closeAll(self):
+        """
+        Closes all the idle connections in the pool.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class DlsKeepAliveHandler(HTTPHandler, HTTPSHandler):
+    """
+    Handler for http and https URLs that reuses the persistent connections
+    of a DlsConnectionPool instead of opening (and closing) a new one for
+    each request, as the default urllib2 handlers do. Since it only
+    replaces the connection management, it is compatible with the rest of
+    urllib2 processing (in particular, with DlsRedirectHandler).
+
+    A connection taken from the pool may have been closed by the server
+    in the meanwhile. In that case, the request is retried once on a new
+    connection.
+
+    Requests to be tunnelled through a proxy use a new connection
+    each time.
+    """
+
+    def __init__(self, pool):
+        AbstractHTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._open(req, "http", HTTPConnection)
+
+    def https_open(self, req):
+        return self._open(req, "https", HTTPSConnection)
+
+    def _open(self, req, scheme, http_class):
+        if req._tunnel_host:
+            return self.do_open(http_class, req)
+
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        conn = self.pool.get(scheme, host)
+        if conn:
+            try:
+                r = self._request(conn, req, headers)
+            except (socket.error, HTTPException):
+                # Stale connection (probably closed by the server)
+                conn.close()
+                conn = None
+        if not conn:
+            conn = http_class(host, timeout = req.timeout)
+            try:
+                r = self._request(conn, req, headers)
+            except socket.error, err:
+                conn.close()
+                raise URLError(err)
+
+        # Same wrapping as urllib2's do_open, but the socket-like object
+        # gives back the connection to the pool on completion
+        fp = socket._fileobject(_PooledResponse(self.pool, scheme, host, conn, r),
+                                close = True)
+        resp = addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def _request(self, conn, req, headers):
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering = True)
+
+
+class _PooledResponse:
+    """
+    Socket-like wrapper of an httplib.HTTPResponse (to be used within a
+    socket._fileobject) that returns its connection to the pool when the
+    response has been completely read. If the response is closed before
+    that, or the server does not allow to reuse it, the connection is closed.
+    """
+
+    def __init__(self, pool, scheme, host, conn, resp):
+        self._pool = pool
+        self._key = (scheme, host)
+        self._conn = conn
+        self._resp = resp
+
+    def recv(self, amt):
+        data = self._resp.read(amt)
+        if self._resp.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        self._resp.close()
+        self._release()
+
+    def _release(self):
+        conn = self._conn
+        if not conn:
+            return
+        self._conn = None
+        if self._resp.isclosed() and not self._resp.will_close:
+            self._pool.put(self._key[0], self._key[1], conn)
+        else:
+            conn.close()
+
+
+
+class DlsDecompressingReader:
+    """
+    File-like object that decompresses (gzip or zlib/deflate encoded) data
+    read from another file-like object (e.g. the reply of an HTTP request)
+    as it is being read, so that it can be directly used by a parser
+    without holding the whole reply in memory.
+
+    Each read returns at most the requested amount of uncompressed bytes
+    (but may return less). When the end of the data is reached, the
+    specified onEnd function is called with the numbers of compressed
+    and uncompressed bytes read.
+    """
+
+    def __init__(self, fp, onEnd = None):
+        self._fp = fp
+        self._onEnd = onEnd
+        # Accept both gzip and zlib headers
+        self._dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._eof = False
+        self.inBytes = 0
+        self.outBytes = 0
+
+    def read(self, amt = -1):
+        if (amt is None) or (amt < 0):
+            parts = []
+            data = self.read(DLS_PHEDEX_READ_SIZE)
+            while data:
+                parts.append(data)
+                data = self.read(DLS_PHEDEX_READ_SIZE)
+            return ''.join(parts)
+
+        data = ''
+        while (not data) and (not self._eof):
+            pending = self._dec.unconsumed_tail
+            if not pending:
+                pending = self._fp.read(DLS_PHEDEX_READ_SIZE)
+                self.inBytes += len(pending)
+            if not pending:
+                data = self._dec.flush()
+                self._eof = True
+                if self._onEnd:
+                    self._onEnd(self.inBytes, self.outBytes + len(data))
+            else:
+                data = self._dec.decompress(pending, amt)
+        self.outBytes += len(data)
+        return data
+
+    def close(self):
+        self._fp.close()
+
+
+
+class DlsReplicaStore:
+    """
+    Local mirror of the FileBlock replica locations of a PhEDEx DLS, kept
+    up to date by the DlsPhedexApi.syncEntries method.
+
+    The FileBlocks and their locations are held in the "entries" dict
+    (FileBlock name to DlsEntry object). The time of the last sync (as
+    a unix timestamp, or None if never synced), the time of the last full
+    resync and the query they correspond to (DLS server, FileBlock pattern
+    and flags) are stored in the lastSync, lastFullSync and query members.
+
+    If a file name is specified, the store is read from that file on
+    creation (if it exists and is valid; otherwise the store starts empty)
+    and written back to it by the save method.
+    """
+
+    def __init__(self, fname = None):
+        self.fname = fname
+        self.clear()
+        if fname:
+            self.load()
+
+    def clear(self):
+        """
+        Removes all the entries and forgets the last sync.
+        """
+        self.entries = {}
+        self.lastSync = None
+        self.lastFullSync = None
+        self.query = None
+
+    def getEntries(self):
+        """
+        Returns the list of stored DlsEntry objects, sorted by FileBlock name.
+        """
+        names = self.entries.keys()
+        names.sort()
+        return [self.entries[name] for name in names]
+
+    def replaceAll(self, entryList):
+        """
+        Replaces all the stored entries by those in entryList (full resync).
+        """
+        self.entries = {}
+        for entry in entryList:
+            self.entries[entry.fileBlock.name] = entry
+
+    def update(self, entryList):
+        """
+        Merges the replicas in entryList (as returned by an incremental
+        query) into the stored entries: each returned location replaces the
+        stored location of the same host, or is added to the FileBlock. The
+        stored locations that are not returned are kept untouched.
+        """
+        for entry in entryList:
+            old = self.entries.get(entry.fileBlock.name)
+            if old == None:
+                self.entries[entry.fileBlock.name] = entry
+                continue
+            hosts = [loc.host for loc in old.locations]
+            for loc in entry.locations:
+                if loc.host in hosts:
+                    old.locations[hosts.index(loc.host)] = loc
+                else:
+                    old.locations.append(loc)
+                    hosts.append(loc.host)
+
+    def load(self):
+        """
+        Reads the store from its file. If the file does not exist or is not
+        valid, the store is left empty.
+        """
+        try:
+            f = open(self.fname, 'rb')
+            try:
+                state = cPickle.load(f)
+            finally:
+                f.close()
+            self.entries, self.lastSync, self.lastFullSync, self.query = state
+        except Exception:
+            self.clear()
+
+    def save(self):
+        """
+        Writes the store to its file. It is written to a temporary file first
+        and then renamed, so that concurrent readers never see a partially
+        written store. May raise IOError or OSError.
+        """
+        state = (self.entries, self.lastSync, self.lastFullSync, self.query)
+        tmpName = "%s.%d" % (self.fname, getpid())
+        f = open(tmpName, 'wb')
+        try:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        rename(tmpName, self.fname)
+
+
+
 #########################################
 # DlsPhedexApi class
 #########################################
@@ -151,6 +484,36 @@ class DlsPhedexApi(dlsApi.DlsApi):
     (e.g: [['ProdAgent', '3.45']], and a string of free format (e.g. 'Operator John').
     Both will be included in the UserAgent string used in identification with the 
     PhEDEx data service, as described in the _userAgent method's docstring.
+
+    The queryThreads argument (**kwd) sets the number of bulk queries (chunks
+    of FileBlocks or locations) that may be sent concurrently to the PhEDEx 
+    data service by a single method call (see setQueryThreads). In any case,
+    there will not be more than DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT (see the
+    dlsDefaults module) concurrent queries to the same server in the process.
+
+    Unless keepAlive (**kwd) is set to False, the HTTP(S) connections to the 
+    PhEDEx data service are not closed after each query, but kept in a pool
+    owned by this object, and reused by subsequent queries (of this or other
+    method calls). The pool connections are closed by the endSession method.
+
+    Unless compression (**kwd) is set to False, compressed (gzip) replies
+    are requested from the PhEDEx data service. These are decompressed
+    as they are parsed. With the highest verbosity, the number of 
+    transferred (compressed) and uncompressed bytes is shown for each reply.
+
+    The format (**kwd) argument selects the format of the data service replies:
+    DLS_PHEDEX_FORMAT_XML (default) or DLS_PHEDEX_FORMAT_JSON. The returned
+    objects are the same in both cases. For the JSON format, the endpoint 
+    should be of the standard form ".../datasvc/xml/<instance>" (or 
+    ".../datasvc/json/<instance>"), since the format is selected in the URL.
+    For the XML format, the xmlBackend (**kwd) argument selects the parser
+    back-end (see the dlsXmlParser.DlsXmlParser class).
+
+    If shareLocations (**kwd) is set to True, the locations returned by 
+    getFileLocs and iterFileLocs (which hold no attributes) are read-only
+    DlsLocation objects shared by all the replicas in the same SE (see
+    dlsDataObjects.internLocation). This saves much memory for large
+    queries, but the returned locations cannot be modified.
       
     @exception DlsConfigError: if no DLS server can be found.
 
@@ -160,6 +523,12 @@ class DlsPhedexApi(dlsApi.DlsApi):
        - checkEndpoint: Boolean (default False) for testing of the DLS endpoint
        - uaClientsList: List of client,version pairs of strings for the UserAgent string
        - uaFlexString: String, flexible (format-free) part of the UserAgent string
+       - queryThreads: Integer, number of concurrent bulk queries per method call
+       - keepAlive: Boolean (default True) for reusing connections among queries
+       - compression: Boolean (default True) for requesting compressed replies
+       - format: String, format of the data service replies (default "xml")
+       - xmlBackend: String, XML parser back-end (default "expat")
+       - shareLocations: Boolean (default False) for sharing file replica locations
     """
 
     # Keywords
@@ -175,6 +544,30 @@ class DlsPhedexApi(dlsApi.DlsApi):
     if(kwd.has_key("uaClientsList")):
        uaClientsList = kwd.get("uaClientsList")
 
+    queryThreads = DLS_PHEDEX_QUERY_THREADS
+    if(kwd.has_key("queryThreads")):
+       queryThreads = kwd.get("queryThreads")
+
+    keepAlive = True
+    if(kwd.has_key("keepAlive")):
+       keepAlive = kwd.get("keepAlive")
+
+    self.compression = True
+    if(kwd.has_key("compression")):
+       self.compression = kwd.get("compression")
+
+    dataFormat = DLS_PHEDEX_FORMAT_XML
+    if(kwd.has_key("format")):
+       dataFormat = kwd.get("format")
+
+    xmlBackend = DLS_XML_EXPAT
+    if(kwd.has_key("xmlBackend")):
+       xmlBackend = kwd.get("xmlBackend")
+
+    shareLocations = False
+    if(kwd.has_key("shareLocations")):
+       shareLocations = kwd.get("shareLocations")
+
     # Let the parent set the server endpoint (if possible) and verbosity
     dlsApi.DlsApi.__init__(self, dls_endpoint, verbosity)
 
@@ -188,13 +581,31 @@ class DlsPhedexApi(dlsApi.DlsApi):
 
     self.server = self.server.strip('/')
   
-    # Create the parser
-    self.parser = DlsXmlParser()
+    # Create the parser (and point to the data service of the right format)
+    if(dataFormat == DLS_PHEDEX_FORMAT_XML):
+       self.parser = DlsXmlParser(xmlBackend, shareLocations)
+    elif(dataFormat == DLS_PHEDEX_FORMAT_JSON):
+       self.parser = DlsJsonParser(shareLocations)
+    else:
+       msg = "Specified format (%s) is not one of the admitted values: %s" % \
+             (dataFormat, [DLS_PHEDEX_FORMAT_XML, DLS_PHEDEX_FORMAT_JSON])
+       raise DlsConfigError(msg)
+    self.format = dataFormat
+    self.server = self._formatUrl(self.server, dataFormat)
+
+    # Create the URL opener (shared by all queries, and threads)
+    self._connPool = None
+    if keepAlive:
+       self._connPool = DlsConnectionPool(DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT)
+       self._opener = build_opener(DlsRedirectHandler(), DlsKeepAliveHandler(self._connPool))
+    else:
+       self._opener = build_opener(DlsRedirectHandler())
 
     # Set the default number of elements for bulk queries
     self.setBlocksPerQuery ( DLS_PHEDEX_MAX_BLOCKS_PER_QUERY )
     self.setBlocksPerFileQuery ( DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY )
     self.setLocsPerQuery ( DLS_PHEDEX_MAX_SES_PER_QUERY )
+    self.setQueryThreads ( queryThreads )
 
     # Store the internal UserAgent variables
 #    import pdb; pdb.set_trace()
@@ -215,9 +626,8 @@ class DlsPhedexApi(dlsApi.DlsApi):
 #         self._debug("Checking endpoint %s..." % self.server)
          urlv = self._buildXmlUrl(self.server, DLS_PHEDEX_BLOCKS, ["-"])
 #         req = Request(urlv[0] + '?' + urlencode(urlv[1]), None, USERAGENT)
-         req = Request(urlv[0] + '?' + urlencode(urlv[1]), None, self._userAgent())
-         opener = build_opener(DlsRedirectHandler())
-         url = opener.open(req)
+         req = Request(urlv[0] + '?' + urlencode(urlv[1]), None, self._headers())
+         url = self._openUrl(req)
          #
          self.parser.xmlToEntries(url)
       except Exception, inst:
@@ -260,6 +670,10 @@ class DlsPhedexApi(dlsApi.DlsApi):
     to True some FileBlock replicas are filtered out. Likewise, if the
     subscribed or custodial flags are set to True, some replicas are not shown.
 
+    If updatedSince or createdSince (**kwd) are set to a unix timestamp, 
+    only the replicas updated (or created) since that time are returned
+    (see also the syncEntries method).
+
     The following keyword flags are ignored: session.
     """
     # Keywords
@@ -279,68 +693,19 @@ class DlsPhedexApi(dlsApi.DlsApi):
     showCAF= False
     if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
 
-    # Make sure the argument is a list
-    if (isinstance(fileBlockList, list)):
-       theList = fileBlockList 
-    else:
-       theList = [fileBlockList]
-
-    # Loop on the entries to build a list of blocks to ask for
-    lfnList = []
-    for fB in theList:
-       # Check what was passed (DlsFileBlock or string)
-       if(isinstance(fB, DlsFileBlock)):
-         lfn = fB.name
-       else:
-         lfn = fB
-
-       # If '/' or '*' or '%' is given, we want all blocks back
-       if (lfn=='/') or (lfn == '*') or (lfn == '%'):
-          lfn = '/%'
+    updatedSince = None
+    if(kwd.has_key("updatedSince")):   updatedSince = kwd.get("updatedSince")
+    createdSince = None
+    if(kwd.has_key("createdSince")):   createdSince = kwd.get("createdSince")
 
-       lfnList.append(('block', lfn)) 
-       
-    multiList = self._toMultiList(lfnList, DLS_PHEDEX_MAX_BLOCKS_PER_QUERY)
-    urlbase = self.server + '/blockReplicas'
+    urlbase, multiList, arglist2, lfnList = self._locationsQuery(fileBlockList, subscribed, \
+                                     custodial, showProd, showCAF, updatedSince, createdSince)
 
-    
-    msg = "Number of arguments per bulk query: "
-    for i in multiList: msg += str(len(i)) + ' '
-    self._debug(msg)
-
-    arglist2 = []
-    # flags that could be added: incomplete, updated_since, created_since
-    arglist2.append(('complete', 'y'))
-    if subscribed:
-       arglist2 += [('subscribed','y')]
-    if custodial:
-       arglist2 += [('custodial','y')]
-    if not (showProd and showCAF):
-       arglist2 += [('op','node:and')]
-    if not showProd:
-       arglist2 += [('node','!T0*'), ('node','!T1*')]
-    if not showCAF:
-       arglist2 += [('node','!T2_CH_CAF')]
-    self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
-  
-    eList = []
-    partList = []
-    for arglist in multiList:
-      if not arglist: continue
-      # Get the locations
-      try:  
-         # Build the xml query to use
-#         req = Request(urlbase, urlencode(arglist + arglist2), USERAGENT)
-         req = Request(urlbase, urlencode(arglist + arglist2), self._userAgent())
-         opener = build_opener(DlsRedirectHandler())
-         url = opener.open(req)
-         partList = self.parser.xmlToEntries(url)
-      except Exception, inst:
-         msg = "Error retrieving locations"
-         msg_w = msg + ". Skipping"
-         self._mapException(inst, msg, msg_w, errorTolerant)
-      # Add to the total 
-      eList += partList
+    # Get the locations (the bulk queries are run concurrently)
+    msg = "Error retrieving locations"
+    msg_w = msg + ". Skipping"
+    eList = self._bulkQuery(urlbase, multiList, arglist2, self.parser.xmlToEntries, \
+                            msg, msg_w, errorTolerant)
 
     # Check if the list was empty
     if(not eList):
@@ -434,23 +799,10 @@ class DlsPhedexApi(dlsApi.DlsApi):
            arglist2 += [('node','!T2_CH_CAF')]
     self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
 
-    eList = []
-    partList = []
-    for arglist in multiList:
-      if not arglist: continue
-      # Get the blocks
-      try:  
-         # Build the xml query to use
-#         req = Request(urlbase, urlencode(arglist + arglist2), USERAGENT)
-         req = Request(urlbase, urlencode(arglist + arglist2), self._userAgent())
-         opener = build_opener(DlsRedirectHandler())
-         url = opener.open(req)
-         partList = self.parser.xmlToEntries(url)
-      except Exception, inst:
-         msg = "Error retrieving FileBlocks for %s" % (locList)
-         self._mapException(inst, msg, msg, False)
-      # Add to the total 
-      eList += partList
+    # Get the blocks (the bulk queries are run concurrently)
+    msg = "Error retrieving FileBlocks for %s" % (locList)
+    eList = self._bulkQuery(urlbase, multiList, arglist2, self.parser.xmlToEntries, \
+                            msg, msg, False)
        
     # Return what we got
     return eList
@@ -520,23 +872,11 @@ class DlsPhedexApi(dlsApi.DlsApi):
     #arglist2.append(('complete', 'y'))
     self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
 
-    bList = []
-    partList = []
-    for arglist in multiList:
-      if not arglist: continue
-      # Get the blocks
-      try:  
-#         req = Request(urlbase, urlencode(arglist + arglist2), USERAGENT)
-         req = Request(urlbase, urlencode(arglist + arglist2), self._userAgent())
-         opener = build_opener(DlsRedirectHandler())
-         url = opener.open(req)
-         partList = self.parser.xmlToBlocks(url)
-      except Exception, inst:
-         msg = "Error retrieving fileblock information"
-         msg_w = msg + ". Skipping"
-         self._mapException(inst, msg, msg_w, errorTolerant = True)
-      # Add to the total 
-      bList += partList
+    # Get the blocks (the bulk queries are run concurrently)
+    msg = "Error retrieving fileblock information"
+    msg_w = msg + ". Skipping"
+    bList = self._bulkQuery(urlbase, multiList, arglist2, self.parser.xmlToBlocks, \
+                            msg, msg_w, errorTolerant = True)
     
     # Check if the list was empty
     if(not bList):
@@ -578,78 +918,65 @@ class DlsPhedexApi(dlsApi.DlsApi):
     showCAF= False
     if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
 
-    # Make sure the argument is a list
-    if (isinstance(fileBlockList, list)):
-       theList = fileBlockList 
-    else:
-       theList = [fileBlockList]
+    urlbase, multiList, arglist2 = self._fileLocsQuery(fileBlockList, subscribed, \
+                                                       custodial, showProd, showCAF)
 
-    # Loop on the entries to build a list of blocks to ask for
-    lfnList = []
-    for fB in theList:
-       # Check what was passed (DlsFileBlock or string)
-       if(isinstance(fB, DlsFileBlock)):
-         lfn = fB.name
-       else:
-         lfn = fB
+    # Get the file replicas (the bulk queries are run concurrently)
+    msg = "Error getting files for FileBlock in DLS"
+    msg_w = msg + ". Skipping"
+    flList = self._bulkQuery(urlbase, multiList, arglist2, self.parser.xmlToFileLocs, \
+                             msg, msg_w, errorTolerant)
+    
+    # Return what we got
+    return flList
 
-       # Check that the passed FileBlock is not a pattern
-       if (lfn.find('*') != -1) or (lfn.find('%') != -1):
-         msg = "FileBlock patterns (containing '*' or '%%' wildcards) are not acceptable: "+lfn
-         raise DlsInvalidBlockName(msg)
-         
-       if lfn: lfnList.append(('block', lfn)) 
-       
-    if not lfnList: 
-       msg = "Error querying for file replicas. A FileBlock must be specified"
-       raise DlsArgumentError(msg)
 
-    multiList = self._toMultiList(lfnList, DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY)
-    urlbase = self.server + '/fileReplicas'
+  def iterFileLocs(self, fileBlockList, **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterFileLocs method.
+    Refer to that method's documentation.
 
-    msg = "Number of arguments per bulk query: "
-    for i in multiList: msg += str(len(i)) + ' '
-    self._debug(msg)
+    Implementation specific remarks:
 
-    arglist2 = []
-    # flags that could be added: incomplete, updated_since, created_since
-    arglist2.append(('dist_complete', 'y'))
-    if subscribed:
-       arglist2 += [('subscribed','y')]
-    if custodial:
-       arglist2 += [('custodial','y')]
-    if not (showProd and showCAF):
-       arglist2 += [('op','node:and')]
-    if not showProd:
-       arglist2 += [('node','!T0*'), ('node','!T1*')]
-    if not showCAF:
-       arglist2 += [('node','!T2_CH_CAF')]
-    self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
+    The same remarks as for the getFileLocs method apply.
 
-    flList = []
-    partList = []
+    The FileBlocks are queried for in bulk queries of up to
+    DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY FileBlocks (see dlsDefaults),
+    one after another, and each reply is parsed as it is read, so that
+    the results are yielded as soon as they arrive. If errorTolerant is
+    True, the results of a failed query that were already yielded are 
+    not taken back.
+    """
+    
+    # Keywords
+    errorTolerant = False
+    if(kwd.has_key("errorTolerant")):   errorTolerant = kwd.get("errorTolerant")
+    
+    subscribed = False
+    if(kwd.has_key("subscribed")):   subscribed = kwd.get("subscribed")
+    custodial = False
+    if(kwd.has_key("custodial")):   custodial = kwd.get("custodial")
+
+    showProd = False
+    if(kwd.has_key("showProd")):   showProd = kwd.get("showProd")
+    showCAF= False
+    if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
+
+    urlbase, multiList, arglist2 = self._fileLocsQuery(fileBlockList, subscribed, \
+                                                       custodial, showProd, showCAF)
+
+    # Get the file replicas, one query at a time
     for arglist in multiList:
       if not arglist: continue
-      # Get the file replicas
       try:  
-         # Build the xml query to use
-#         req = Request(urlbase, urlencode(arglist + arglist2), USERAGENT)
-         req = Request(urlbase, urlencode(arglist + arglist2), self._userAgent())
-#         url = urlopen(urlbase, urlencode(arglist + arglist2))
-#         url = urlopen(req)
-         opener = build_opener(DlsRedirectHandler())
-         url = opener.open(req)
-         #
-         partList = self.parser.xmlToFileLocs(url)
+         req = Request(urlbase, urlencode(arglist + arglist2), self._headers())
+         url = self._openUrl(req)
+         for item in self.parser.iterFileLocs(url):
+            yield item
       except Exception, inst:
          msg = "Error getting files for FileBlock in DLS"
          msg_w = msg + ". Skipping"
          self._mapException(inst, msg, msg_w, errorTolerant)
-      # Add to the total
-      flList += partList
-    
-    # Return what we got
-    return flList
 
 
   def getAllLocations(self, **kwd):
@@ -673,9 +1000,8 @@ class DlsPhedexApi(dlsApi.DlsApi):
        self._debug("Using PhEDex xml url: " + urlbase + str(urlargs))
        urlv = self._buildXmlUrl(self.server, DLS_PHEDEX_BLOCKS, ["-"])
 #       req = Request(urlbase + '?' + urlencode(urlargs), None, USERAGENT)
-       req = Request(urlbase + '?' + urlencode(urlargs), None, self._userAgent())
-       opener = build_opener(DlsRedirectHandler())
-       url = opener.open(req)
+       req = Request(urlbase + '?' + urlencode(urlargs), None, self._headers())
+       url = self._openUrl(req)
        locList = self.parser.xmlToLocations(url)
     except Exception, inst:
        msg = "Error getting all locations in DLS"
@@ -701,6 +1027,7 @@ class DlsPhedexApi(dlsApi.DlsApi):
     The showProd and showCAF flags are taken into account and if not set 
     to True some FileBlock replicas are filtered out. Likewise, if the
     subscribed or custodial flags are set to True, some replicas are not shown.
+    The updatedSince and createdSince flags are used as in getLocations.
 
     The following keyword flags are ignored: session, recursive.
     """
@@ -716,16 +1043,179 @@ class DlsPhedexApi(dlsApi.DlsApi):
     showCAF= False
     if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
 
+    updatedSince = None
+    if(kwd.has_key("updatedSince")):   updatedSince = kwd.get("updatedSince")
+    createdSince = None
+    if(kwd.has_key("createdSince")):   createdSince = kwd.get("createdSince")
+
     # This can be achieved by listing the fBs and associated locations
     result = self.getLocations(dir, longList=False, errorTolerant=True, \
                                subscribed=subscribed, custodial=custodial, \
-                               showProd=showProd, showCAF=showCAF)
+                               showProd=showProd, showCAF=showCAF, \
+                               updatedSince=updatedSince, createdSince=createdSince)
 
     # Return what we got
     return result
 
 
 
+  def iterEntries(self, dir = "/", **kwd):
+    """
+    Implementation of the dlsApi.DlsApi.iterEntries method.
+    Refer to that method's documentation.
+
+    Implementation specific remarks:
+
+    The same remarks as for the dumpEntries method apply.
+
+    The reply of the PhEDEx data service is parsed as it is read, and the
+    entries are yielded as soon as each of them has been parsed (with the
+    JSON format, the reply is decoded at once, though). If the query fails,
+    the error is just warned about (like for dumpEntries), but the entries
+    already yielded are not taken back.
+    """
+
+    # Keywords
+    subscribed = False
+    if(kwd.has_key("subscribed")):   subscribed = kwd.get("subscribed")
+    custodial = False
+    if(kwd.has_key("custodial")):   custodial = kwd.get("custodial")
+
+    showProd = False
+    if(kwd.has_key("showProd")):   showProd = kwd.get("showProd")
+    showCAF= False
+    if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
+
+    updatedSince = None
+    if(kwd.has_key("updatedSince")):   updatedSince = kwd.get("updatedSince")
+    createdSince = None
+    if(kwd.has_key("createdSince")):   createdSince = kwd.get("createdSince")
+
+    urlbase, multiList, arglist2, lfnList = self._locationsQuery(dir, subscribed, \
+                                     custodial, showProd, showCAF, updatedSince, createdSince)
+
+    # Get the entries, one query at a time
+    found = False
+    for arglist in multiList:
+      if not arglist: continue
+      try:  
+         req = Request(urlbase, urlencode(arglist + arglist2), self._headers())
+         url = self._openUrl(req)
+         for entry in self.parser.iterEntries(url):
+            found = True
+            yield entry
+      except Exception, inst:
+         msg = "Error retrieving locations"
+         msg_w = msg + ". Skipping"
+         self._mapException(inst, msg, msg_w, True)
+
+    # Check if the list was empty
+    if(not found):
+       msg = "No existing fileblock matching %s" % (str(lfnList))
+       self._warn(msg)
+
+
+
+  def syncEntries(self, store, dir = "/", **kwd):
+    """
+    Brings the specified local mirror of FileBlock replica locations (a
+    DlsReplicaStore object) up to date with the PhEDEx data service, and
+    returns the list of DlsEntry objects received from it.
+
+    The dir argument and the showProd, showCAF, subscribed and custodial
+    flags (**kwd) select the FileBlocks and replicas to mirror, as for the
+    dumpEntries method.
+
+    If the store was already synced (with the same DLS server, pattern
+    and flags), only the replicas updated since its last sync are asked
+    for (using the updated_since argument of the data service), and they
+    are merged into the stored entries (see DlsReplicaStore.update). Since
+    the last sync time is taken from the local clock, the query goes back
+    overlap (**kwd) seconds more, to allow for clock skew and replicas
+    being updated while the previous query was served.
+
+    An incremental query cannot see the replicas that were removed (or
+    that became incomplete). Thus, a full resync (querying for all the
+    replicas and replacing the whole store contents) is done instead if
+    the store was never synced, if the pattern or flags differ, if the
+    last full resync is older than fullPeriod (**kwd) seconds, if the
+    incremental query fails, or if full (**kwd) is set to True. After a
+    full resync, the lastSync and lastFullSync members of the store are equal.
+
+    If the store has an associated file, it is saved after the sync. Errors
+    saving it are just warned about (the next sync will just ask for the
+    same replicas again).
+
+    @exception DlsApiError: if the (full) query fails. The store is not modified.
+
+    @param store: the local mirror, as a DlsReplicaStore object
+    @param dir: the FileBlock name pattern to mirror (with '%' or '*' as wildcards)
+    @param kwd:
+       - full: Boolean (default False) for forcing a full resync
+       - overlap: seconds to go back from the last sync time (default DLS_PHEDEX_SYNC_OVERLAP)
+       - fullPeriod: maximum age (s) of the last full resync (default DLS_PHEDEX_SYNC_FULL_PERIOD)
+       - showProd, showCAF, subscribed, custodial: Booleans (default False), as for dumpEntries
+
+    @return: the list of received DlsEntry objects (all of them, for a full resync)
+    """
+
+    # Keywords
+    full = False
+    if(kwd.has_key("full")):   full = kwd.get("full")
+    overlap = DLS_PHEDEX_SYNC_OVERLAP
+    if(kwd.has_key("overlap")):   overlap = kwd.get("overlap")
+    fullPeriod = DLS_PHEDEX_SYNC_FULL_PERIOD
+    if(kwd.has_key("fullPeriod")):   fullPeriod = kwd.get("fullPeriod")
+
+    subscribed = False
+    if(kwd.has_key("subscribed")):   subscribed = kwd.get("subscribed")
+    custodial = False
+    if(kwd.has_key("custodial")):   custodial = kwd.get("custodial")
+
+    showProd = False
+    if(kwd.has_key("showProd")):   showProd = kwd.get("showProd")
+    showCAF= False
+    if(kwd.has_key("showCAF")):   showCAF = kwd.get("showCAF")
+
+    if(isinstance(dir, DlsFileBlock)):
+       dir = dir.name
+    query = (self.server, dir, subscribed, custodial, showProd, showCAF)
+    now = time.time()
+
+    # Decide whether an incremental sync is possible
+    if full:
+       reason = "requested"
+    elif (store.lastSync == None) or (store.lastFullSync == None):
+       reason = "no previous sync"
+    elif store.query != query:
+       reason = "different query"
+    elif (now - store.lastFullSync) > fullPeriod:
+       reason = "last full resync is too old"
+    else:
+       reason = None
+       since = store.lastSync - overlap
+       self._debug("Incremental sync of %s (replicas updated since %d)" % (dir, since))
+       try:
+          eList = self._syncQuery(dir, subscribed, custodial, showProd, showCAF, since)
+          store.update(eList)
+          store.lastSync = now
+          self._saveStore(store)
+          return eList
+       except DlsApiError, inst:
+          self._warn("Incremental sync failed (%s). Doing a full resync" % inst)
+          reason = "incremental sync failed"
+
+    # Full resync
+    self._debug("Full resync of %s (%s)" % (dir, reason))
+    eList = self._syncQuery(dir, subscribed, custodial, showProd, showCAF, None)
+    store.replaceAll(eList)
+    store.query = query
+    store.lastSync = store.lastFullSync = now
+    self._saveStore(store)
+    return eList
+
+
+
   def startSession(self):
     """
     Implementation of the dlsApi.DlsApi.startSession method.
@@ -745,9 +1235,13 @@ class DlsPhedexApi(dlsApi.DlsApi):
     
     Implementation specific remarks:
 
-    Since PhEDEx does not support sessions, this method does nothing.
+    Since PhEDEx does not support sessions, this method just closes the
+    idle connections kept by this object (if any). New connections will be 
+    opened when needed by later queries.
     """
-    self._debug("Ending session with %s (no action)" % (self.server))
+    self._debug("Ending session with %s (closing idle connections)" % (self.server))
+    if self._connPool:
+       self._connPool.closeAll()
   
  
   def startTrans(self):
@@ -825,6 +1319,27 @@ class DlsPhedexApi(dlsApi.DlsApi):
     self.locsPerQuery = nlocs
 
  
+  def setQueryThreads(self, nthreads):
+    """
+    Sets the number of bulk queries that may be run concurrently by each
+    getLocations, getFileBlocks, listFileBlocks or getFileLocs call (when
+    the list of arguments is split in several queries). The results are
+    anyway returned in the same order as the arguments. Use 1 for serial
+    querying.
+
+    Notice that, regardless of this value, no more than 
+    DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT queries are sent at the same time
+    to the same server from this process.
+    
+    @param nthreads: number of bulk queries to run concurrently
+
+    @exception: raises ValueError, if nthreads is not a positive integer
+    """
+    if not ((type(nthreads) == int) and (nthreads > 0)):
+       raise DlsValueError("Argument of setQueryThreads must be a positive integer")
+    self.queryThreads = nthreads
+
+ 
   def addUserAgentClient(self, client, version):
     """
     Adds a client/version pair to the list that will be included in the 
@@ -868,6 +1383,252 @@ class DlsPhedexApi(dlsApi.DlsApi):
     return  {'User-Agent': result}
 
 
+  def _bulkQuery(self, urlbase, multiList, arglist2, parse, excp_msg, warn_msg, \
+                 errorTolerant=False):
+    """
+    Sends a query to urlbase for each of the lists of URL arguments in 
+    multiList (adding the common arguments of arglist2 to each of them), 
+    and parses each reply with the specified parse method (one of the
+    DlsXmlParser methods). Up to self.queryThreads queries are run 
+    concurrently.
+
+    Returns the concatenation of the parsed results, in multiList order.
+
+    Errors are treated per query, in multiList order, as done by _mapException.
+    That is, if errorTolerant==False, the first failed query raises the
+    corresponding DlsApiError (and no new queries are started after the 
+    failure), while if errorTolerant==True, the failed queries are just 
+    warned about and skipped.
+
+    @param urlbase: URL of the data service API call
+    @param multiList: list of lists of URL arguments (as returned by _toMultiList)
+    @param arglist2: list of URL arguments common to all queries
+    @param parse: method turning a reply (file object) into a list of results
+    @param excp_msg: the message passed to the exception, if raised
+    @param warn_msg: the message to print as warning, if errorTolerant
+    @param errorTolerant: boolean to control operation
+
+    @return: a list with the parsed results of all the queries
+    """
+
+    def query(arglist):
+       req = Request(urlbase, urlencode(arglist + arglist2), self._headers())
+       url = self._openUrl(req)
+       return parse(url)
+
+    argLists = [x for x in multiList if x]
+    sem = getEndpointSemaphore(urlparse(self.server)[1], DLS_PHEDEX_MAX_THREADS_PER_ENDPOINT)
+    self._debug("Running %d bulk queries (up to %d concurrently)" % \
+                (len(argLists), self.queryThreads))
+    results = runInPool(query, argLists, self.queryThreads, \
+                        stopOnError = (not errorTolerant), semaphore = sem)
+
+    total = []
+    for res in results:
+      # Never started (after a failure)
+      if res == None: continue
+      partList, inst = res
+      if inst != None:
+         self._mapException(inst, excp_msg, warn_msg, errorTolerant)
+      else:
+         total += partList
+
+    return total
+
+
+  def _headers(self):
+    """
+    Returns the HTTP headers to be used in the queries to the PhEDEx data
+    service (as a dict): the UserAgent (see _userAgent) and, if compression
+    is on, the accepted content encodings.
+    """
+    headers = self._userAgent()
+    if self.compression:
+       headers['Accept-Encoding'] = 'gzip, deflate'
+    return headers
+
+
+  def _openUrl(self, req):
+    """
+    Sends the specified request (urllib2.Request object) to the PhEDEx data
+    service and returns the reply, as a file-like object. If the reply is
+    compressed, the returned object decompresses it as it is read.
+    """
+    url = self._opener.open(req)
+    encoding = url.info().get('Content-Encoding', '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+       fullUrl = req.get_full_url()
+       def report(inBytes, outBytes):
+          self._debug("Read %d bytes (%s), %d bytes uncompressed, from %s" % \
+                      (inBytes, encoding, outBytes, fullUrl))
+       url = DlsDecompressingReader(url, report)
+    return url
+
+
+  def _formatUrl(self, server, dataFormat):
+    """
+    Returns the specified PhEDEx data service endpoint modified so that it 
+    returns replies in the specified format. The endpoint should be of the
+    form ".../<format>/<instance>", otherwise it is returned untouched for
+    the XML format, and a DlsConfigError is raised for other formats.
+    """
+    parts = server.split('/')
+    if (len(parts) > 2) and (parts[-2] in (DLS_PHEDEX_FORMAT_XML, DLS_PHEDEX_FORMAT_JSON)):
+       parts[-2] = dataFormat
+       return '/'.join(parts)
+
+    if dataFormat != DLS_PHEDEX_FORMAT_XML:
+       msg = "Cannot use format %s with PhEDEx endpoint %s. " % (dataFormat, server)
+       msg += "Expected an endpoint of the form '.../datasvc/xml/<instance>'"
+       raise DlsConfigError(msg)
+    return server
+
+
+  def _locationsQuery(self, fileBlockList, subscribed, custodial, showProd, showCAF, \
+                      updatedSince=None, createdSince=None):
+    """
+    Returns the [urlbase, multiList, arglist2, lfnList] elements to query for
+    the locations of the specified FileBlocks (as used by getLocations and
+    iterEntries, see _bulkQuery for their meaning; lfnList holds all the
+    query arguments, for messages). If updatedSince or createdSince (unix
+    timestamps) are specified, only the replicas updated or created since
+    then are asked for.
+    """
+    # Make sure the argument is a list
+    if (isinstance(fileBlockList, list)):
+       theList = fileBlockList 
+    else:
+       theList = [fileBlockList]
+
+    # Loop on the entries to build a list of blocks to ask for
+    lfnList = []
+    for fB in theList:
+       # Check what was passed (DlsFileBlock or string)
+       if(isinstance(fB, DlsFileBlock)):
+         lfn = fB.name
+       else:
+         lfn = fB
+
+       # If '/' or '*' or '%' is given, we want all blocks back
+       if (lfn=='/') or (lfn == '*') or (lfn == '%'):
+          lfn = '/%'
+
+       lfnList.append(('block', lfn)) 
+       
+    multiList = self._toMultiList(lfnList, DLS_PHEDEX_MAX_BLOCKS_PER_QUERY)
+    urlbase = self.server + '/blockReplicas'
+
+    
+    msg = "Number of arguments per bulk query: "
+    for i in multiList: msg += str(len(i)) + ' '
+    self._debug(msg)
+
+    arglist2 = []
+    # flags that could be added: incomplete
+    arglist2.append(('complete', 'y'))
+    if subscribed:
+       arglist2 += [('subscribed','y')]
+    if custodial:
+       arglist2 += [('custodial','y')]
+    if updatedSince != None:
+       arglist2 += [('updated_since', int(updatedSince))]
+    if createdSince != None:
+       arglist2 += [('created_since', int(createdSince))]
+    if not (showProd and showCAF):
+       arglist2 += [('op','node:and')]
+    if not showProd:
+       arglist2 += [('node','!T0*'), ('node','!T1*')]
+    if not showCAF:
+       arglist2 += [('node','!T2_CH_CAF')]
+    self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
+
+    return [urlbase, multiList, arglist2, lfnList]
+
+
+  def _syncQuery(self, dir, subscribed, custodial, showProd, showCAF, updatedSince):
+    """
+    Returns the entries (list of DlsEntry objects) matching the specified
+    FileBlock pattern, with the replicas updated since updatedSince (or all
+    of them, if None), as used by syncEntries. Unlike getLocations, an
+    empty result is not warned about, and any failed query raises the
+    corresponding DlsApiError.
+    """
+    urlbase, multiList, arglist2, lfnList = self._locationsQuery(dir, subscribed, \
+                                                custodial, showProd, showCAF, updatedSince)
+    msg = "Error retrieving locations for sync of %s" % (str(lfnList))
+    return self._bulkQuery(urlbase, multiList, arglist2, self.parser.xmlToEntries, \
+                           msg, msg, False)
+
+
+  def _saveStore(self, store):
+    """
+    Saves the specified DlsReplicaStore, if it has an associated file.
+    Errors are just warned about.
+    """
+    if not store.fname: return
+    try:
+       store.save()
+    except (IOError, OSError), inst:
+       self._warn("Could not save replica store %s: %s" % (store.fname, inst))
+
+
+  def _fileLocsQuery(self, fileBlockList, subscribed, custodial, showProd, showCAF):
+    """
+    Returns the [urlbase, multiList, arglist2] elements to query for the
+    file replicas of the specified FileBlocks (as used by getFileLocs and
+    iterFileLocs, see _bulkQuery for their meaning).
+    """
+    # Make sure the argument is a list
+    if (isinstance(fileBlockList, list)):
+       theList = fileBlockList 
+    else:
+       theList = [fileBlockList]
+
+    # Loop on the entries to build a list of blocks to ask for
+    lfnList = []
+    for fB in theList:
+       # Check what was passed (DlsFileBlock or string)
+       if(isinstance(fB, DlsFileBlock)):
+         lfn = fB.name
+       else:
+         lfn = fB
+
+       # Check that the passed FileBlock is not a pattern
+       if (lfn.find('*') != -1) or (lfn.find('%') != -1):
+         msg = "FileBlock patterns (containing '*' or '%%' wildcards) are not acceptable: "+lfn
+         raise DlsInvalidBlockName(msg)
+         
+       if lfn: lfnList.append(('block', lfn)) 
+       
+    if not lfnList: 
+       msg = "Error querying for file replicas. A FileBlock must be specified"
+       raise DlsArgumentError(msg)
+
+    multiList = self._toMultiList(lfnList, DLS_PHEDEX_MAX_BLOCKS_PER_FILE_QUERY)
+    urlbase = self.server + '/fileReplicas'
+
+    msg = "Number of arguments per bulk query: "
+    for i in multiList: msg += str(len(i)) + ' '
+    self._debug(msg)
+
+    arglist2 = []
+    # flags that could be added: incomplete, updated_since, created_since
+    arglist2.append(('dist_complete', 'y'))
+    if subscribed:
+       arglist2 += [('subscribed','y')]
+    if custodial:
+       arglist2 += [('custodial','y')]
+    if not (showProd and showCAF):
+       arglist2 += [('op','node:and')]
+    if not showProd:
+       arglist2 += [('node','!T0*'), ('node','!T1*')]
+    if not showCAF:
+       arglist2 += [('node','!T2_CH_CAF')]
+    self._debug("Using PhEDex xml url: " + urlbase + ' ' + str(arglist2))
+
+    return [urlbase, multiList, arglist2]
+
+
   def _toMultiList(self, list, num):
     """
     Gets a list of elements and returns a list of lists. These are the result
@@ -936,7 +1697,7 @@ class DlsPhedexApi(dlsApi.DlsApi):
           urlargs.append(('updated_since', kwd.get("updated_since")))
        
        if(kwd.has_key("created_since")):
-          urlargs.append(('created_since'+kwd.get("created_since")))
+          urlargs.append(('created_since', kwd.get("created_since")))
 
        showProd = (kwd.has_key("showProd") and kwd.get("showProd"))
        showCAF = (kwd.has_key("showCAF") and kwd.get("showCAF"))
@@ -971,7 +1732,7 @@ class DlsPhedexApi(dlsApi.DlsApi):
           urlargs.append(('updated_since', kwd.get("updated_since")))
        
        if(kwd.has_key("created_since")):
-          urlargs.append(('created_since'+kwd.get("created_since")))
+          urlargs.append(('created_since', kwd.get("created_since")))
  
        showProd = (kwd.has_key("showProd") and kwd.get("showProd"))
        showCAF = (kwd.has_key("showCAF") and kwd.get("showCAF"))
@@ -1022,7 +1783,9 @@ class DlsPhedexApi(dlsApi.DlsApi):
        # Otherwise, include all information
        excp_msg = excp_msg + '. Caught: %s' % (caught_msg)
       
-       if (isinstance(inst, SAXException) or (isinstance(inst, SAXParseException))):
+       # (ValueError is what the json module raises on bad input)
+       if (isinstance(inst, SAXException) or (isinstance(inst, SAXParseException)) \
+           or (isinstance(inst, ExpatError)) or (isinstance(inst, ValueError))):
          excp_msg = "Error parsing server reply. " + excp_msg
          raise DlsErrorWithServer(excp_msg)
          
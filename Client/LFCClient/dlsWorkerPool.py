@@ -0,0 +1,130 @@
+#
+# $Id$
+#
+# DLS Client. $Name: DLS_1_1_3 $.
+# Antonio Delgado Peris. CIEMAT. CMS.
+#
+
+"""
+ This module implements a simple bounded pool of worker threads, used by
+ some DLS API implementations to run independent queries to the back-end
+ concurrently. All methods and classes here included are for internal
+ DLS use only (no public interface).
+"""
+
+#########################################
+# Imports
+#########################################
+import threading
+from Queue import Queue, Empty
+
+
+#########################################
+# Module globals
+#########################################
+_semLock = threading.Lock()
+_endpointSems = {}
+
+
+#########################################
+# Functions
+#########################################
+
+def getEndpointSemaphore(endpoint, limit):
+  """
+  Returns the process-wide semaphore that bounds the number of concurrent
+  requests to the specified endpoint. The semaphore is created (with the
+  specified limit) the first time it is asked for, and shared afterwards
+  by all callers using the same endpoint (the limit is not changed then).
+
+  @param endpoint: a string identifying the server (e.g. "hname:port")
+  @param limit: maximum number of concurrent requests to that server
+
+  @return: a threading.BoundedSemaphore object
+  """
+  _semLock.acquire()
+  try:
+    if not _endpointSems.has_key(endpoint):
+       _endpointSems[endpoint] = threading.BoundedSemaphore(max(1, limit))
+    return _endpointSems[endpoint]
+  finally:
+    _semLock.release()
+
+
+def runInPool(func, argList, nThreads, stopOnError = False, semaphore = None):
+  """
+  Calls func(arg) for each arg in argList, using not more than nThreads
+  worker threads at a time, and returns a list with the outcome of each
+  call, in the same order as argList. Each element is a pair [result,
+  exception], where exception is None if the call succeeded, or the
+  caught Exception object otherwise (and then result is None).
+
+  If stopOnError is True, no new call is started after one of them has
+  failed, and the elements for the calls that were never started are set
+  to None. Since calls are started in order, all of these come after a
+  failed one in the returned list.
+
+  If a semaphore is specified, it is held during each of the calls (this
+  can be used to bound the load on a given server from all the pools in
+  the process, see getEndpointSemaphore).
+
+  With nThreads <= 1 (or a single argument) everything is run serially in
+  the calling thread.
+
+  @param func: callable taking a single argument
+  @param argList: list of arguments for func
+  @param nThreads: maximum number of concurrent calls
+  @param stopOnError: boolean (default False) for not starting calls after a failure
+  @param semaphore: threading semaphore to hold during each call (or None)
+
+  @return: list of [result, exception] pairs (or None), in argList order
+  """
+  results = [None] * len(argList)
+
+  if (nThreads <= 1) or (len(argList) <= 1):
+     for i in xrange(len(argList)):
+        results[i] = _call(func, argList[i], semaphore)
+        if stopOnError and (results[i][1] is not None):
+           break
+     return results
+
+  queue = Queue()
+  for i in xrange(len(argList)):
+     queue.put(i)
+  stop = threading.Event()
+
+  def worker():
+     while not stop.isSet():
+        try:
+           i = queue.get_nowait()
+        except Empty:
+           return
+        results[i] = _call(func, argList[i], semaphore)
+        if stopOnError and (results[i][1] is not None):
+           stop.set()
+
+  threads = []
+  for i in xrange(min(nThreads, len(argList))):
+     t = threading.Thread(target = worker)
+     t.setDaemon(True)
+     threads.append(t)
+     t.start()
+  for t in threads:
+     t.join()
+
+  return results
+
+
+#########################################
+# Some local utilities
+#########################################
+
+def _call(func, arg, semaphore):
+  if semaphore: semaphore.acquire()
+  try:
+     try:
+        return [func(arg), None]
+     except Exception, inst:
+        return [None, inst]
+  finally:
+     if semaphore: semaphore.release()
@@ -16,14 +16,35 @@ public interface).
 # Imports
 ############
 from xml.sax import ContentHandler, make_parser
+from xml.sax.saxutils import prepare_input_source
+from xml.parsers import expat
 from dlsDataObjects import DlsLocation, DlsFileBlock, DlsEntry, DlsDataObjectError, DlsFile
-from dlsApiExceptions import DlsErrorWithServer
+from dlsDataObjects import internHost, internLocation
+from dlsApiExceptions import DlsErrorWithServer, DlsValueError
+
+
+
+############################################
+# Module globals
+############################################
+
+# Parser back-ends
+DLS_XML_SAX = "sax"
+DLS_XML_EXPAT = "expat"
+
+# Size of the chunks read from the XML source (when not left to xml.sax)
+DLS_XML_EXPAT_BUFFER = 65536
 
 
 
 ############################################
 # Helper classes
 # SAX handlers
+#
+# The handlers are also used by the expat
+# back-end, which passes the attributes
+# as a plain dict (instead of a SAX
+# Attributes object)
 ############################################
 
 class EntryPageHandler(ContentHandler):
@@ -47,21 +68,15 @@ class EntryPageHandler(ContentHandler):
     elif name == "block":
       self.locs = []
       self.ses = []
-      self.fbAttrs = {}
-      for attr in attributes.keys():
-        if (attr == "name"): self.fbName = attributes["name"]
-        else:
-           self.fbAttrs[attr] = attributes[attr]
+      self.fbAttrs = dict(attributes)
+      self.fbName = self.fbAttrs.pop("name", None)
          
     elif name == "replica":
-      self.seAttrs = {}
-      for attr in attributes.keys():
-        if (attr == "se"): self.seName = attributes["se"]
-        else:
-           self.seAttrs[attr] = attributes[attr]
+      self.seAttrs = dict(attributes)
+      self.seName = self.seAttrs.pop("se", None)
       if self.seName and (self.seName not in self.ses):
          self.ses.append(self.seName)
-         self.locs.append(DlsLocation(self.seName, self.seAttrs))
+         self.locs.append(DlsLocation(internHost(self.seName), self.seAttrs))
 
   def characters(self, contents):
     if self.inError:
@@ -93,10 +108,8 @@ class BlockPageHandler(ContentHandler):
       self.phedexReply = True
       
     elif name == "block":
-      for attr in attributes.keys():
-        if (attr == "name"): self.fbName = attributes["name"]
-        else:
-           self.fbAttrs[attr] = attributes[attr]
+      self.fbAttrs = dict(attributes)
+      self.fbName = self.fbAttrs.pop("name", None)
  
   def characters(self, contents):
     if self.inError:
@@ -128,12 +141,8 @@ class NodePageHandler(ContentHandler):
       self.phedexReply = True
       
     elif name == "node":
-#      self.host = attributes["se"]
-      self.seAttrs = {}
-      for attr in attributes.keys():
-        if (attr == "se"): self.host = attributes["se"]
-        else:
-           self.seAttrs[attr] = attributes[attr]
+      self.seAttrs = dict(attributes)
+      self.host = self.seAttrs.pop("se", self.host)
  
   def characters(self, contents):
     if self.inError:
@@ -147,12 +156,13 @@ class NodePageHandler(ContentHandler):
     elif name == "node":
 #      if self.host and (self.host not in self.list):
 #            self.list.append(self.host)
-       self.list.append(DlsLocation(self.host, self.seAttrs))
+       self.list.append(DlsLocation(internHost(self.host), self.seAttrs))
 
 
 class FilePageHandler(ContentHandler):
 
-  def __init__(self):
+  def __init__(self, shareLocations = False):
+    self.shareLocations = shareLocations
     self.phedexReply = False
     self.inError = False
     self.error = ""
@@ -168,11 +178,9 @@ class FilePageHandler(ContentHandler):
       self.phedexReply = True
       
     elif name == "block":
-      self.fbAttrs = {}
       self.files = {}
-      for attr in attributes.keys():
-        if (attr == "name"): self.fbName = attributes["name"]
-        else:                self.fbAttrs[attr] = attributes[attr]
+      self.fbAttrs = dict(attributes)
+      self.fbName = self.fbAttrs.pop("name", None)
 
     elif name == "file":
       self.ses = []
@@ -183,7 +191,10 @@ class FilePageHandler(ContentHandler):
       self.seName = attributes["se"]
       if self.seName and (self.seName not in self.ses):
          self.ses.append(self.seName)
-         self.locs.append(DlsLocation(self.seName))
+         if self.shareLocations:
+            self.locs.append(internLocation(self.seName))
+         else:
+            self.locs.append(DlsLocation(internHost(self.seName)))
 #      self.ses.append(self.seName)
  
 
@@ -204,6 +215,48 @@ class FilePageHandler(ContentHandler):
        self.mapping.append([DlsFileBlock(self.fbName, self.fbAttrs), self.files])
 
 
+class FileStreamHandler(FilePageHandler):
+  """
+  Like FilePageHandler, but instead of building a dict of files per block,
+  it queues a (DlsFileBlock, DlsFile, [DlsLocation]) tuple in the pending
+  list as soon as each file has been parsed (the consumer should empty
+  the list as it goes).
+  """
+
+  def __init__(self, shareLocations = False):
+    FilePageHandler.__init__(self, shareLocations)
+    self.pending = []
+
+  def startElement(self, name, attributes):
+    FilePageHandler.startElement(self, name, attributes)
+    if name == "block":
+      self.fileBlock = DlsFileBlock(self.fbName, self.fbAttrs)
+
+  def endElement(self, name):
+    if name == "file":
+      self.pending.append((self.fileBlock, DlsFile(self.fileName), self.locs))
+    elif name != "block":
+      FilePageHandler.endElement(self, name)
+
+
+class EntryStreamHandler(EntryPageHandler):
+  """
+  Like EntryPageHandler, but the DlsEntry objects are queued in the pending
+  list as soon as each block has been parsed (the consumer should empty
+  the list as it goes).
+  """
+
+  def __init__(self):
+    EntryPageHandler.__init__(self)
+    self.pending = []
+
+  def endElement(self, name):
+    if name == "block":
+      self.pending.append(DlsEntry(DlsFileBlock(self.fbName, self.fbAttrs), self.locs))
+    else:
+      EntryPageHandler.endElement(self, name)
+
+
 # This would be the OLD FilePageHandler (without duplicates filtering) with attribute support 
 # But for now we're just getting name and host (below), as should be faster
 
@@ -243,6 +296,37 @@ class FilePageHandler(ContentHandler):
 ############################################
 
 class DlsXmlParser:
+  """
+  Parser of XML replies of the PhEDEx data service. Two back-ends are
+  supported, producing the same results:
+    - DLS_XML_SAX: the standard xml.sax machinery
+    - DLS_XML_EXPAT: the handlers are called directly from the pyexpat 
+      parser, avoiding the per-element xml.sax dispatch overhead 
+
+  In both cases, the XML source is parsed as a stream (in chunks), and 
+  only the resulting objects are kept in memory.
+
+  The SE names of the returned locations are interned (see the 
+  dlsDataObjects.internHost function), so that they share a single string
+  per SE. If shareLocations is True, the (attribute-less) locations of
+  the file replicas are also shared, read-only, DlsLocation objects (see
+  dlsDataObjects.internLocation).
+  """
+
+  def __init__(self, backend = DLS_XML_EXPAT, shareLocations = False):
+    """
+    Constructor of the class.
+
+    @param backend: the parser back-end to use: DLS_XML_EXPAT (default) or DLS_XML_SAX
+    @param shareLocations: boolean (default False) for sharing file replica locations
+    """
+    if backend not in (DLS_XML_SAX, DLS_XML_EXPAT):
+      msg = "Specified XML parser back-end (%s) is not one of the admitted values: %s" % \
+            (backend, [DLS_XML_SAX, DLS_XML_EXPAT])
+      raise DlsValueError(msg)
+    self.backend = backend
+    self.shareLocations = shareLocations
+
 
   def xmlToEntries(self, xmlSource):
     """
@@ -254,15 +338,33 @@ class DlsXmlParser:
 
     @return: a list of DlsEntry objects with FileBlock and locations information
     """
-    parser = make_parser()
     handler = EntryPageHandler()
-    parser.setContentHandler(handler)
-    parser.parse(xmlSource)
+    self._parse(xmlSource, handler)
     if not handler.phedexReply:
       raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
     return handler.mapping
     
 
+  def iterEntries(self, xmlSource):
+    """
+    Generator version of xmlToEntries. Instead of returning the whole list
+    at once, it yields each DlsEntry object as soon as its block has been
+    parsed from the specified XML source (in PhEDEx's blockReplicas format).
+
+    @param xmlSource: XML source file in URL format (e.g. http://...) or file object
+
+    @return: an iterator on DlsEntry objects with FileBlock and locations information
+    """
+    handler = EntryStreamHandler()
+    for dummy in self._iterParse(xmlSource, handler):
+      pending = handler.pending
+      handler.pending = []
+      for item in pending:
+        yield item
+    if not handler.phedexReply:
+      raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
+
+
   def xmlToBlocks(self, xmlSource):
     """
     Returns a list of DlsFileBlock objects holding the FileBlock information
@@ -272,10 +374,8 @@ class DlsXmlParser:
 
     @return: a list of DlsFileBlock objects with FileBlock information
     """
-    parser = make_parser()
     handler = BlockPageHandler()
-    parser.setContentHandler(handler)
-    parser.parse(xmlSource)
+    self._parse(xmlSource, handler)
     if not handler.phedexReply:
       raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
     return handler.mapping
@@ -290,10 +390,8 @@ class DlsXmlParser:
 
     @return: a list of DlsLocation objects with location information
     """
-    parser = make_parser()
     handler = NodePageHandler()
-    parser.setContentHandler(handler)
-    parser.parse(xmlSource)
+    self._parse(xmlSource, handler)
     if not handler.phedexReply:
       raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
 #    hostList = handler.list
@@ -312,10 +410,83 @@ class DlsXmlParser:
 
     @return: a list of dicts associating DlsFile objects and locations 
     """
-    parser = make_parser()
-    handler = FilePageHandler()
-    parser.setContentHandler(handler)
-    parser.parse(xmlSource)
+    handler = FilePageHandler(self.shareLocations)
+    self._parse(xmlSource, handler)
     if not handler.phedexReply:
       raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
     return handler.mapping
+
+
+  def iterFileLocs(self, xmlSource):
+    """
+    Generator version of xmlToFileLocs. Instead of returning the whole list
+    at once, it yields a (DlsFileBlock, DlsFile, [DlsLocation]) tuple for each
+    file in the specified XML source (in PhEDEx's "fileReplicas" format), as
+    soon as it has been parsed. The files of a FileBlock share the same
+    DlsFileBlock object. FileBlocks with no files produce no tuples.
+
+    @param xmlSource: XML source file in URL format (e.g. http://...) or file object
+
+    @return: an iterator on (DlsFileBlock, DlsFile, list of DlsLocation) tuples
+    """
+    handler = FileStreamHandler(self.shareLocations)
+    for dummy in self._iterParse(xmlSource, handler):
+      pending = handler.pending
+      handler.pending = []
+      for item in pending:
+        yield item
+    if not handler.phedexReply:
+      raise DlsErrorWithServer("No valid server response (no phedex entry). Check DLS endpoint")
+
+
+  def _parse(self, xmlSource, handler):
+    """
+    Parses the specified XML source (URL or file object) with the 
+    selected back-end, feeding the specified handler.
+    """
+    if self.backend == DLS_XML_SAX:
+      parser = make_parser()
+      parser.setContentHandler(handler)
+      parser.parse(xmlSource)
+
+    else:
+      stream = prepare_input_source(xmlSource).getByteStream()
+      parser = expat.ParserCreate()
+      parser.buffer_text = True
+      parser.buffer_size = DLS_XML_EXPAT_BUFFER
+      parser.StartElementHandler = handler.startElement
+      parser.EndElementHandler = handler.endElement
+      parser.CharacterDataHandler = handler.characters
+      parser.ParseFile(stream)
+
+
+  def _iterParse(self, xmlSource, handler):
+    """
+    Generator that parses the specified XML source (URL or file object) 
+    incrementally with the selected back-end, feeding the specified handler.
+    It yields (None) after each chunk of the source has been processed.
+    """
+    stream = prepare_input_source(xmlSource).getByteStream()
+
+    if self.backend == DLS_XML_SAX:
+      parser = make_parser()
+      parser.setContentHandler(handler)
+      feed = parser.feed
+      close = parser.close
+
+    else:
+      parser = expat.ParserCreate()
+      parser.buffer_text = True
+      parser.StartElementHandler = handler.startElement
+      parser.EndElementHandler = handler.endElement
+      parser.CharacterDataHandler = handler.characters
+      feed = lambda data: parser.Parse(data, False)
+      close = lambda: parser.Parse('', True)
+
+    data = stream.read(DLS_XML_EXPAT_BUFFER)
+    while data:
+      feed(data)
+      yield None
+      data = stream.read(DLS_XML_EXPAT_BUFFER)
+    close()
+    yield None
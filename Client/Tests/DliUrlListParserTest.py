@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Light DLI reply parser (dliClient_types.UrlListParser) tests
+"""
+
+import unittest
+
+from dliClient_types import UrlListParser
+
+
+ENVELOPE = '''<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"
+ xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/"
+ xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+ xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+ xmlns:ns1="urn:DataLocationInterface"><SOAP-ENV:Body
+ SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">%s</SOAP-ENV:Body></SOAP-ENV:Envelope>'''
+
+PLAIN = ENVELOPE % '''<ns1:listReplicasResponse><urlList xsi:type="SOAP-ENC:Array"
+ SOAP-ENC:arrayType="xsd:string[2]"><item xsi:type="xsd:string">srm://se1.org/a</item>
+<item xsi:type="xsd:string"> srm://se2.org:8443/b </item></urlList></ns1:listReplicasResponse>'''
+
+ESCAPED = ENVELOPE % '''<ns1:listReplicasResponse><urlList xsi:type="SOAP-ENC:Array"
+ SOAP-ENC:arrayType="xsd:string[1]"><item>srm://se1.org/a&amp;b&lt;c&gt;</item><item><![CDATA[srm://se2.org/d&e]]></item>
+</urlList></ns1:listReplicasResponse>'''
+
+EMPTY = ENVELOPE % '''<ns1:listReplicasResponse><urlList xsi:type="SOAP-ENC:Array"
+ SOAP-ENC:arrayType="xsd:string[0]"/></ns1:listReplicasResponse>'''
+
+FAULT = ENVELOPE % '''<SOAP-ENV:Fault><faultcode>SOAP-ENV:Client</faultcode>
+<faultstring>NoURLFound</faultstring></SOAP-ENV:Fault>'''
+
+MULTIREF_LIST = ENVELOPE % '''<ns1:listReplicasResponse><urlList href="#id1"/></ns1:listReplicasResponse>
+<multiRef id="id1" xsi:type="SOAP-ENC:Array" SOAP-ENC:arrayType="xsd:string[1]"><item>srm://se1.org/a</item></multiRef>'''
+
+MULTIREF_ITEM = ENVELOPE % '''<ns1:listReplicasResponse><urlList xsi:type="SOAP-ENC:Array"
+ SOAP-ENC:arrayType="xsd:string[1]"><item href="#id1"/></urlList></ns1:listReplicasResponse>
+<multiRef id="id1" xsi:type="xsd:string">srm://se1.org/a</multiRef>'''
+
+NIL_LIST = ENVELOPE % '''<ns1:listReplicasResponse><urlList xsi:nil="true"/></ns1:listReplicasResponse>'''
+
+
+class DliUrlListParserTest(unittest.TestCase):
+    """
+    TestCase for the UrlListParser class (dliClient_types module)
+    """
+
+    def setUp(self):
+        """
+        Code to execute to in preparation for the test
+        """
+        self.parser = UrlListParser()
+
+    def testA_Plain(self):
+        urls = self.parser.parse(PLAIN)
+        self.assertEqual(urls, ["srm://se1.org/a", "srm://se2.org:8443/b"])
+        self.assertEqual([type(x) for x in urls], [str, str])
+
+    def testB_Escaped(self):
+        urls = self.parser.parse(ESCAPED)
+        self.assertEqual(urls, ["srm://se1.org/a&b<c>", "srm://se2.org/d&e"])
+
+    def testC_Empty(self):
+        self.assertEqual(self.parser.parse(EMPTY), [])
+
+    def testD_FaultLeftToZSI(self):
+        self.assertEqual(self.parser.parse(FAULT), None)
+
+    def testE_MultiRefLeftToZSI(self):
+        self.assertEqual(self.parser.parse(MULTIREF_LIST), None)
+        self.assertEqual(self.parser.parse(MULTIREF_ITEM), None)
+        self.assertEqual(self.parser.parse(NIL_LIST), None)
+
+    def testF_MalformedLeftToZSI(self):
+        self.assertEqual(self.parser.parse(PLAIN[:-20]), None)
+        self.assertEqual(self.parser.parse(ENVELOPE % ''), None)
+
+    def testG_ParserReuse(self):
+        self.assertEqual(self.parser.parse(FAULT), None)
+        self.assertEqual(self.parser.parse(PLAIN), ["srm://se1.org/a", "srm://se2.org:8443/b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+"""
+DLS cache layer (dlsCacheApi) tests
+"""
+
+import unittest
+import time, os, tempfile, shutil
+
+import dlsApi
+from dlsCacheApi import DlsCacheApi
+from dlsDataObjects import *
+from dlsApiExceptions import DlsApiError
+
+
+class FakeApi(dlsApi.DlsApi):
+    """
+    In-memory DLS back-end, counting the queried FileBlocks
+    """
+
+    def __init__(self):
+        dlsApi.DlsApi.__init__(self, "fake.host/dls", dlsApi.DLS_VERB_NONE)
+        self.db = {}
+        self.queried = []
+
+    def add(self, dlsEntryList, **kwd):
+        for entry in dlsEntryList:
+            locs = self.db.setdefault(entry.fileBlock.name, [])
+            for loc in entry.locations:
+                if loc.host not in locs: locs.append(loc.host)
+
+    def delete(self, dlsEntryList, **kwd):
+        for entry in dlsEntryList:
+            locs = self.db.get(entry.fileBlock.name, [])
+            for loc in entry.locations:
+                if loc.host in locs: locs.remove(loc.host)
+
+    def renameFileBlock(self, oldFileBlock, newFileBlock, **kwd):
+        self.db[newFileBlock] = self.db.pop(oldFileBlock)
+
+    def getLocations(self, fileBlockList, **kwd):
+        result = []
+        for name in fileBlockList:
+            self.queried.append(name)
+            if not self.db.has_key(name):
+                if kwd.get("errorTolerant"): continue
+                raise DlsApiError("No such block: %s" % name)
+            locs = self.db[name]
+            if kwd.get("longList"):
+                locs = locs[:1]
+            result.append(DlsEntry(DlsFileBlock(name), [DlsLocation(h) for h in locs]))
+        return result
+
+    def getFileBlocks(self, locationList, **kwd):
+        if not isinstance(locationList, list):
+            locationList = [locationList]
+        self.queried.append(tuple(locationList))
+        result = []
+        for host in locationList:
+            for name in sorted(self.db):
+                if host in self.db[name] and not (kwd.get("custodial") and name.endswith("#3")):
+                    result.append(DlsEntry(DlsFileBlock(name), [DlsLocation(host)]))
+        return result
+
+
+class ExpandingApi(FakeApi):
+    """
+    In-memory DLS back-end that expands '/', patterns ('*' or '%') and
+    dataset names (without '#') to the matching FileBlocks
+    """
+
+    def getLocations(self, fileBlockList, **kwd):
+        if not isinstance(fileBlockList, list):
+            fileBlockList = [fileBlockList]
+        names = []
+        for name in fileBlockList:
+            if name == '/' or name.find('*') != -1 or name.find('%') != -1:
+                prefix = name.replace('%', '*').split('*')[0]
+                names.extend([n for n in sorted(self.db) if n.startswith(prefix)])
+            elif name.find('#') == -1:
+                self.queried.append(name)
+                names.extend([n for n in sorted(self.db) if n.startswith(name + '#')])
+            else:
+                names.append(name)
+        return FakeApi.getLocations(self, names, **kwd)
+
+
+def hosts(entries):
+    return [(e.fileBlock.name, [l.host for l in e.locations]) for e in entries]
+
+
+class DlsCacheApiTest(unittest.TestCase):
+    """
+    TestCase for dlsCacheApi module
+    """
+
+    def setUp(self):
+        """
+        Code to execute to in preparation for the test
+        """
+        self.back = FakeApi()
+        self.back.add([DlsEntry(DlsFileBlock("/a#1"), [DlsLocation("se1"), DlsLocation("se2")]),
+                       DlsEntry(DlsFileBlock("/a#2"), [DlsLocation("se2")]),
+                       DlsEntry(DlsFileBlock("/a#3"), [DlsLocation("se3")])])
+        self.api = DlsCacheApi(self.back)
+
+    def testA_HitsAndOrder(self):
+        res = self.api.getLocations(["/a#2", "/a#1"])
+        self.assertEqual(hosts(res), [("/a#2", ["se2"]), ("/a#1", ["se1", "se2"])])
+        res = self.api.getLocations(["/a#1", DlsFileBlock("/a#3"), "/a#2"])
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"]), ("/a#3", ["se3"]), ("/a#2", ["se2"])])
+        self.assertEqual(self.back.queried, ["/a#2", "/a#1", "/a#3"])
+        stats = self.api.getCacheStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 3, 3))
+
+    def testB_ReturnedEntriesAreCopies(self):
+        res = self.api.getLocations("/a#1")
+        res[0].locations.append(DlsLocation("bogus"))
+        res = self.api.getLocations("/a#1")
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"])])
+
+    def testC_FlagsAreCached(self):
+        self.api.getLocations("/a#1")
+        res = self.api.getLocations("/a#1", longList = True)
+        self.assertEqual(hosts(res), [("/a#1", ["se1"])])
+        self.assertEqual(self.back.queried, ["/a#1", "/a#1"])
+
+    def testD_Expiration(self):
+        api = DlsCacheApi(self.back, ttl = 0.2)
+        api.getLocations("/a#1")
+        api.getLocations("/a#1")
+        time.sleep(0.3)
+        api.getLocations("/a#1")
+        self.assertEqual(self.back.queried, ["/a#1", "/a#1"])
+
+    def testE_NegativeEntries(self):
+        res = self.api.getLocations(["/a#1", "/none"], errorTolerant = True)
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"])])
+        res = self.api.getLocations(["/none", "/a#1"], errorTolerant = True)
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"])])
+        self.assertEqual(self.back.queried, ["/a#1", "/none"])
+        self.assertEqual(self.api.getCacheStats()['negativeHits'], 1)
+        # Not tolerant: the back-end is asked (and raises)
+        self.assertRaises(DlsApiError, self.api.getLocations, "/none")
+
+    def testF_Invalidation(self):
+        self.api.getLocations(["/a#1", "/a#2"])
+        self.api.getLocations("/a#1", longList = True)
+        self.api.add([DlsEntry(DlsFileBlock("/a#1"), [DlsLocation("se9")])])
+        res = self.api.getLocations(["/a#1", "/a#2"])
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2", "se9"]), ("/a#2", ["se2"])])
+        self.api.delete([DlsEntry(DlsFileBlock("/a#2"), [DlsLocation("se2")])])
+        res = self.api.getLocations("/a#2")
+        self.assertEqual(hosts(res), [("/a#2", [])])
+        self.api.renameFileBlock("/a#1", "/b#1")
+        res = self.api.getLocations(["/b#1", "/a#1"], errorTolerant = True)
+        self.assertEqual(hosts(res), [("/b#1", ["se1", "se2", "se9"])])
+        self.assertEqual(self.api.getCacheStats()['hits'], 1)
+
+    def testG_MemoryLimit(self):
+        self.back.add([DlsEntry(DlsFileBlock("/c#%d" % i), [DlsLocation("se%d" % i)])
+                       for i in range(100)])
+        self.api.getLocations("/c#0")
+        size = self.api.getCacheStats()['memory']
+        api = DlsCacheApi(self.back, maxMemory = size * 10 + size / 2)
+        api.getLocations(["/c#%d" % i for i in range(10)])
+        api.getLocations("/c#0")
+        api.getLocations(["/c#%d" % i for i in range(10, 15)])
+        stats = api.getCacheStats()
+        self.assert_(stats['memory'] <= size * 10 + size / 2)
+        self.assertEqual(stats['evictions'], 5)
+        # The least recently used ones are dropped (not /c#0)
+        del self.back.queried[:]
+        api.getLocations(["/c#0", "/c#1", "/c#9"])
+        self.assertEqual(self.back.queried, ["/c#1"])
+
+    def testH_PatternsNotCached(self):
+        self.assertRaises(DlsApiError, self.api.getLocations, ["/a#1", "/a#*"])
+        self.assertEqual(self.api.getCacheStats()['entries'], 0)
+
+    def testK_AllBlocksAndPatternsPassed(self):
+        back = ExpandingApi()
+        back.db = self.back.db
+        api = DlsCacheApi(back)
+        all = ["/a#1", "/a#2", "/a#3"]
+        for query, expected in [("/", all), ("/a#%", all), (["/a#1", "/a#*"], ["/a#1"] + all)]:
+            for tolerant in (False, True):
+                res = api.getLocations(query, errorTolerant = tolerant)
+                self.assertEqual([e.fileBlock.name for e in res], expected)
+        self.assertEqual(api.getCacheStats()['entries'], 0)
+
+    def testL_UnrequestedEntriesNotNegative(self):
+        back = ExpandingApi()
+        back.db = self.back.db
+        api = DlsCacheApi(back)
+        res = api.getLocations(["/a#1", "/a"], errorTolerant = True)
+        self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"]), ("/a#2", ["se2"]), ("/a#3", ["se3"])])
+        # Only the FileBlock asked for is cached (no negative entry for "/a")
+        self.assertEqual(api.getCacheStats()['entries'], 1)
+        res = api.getLocations("/a", errorTolerant = True)
+        self.assertEqual(len(res), 3)
+        self.assertEqual(back.queried.count("/a"), 2)
+
+    def testI_DiskCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "cache.db")
+            api1 = DlsCacheApi(self.back, cacheFile = fname)
+            api1.getLocations(["/a#1", "/none"], errorTolerant = True)
+            api1.getLocations("/a#2", showProd = True)
+            # A new object (e.g. in another process) uses the file
+            api2 = DlsCacheApi(self.back, cacheFile = fname)
+            res = api2.getLocations(["/none", "/a#1"], errorTolerant = True)
+            self.assertEqual(hosts(res), [("/a#1", ["se1", "se2"])])
+            res = api2.getLocations("/a#2")
+            self.assertEqual(hosts(res), [("/a#2", ["se2"])])
+            self.assertEqual(self.back.queried, ["/a#1", "/none", "/a#2", "/a#2"])
+            stats = api2.getCacheStats()
+            self.assertEqual((stats['diskHits'], stats['negativeHits'], stats['misses']), (1, 1, 1))
+            # Changes through any object invalidate the file entries
+            api2.add([DlsEntry(DlsFileBlock("/a#1"), [DlsLocation("se9")])])
+            api3 = DlsCacheApi(self.back, cacheFile = fname)
+            res = api3.getLocations("/a#1")
+            self.assertEqual(hosts(res), [("/a#1", ["se1", "se2", "se9"])])
+            # Entries of other back-end servers are not used
+            other = FakeApi()
+            other.server = "other.host/dls"
+            other.add([DlsEntry(DlsFileBlock("/a#1"), [DlsLocation("se5")])])
+            res = DlsCacheApi(other, cacheFile = fname).getLocations("/a#1")
+            self.assertEqual(hosts(res), [("/a#1", ["se5"])])
+            # Nor those of other root paths of the same server
+            other = FakeApi()
+            other.root = "/other/dls"
+            other.add([DlsEntry(DlsFileBlock("/a#1"), [DlsLocation("se6")])])
+            res = DlsCacheApi(other, cacheFile = fname).getLocations("/a#1")
+            self.assertEqual(hosts(res), [("/a#1", ["se6"])])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testM_DiskCacheNotPickled(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "cache.db")
+            back = FakeApi()
+            fB = DlsFileBlock("/d#1", {"filesize": 10}, "guid-1")
+            locs = [DlsLocation("se1", {"atime": 5, "f_type": "P"}, "srm://se1/d1"),
+                    internLocation("se2")]
+            back.getLocations = lambda names, **kwd: [DlsEntry(fB, locs)]
+            DlsCacheApi(back, cacheFile = fname).getLocations("/d#1")
+            # Stored as text (no pickles), and built again when read
+            import sqlite3
+            conn = sqlite3.connect(fname)
+            rows = conn.execute("SELECT fileblock, locations FROM replicas").fetchall()
+            self.assertEqual(len(rows), 1)
+            self.assert_(rows[0][1].find("srm://se1/d1") != -1)
+            res = DlsCacheApi(FakeApi(), cacheFile = fname).getLocations("/d#1")
+            entry = res[0]
+            self.assertEqual((entry.fileBlock.name, entry.fileBlock.getGuid(), entry.fileBlock.attribs),
+                             ("/d#1", "guid-1", {"filesize": 10}))
+            self.assertEqual([(l.host, l.attribs, l.getSurl()) for l in entry.locations],
+                             [("se1", {"atime": 5, "f_type": "P"}, "srm://se1/d1"), ("se2", {}, "")])
+            self.assert_(entry.locations[1] is internLocation("se2"))
+            # Unreadable rows are ignored (the back-end is asked)
+            conn.execute("UPDATE replicas SET locations = 'cos\nsystem\n'")
+            conn.commit()
+            conn.close()
+            self.assertRaises(DlsApiError, DlsCacheApi(FakeApi(), cacheFile = fname).getLocations, "/d#1")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testN_FileBlocks(self):
+        res = self.api.getFileBlocks(["se2", "se3"])
+        expected = [("/a#1", ["se2"]), ("/a#2", ["se2"]), ("/a#3", ["se3"])]
+        self.assertEqual(hosts(res), expected)
+        self.assertEqual(hosts(self.api.getFileBlocks(["se2", DlsLocation("se3")])), expected)
+        self.assertEqual(hosts(self.api.getFileBlocks(["se3"], custodial = True)), [])
+        self.assertEqual(hosts(self.api.getFileBlocks(["se3"], custodial = True)), [])
+        self.assertEqual(self.back.queried, [("se2", "se3"), ("se3",)])
+        stats = self.api.getCacheStats()
+        self.assertEqual((stats['hits'], stats['negativeHits'], stats['misses']), (1, 1, 2))
+        # Any change through the cache removes all the results
+        self.api.add([DlsEntry(DlsFileBlock("/b#1"), [DlsLocation("se3")])])
+        res = self.api.getFileBlocks(["se2", "se3"])
+        self.assertEqual(hosts(res), expected + [("/b#1", ["se3"])])
+        self.assertEqual(len(self.back.queried), 3)
+
+    def testO_FileBlocksDiskCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "cache.db")
+            DlsCacheApi(self.back, cacheFile = fname).getFileBlocks("se2")
+            api = DlsCacheApi(self.back, cacheFile = fname)
+            res = api.getFileBlocks("se2")
+            self.assertEqual(hosts(res), [("/a#1", ["se2"]), ("/a#2", ["se2"])])
+            self.assertEqual(api.getCacheStats()['diskHits'], 1)
+            self.assertEqual(self.back.queried, [("se2",)])
+            # Changes through any object remove the stored results
+            api.delete([DlsEntry(DlsFileBlock("/a#2"), [DlsLocation("se2")])])
+            res = DlsCacheApi(self.back, cacheFile = fname).getFileBlocks("se2")
+            self.assertEqual(hosts(res), [("/a#1", ["se2"])])
+            self.assertEqual(len(self.back.queried), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testJ_DiskCacheConcurrentProcesses(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "cache.db")
+            self.back.add([DlsEntry(DlsFileBlock("/c#%d" % i), [DlsLocation("se%d" % i)])
+                           for i in range(200)])
+            pids = []
+            for p in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        for i in range(20):
+                            api = DlsCacheApi(self.back, cacheFile = fname, ttl = 1)
+                            names = ["/c#%d" % ((i * 7 + j) % 200) for j in range(50)]
+                            res = api.getLocations(names)
+                            api.delete([DlsEntry(DlsFileBlock(names[0]), [])])
+                            if (api.disk == None) or (len(res) != 50): break
+                        else:
+                            status = 0
+                    finally:
+                        os._exit(status)
+                pids.append(pid)
+            for pid in pids:
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Memory benchmark of the DLS data objects (dlsDataObjects module).
+
+Large numbers of DlsEntry objects (and DlsFile/DlsLocation pairs), like
+those returned by dumpEntries, getLocations or getFileLocs, are created in
+a forked child process, and the growth of its resident set size is shown
+as bytes per object.
+"""
+
+import getopt, os, sys, resource
+
+from dlsDataObjects import DlsFileBlock, DlsLocation, DlsEntry, DlsFile, internLocation
+
+
+############  CONSTANTS  ############
+
+NOBJECTS = 200000     # number of objects of each case
+NLOCS = 3             # locations per entry
+
+
+############  FUNCTIONS ############
+
+def usage():
+  print "Usage:"
+  print "\tDlsDataObjectsBenchmark.py [-n <objects>]"
+  print "\tDlsDataObjectsBenchmark.py  -h"
+  print "\nOptions:"
+  print "\t-h,--help \t\t\t Show usage information"
+  print "\t-n,--number <n> \t\t Number of objects of each case (default %d)" % NOBJECTS
+
+
+def entries(n):
+  """
+  DlsEntry objects with no attributes (e.g. from dumpEntries)
+  """
+  ses = ['srm%03d.site.org' % i for i in xrange(300)]
+  return [DlsEntry(DlsFileBlock('/Sample/Run-v1/RECO#%08d' % i),
+                   [DlsLocation(ses[(i + j) % 300]) for j in xrange(NLOCS)])
+          for i in xrange(n)]
+
+
+def entriesLong(n):
+  """
+  DlsEntry objects with attributes (e.g. from a PhEDEx getLocations)
+  """
+  ses = ['srm%03d.site.org' % i for i in xrange(300)]
+  return [DlsEntry(DlsFileBlock('/Sample/Run-v1/RECO#%08d' % i,
+                                {'bytes': '400189659660', 'files': '340', 'is_open': 'n'}),
+                   [DlsLocation(ses[(i + j) % 300], {'node': 'T2_XX', 'complete': 'y'})
+                    for j in xrange(NLOCS)])
+          for i in xrange(n)]
+
+
+def fileLocs(n):
+  """
+  DlsFile objects and their locations (e.g. from getFileLocs)
+  """
+  ses = ['srm%03d.site.org' % i for i in xrange(300)]
+  return dict([(DlsFile('/store/data/Run/Sample/RECO/%08d.root' % i),
+                [DlsLocation(ses[(i + j) % 300]) for j in xrange(NLOCS)])
+               for i in xrange(n)])
+
+
+def fileLocsShared(n):
+  """
+  DlsFile objects and their shared locations (e.g. from getFileLocs with shareLocations)
+  """
+  ses = ['srm%03d.site.org' % i for i in xrange(300)]
+  return dict([(DlsFile('/store/data/Run/Sample/RECO/%08d.root' % i),
+                [internLocation(ses[(i + j) % 300]) for j in xrange(NLOCS)])
+               for i in xrange(n)])
+
+
+def measure(func, n):
+  """
+  Runs func(n) in a forked child and returns the growth of its peak RSS (kB).
+  """
+  rfd, wfd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(rfd)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res = func(n)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    os.write(wfd, '%d' % rss)
+    os._exit(0)
+  os.close(wfd)
+  out = os.read(rfd, 1024)
+  os.close(rfd)
+  os.waitpid(pid, 0)
+  return int(out)
+
+
+########## MAIN ###########
+
+if __name__ == '__main__':
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help", "number="])
+  except getopt.GetoptError:
+    usage()
+    sys.exit(2)
+
+  n = NOBJECTS
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      usage()
+      sys.exit(0)
+    if o in ("-n", "--number"): n = int(a)
+
+  print "%-40s %12s %14s" % ('Case (%d objects)' % n, 'Memory (MB)', 'Bytes/object')
+  for label, func in [['DlsEntry (%d locations)' % NLOCS, entries],
+                      ['DlsEntry with attributes', entriesLong],
+                      ['DlsFile -> %d DlsLocation (dict)' % NLOCS, fileLocs],
+                      ['DlsFile -> %d shared DlsLocation (dict)' % NLOCS, fileLocsShared]]:
+    kb = measure(func, n)
+    print "%-40s %12.1f %14d" % (label, kb / 1024.0, kb * 1024 / n)
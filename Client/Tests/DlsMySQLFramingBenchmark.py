@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the message framing of the MySQL prototype DLS client
+(dlsMySQLApi module).
+
+A local socket server stands in for the DLS server: for each received
+request (a number), it replies with a message of that many bytes. The
+replies are received with the old framing code (string concatenation of
+the received chunks, partial sends of the remaining string slice) and with
+the current DlsMySQLApi.dls_send and dls_receive methods (sendall, and
+reception of the whole reply into a buffer allocated at once), and the
+best time (request and reply) and the throughput of each case are shown.
+"""
+
+import getopt, sys, time, socket, threading
+
+from dlsMySQLApi import DlsMySQLApi
+
+
+############  CONSTANTS  ############
+
+SIZES = [1, 10, 100]  # reply sizes (MB)
+REPEAT = 3            # receptions per case (the best time is kept)
+
+
+############  FUNCTIONS ############
+
+def usage():
+  print "Usage:"
+  print "\tDlsMySQLFramingBenchmark.py [-s <size>[,<size>...]] [-r <repetitions>]"
+  print "\tDlsMySQLFramingBenchmark.py  -h"
+  print "\nOptions:"
+  print "\t-h,--help \t\t\t Show usage information"
+  print "\t-s,--sizes <n,m,...> \t\t Reply sizes in MB (default %s)" % ','.join(map(str, SIZES))
+  print "\t-r,--repeat <n> \t\t Number of receptions of each case (default %d)" % REPEAT
+
+
+def recvAll(sock, n):
+  data = ''
+  while len(data) < n:
+    chunk = sock.recv(n - len(data))
+    if not chunk: return None
+    data += chunk
+  return data
+
+
+def serve(server):
+  """
+  Stand-in server: replies to each request with a message of the
+  requested size (same framing as the DLS server). Each connection is
+  served by its own thread.
+  """
+  while True:
+    conn, addr = server.accept()
+    t = threading.Thread(target = serveConnection, args = (conn,))
+    t.setDaemon(True)
+    t.start()
+
+
+def serveConnection(conn):
+  payload = ''
+  while True:
+    header = recvAll(conn, 16)
+    if header is None: break
+    size = int(recvAll(conn, int(header)))
+    if len(payload) != size: payload = 'x' * size
+    conn.sendall(str(size).zfill(16))
+    conn.sendall(payload)
+  conn.close()
+
+
+def oldSend(sock, msg):
+  """
+  The former DlsMySQLApi.dls_send
+  """
+  totalsent = 0
+  MSGLEN = len(msg)
+  sent = sock.send(str(MSGLEN).zfill(16))
+  if sent == 0:
+    raise RuntimeError, "Socket connection broken"
+  while totalsent < MSGLEN:
+    sent = sock.send(msg[totalsent:])
+    if sent == 0:
+      raise RuntimeError, "Socket connection broken"
+    totalsent = totalsent + sent
+
+
+def oldReceive(sock):
+  """
+  The former DlsMySQLApi.dls_receive
+  """
+  chunk = sock.recv(16)
+  if chunk == '':
+    raise RuntimeError, "Socket connection broken"
+  MSGLEN = int(chunk)
+  msg = ''
+  while len(msg) < MSGLEN:
+    chunk = sock.recv(MSGLEN - len(msg))
+    if chunk == '':
+      raise RuntimeError, "Socket connection broken"
+    msg = msg + chunk
+  return msg
+
+
+def measure(send, receive, size, repeat):
+  """
+  Asks repeat times for a reply of the specified size, and returns the
+  best time (s).
+  """
+  best = None
+  for i in xrange(repeat):
+    t = time.time()
+    send(str(size))
+    msg = receive()
+    t = time.time() - t
+    if len(msg) != size:
+      raise RuntimeError, "Wrong reply size: %d (expected %d)" % (len(msg), size)
+    del msg
+    if (best is None) or (t < best): best = t
+  return best
+
+
+########## MAIN ###########
+
+if __name__ == '__main__':
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hs:r:", ["help", "sizes=", "repeat="])
+  except getopt.GetoptError:
+    usage()
+    sys.exit(2)
+
+  sizes, repeat = SIZES, REPEAT
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      usage()
+      sys.exit(0)
+    if o in ("-s", "--sizes"): sizes = [int(x) for x in a.split(',')]
+    if o in ("-r", "--repeat"): repeat = int(a)
+
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(('127.0.0.1', 0))
+  server.listen(5)
+  t = threading.Thread(target = serve, args = (server,))
+  t.setDaemon(True)
+  t.start()
+  endpoint = '127.0.0.1:%d' % server.getsockname()[1]
+
+  # Old framing (on a plain socket)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.connect(server.getsockname())
+  old = [lambda msg: oldSend(sock, msg), lambda: oldReceive(sock)]
+
+  # Current framing (the DlsMySQLApi connection, kept open in a session)
+  api = DlsMySQLApi(endpoint, 0)
+  api.startSession()
+  api.dls_connect()
+  new = [api.dls_send, api.dls_receive]
+
+  print "%-10s %-16s %10s %16s" % ('Size (MB)', 'Framing', 'Time (s)', 'Throughput (MB/s)')
+  for mb in sizes:
+    for label, funcs in [['old', old], ['current', new]]:
+      t = measure(funcs[0], funcs[1], mb * 1048576, repeat)
+      print "%-10d %-16s %10.3f %16.1f" % (mb, label, t, mb / t)
+
+  api.endSession()
+  sock.close()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the parsers of PhEDEx data service replies (DLS-phedex).
+
+Synthetic blockReplicas and fileReplicas replies of the requested size
+are generated (both in XML and JSON format) and parsed with each of the
+available parsers. For each case, the best parsing time and the growth
+of the peak memory (resident set size) of a forked child process doing
+the parsing are shown.
+"""
+
+import getopt, os, sys, time, resource, tempfile, json
+
+from dlsXmlParser import DlsXmlParser, DLS_XML_SAX, DLS_XML_EXPAT
+from dlsJsonParser import DlsJsonParser
+
+
+############  CONSTANTS  ############
+
+NBLOCKS = 20000     # blocks in the blockReplicas reply
+NFBLOCKS = 50       # blocks in the fileReplicas reply
+NFILES = 1000       # files per block in the fileReplicas reply
+NREPLICAS = 4       # replicas per block/file
+NSES = 300          # distinct SEs
+REPEAT = 3          # parsing repetitions (the best time is kept)
+
+
+############  FUNCTIONS ############
+
+def usage():
+  print "Usage:"
+  print "\tDlsParserBenchmark.py [-b <blocks>] [-f <files per block>] [-r <repetitions>]"
+  print "\tDlsParserBenchmark.py  -h"
+  print "\nOptions:"
+  print "\t-h,--help \t\t\t Show usage information"
+  print "\t-b,--blocks <n> \t\t Number of blocks in the blockReplicas reply (default %d)" % NBLOCKS
+  print "\t-f,--files <n> \t\t\t Number of files per block in the fileReplicas reply (default %d)" % NFILES
+  print "\t-r,--repeat <n> \t\t Number of repetitions of each parsing (default %d)" % REPEAT
+
+
+def replicas(i):
+  return [{'se': 'srm%03d.site.org' % ((i + j) % NSES), 'node': 'T2_XX_%03d' % ((i + j) % NSES),
+           'bytes': 400189659660, 'files': 340, 'time_create': 1272485844, 'time_update': 1275047433,
+           'group': 'AnalysisOps', 'custodial': 'n', 'node_id': (i + j) % NSES,
+           'subscribed': 'y', 'complete': 'y'} for j in xrange(NREPLICAS)]
+
+
+def blockReplicas(nblocks):
+  blocks = []
+  for i in xrange(nblocks):
+    blocks.append({'name': '/Sample/Run-v1/RECO#%08d-0000-0000-0000-000000000000' % i,
+                   'bytes': 400189659660, 'files': 340, 'is_open': 'n', 'id': i,
+                   'replica': replicas(i)})
+  return blocks
+
+
+def fileReplicas(nblocks, nfiles):
+  blocks = []
+  for i in xrange(nblocks):
+    name = '/Sample/Run-v1/RECO#%08d-0000-0000-0000-000000000000' % i
+    files = []
+    for j in xrange(nfiles):
+      files.append({'name': '/store/data/Run/Sample/RECO/v1/%08d/%06d.root' % (i, j),
+                    'bytes': 2000000000, 'checksum': 'cksum:1234567890',
+                    'replica': [{'se': r['se'], 'node': r['node']} for r in replicas(i + j)]})
+    blocks.append({'name': name, 'bytes': 400189659660, 'files': nfiles, 'is_open': 'n',
+                   'id': i, 'file': files})
+  return blocks
+
+
+def xmlAttrs(obj):
+  return ' '.join(['%s="%s"' % (k, v) for k, v in obj.items() if not isinstance(v, list)])
+
+
+def writeXml(fname, call, blocks):
+  f = open(fname, 'w')
+  f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n')
+  f.write('<phedex request_call="%s" instance="prod">\n' % call)
+  for b in blocks:
+    f.write('<block %s>\n' % xmlAttrs(b))
+    for r in b.get('replica', []):
+      f.write('<replica %s/>\n' % xmlAttrs(r))
+    for fl in b.get('file', []):
+      f.write('<file %s>' % xmlAttrs(fl))
+      for r in fl['replica']:
+        f.write('<replica %s/>' % xmlAttrs(r))
+      f.write('</file>\n')
+    f.write('</block>\n')
+  f.write('</phedex>\n')
+  f.close()
+
+
+def writeJson(fname, call, blocks):
+  f = open(fname, 'w')
+  json.dump({'phedex': {'request_call': call, 'instance': 'prod', 'block': blocks}}, f)
+  f.close()
+
+
+def measure(func, fname, repeat):
+  """
+  Runs func(file object) repeat times in a forked child and returns
+  [best time (s), peak RSS growth (kB), number of returned elements].
+  """
+  rfd, wfd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(rfd)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for i in xrange(repeat):
+      f = open(fname)
+      t = time.time()
+      res = func(f)
+      t = time.time() - t
+      f.close()
+      if (best is None) or (t < best): best = t
+      n = len(res)
+      del res
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    os.write(wfd, '%f %d %d' % (best, rss, n))
+    os._exit(0)
+  os.close(wfd)
+  out = os.read(rfd, 1024)
+  os.close(rfd)
+  os.waitpid(pid, 0)
+  t, rss, n = out.split()
+  return [float(t), int(rss), int(n)]
+
+
+def cases():
+  """
+  Returns the list of parsing cases: [label, reply type, format, function]
+  """
+  sax = DlsXmlParser(DLS_XML_SAX)
+  exp = DlsXmlParser(DLS_XML_EXPAT)
+  jsn = DlsJsonParser()
+  shr = DlsXmlParser(DLS_XML_EXPAT, shareLocations = True)
+  return [
+    ['SAX   blockReplicas', 'blocks', 'xml', sax.xmlToEntries],
+    ['expat blockReplicas', 'blocks', 'xml', exp.xmlToEntries],
+    ['JSON  blockReplicas', 'blocks', 'json', jsn.xmlToEntries],
+    ['SAX   fileReplicas', 'files', 'xml', sax.xmlToFileLocs],
+    ['expat fileReplicas', 'files', 'xml', exp.xmlToFileLocs],
+    ['JSON  fileReplicas', 'files', 'json', jsn.xmlToFileLocs],
+    ['expat fileReplicas (shared)', 'files', 'xml', shr.xmlToFileLocs],
+  ]
+
+
+########## MAIN ###########
+
+if __name__ == '__main__':
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hb:f:r:", ["help", "blocks=", "files=", "repeat="])
+  except getopt.GetoptError:
+    usage()
+    sys.exit(2)
+
+  nblocks, nfiles, repeat = NBLOCKS, NFILES, REPEAT
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      usage()
+      sys.exit(0)
+    if o in ("-b", "--blocks"): nblocks = int(a)
+    if o in ("-f", "--files"): nfiles = int(a)
+    if o in ("-r", "--repeat"): repeat = int(a)
+
+  tmpdir = tempfile.mkdtemp()
+  files = {}
+  try:
+    print "Generating replies in %s..." % tmpdir
+    bl = blockReplicas(nblocks)
+    fl = fileReplicas(NFBLOCKS, nfiles)
+    for kind, call, blocks in [['blocks', 'blockReplicas', bl], ['files', 'fileReplicas', fl]]:
+      for fmt, writer in [['xml', writeXml], ['json', writeJson]]:
+        fname = os.path.join(tmpdir, '%s.%s' % (call, fmt))
+        writer(fname, call, blocks)
+        files[(kind, fmt)] = fname
+    del bl, fl
+
+    print "\n%-28s %10s %10s %12s %10s" % ('Case', 'Size (MB)', 'Time (s)', 'Memory (MB)', 'Elements')
+    for label, kind, fmt, func in cases():
+      fname = files[(kind, fmt)]
+      t, rss, n = measure(func, fname, repeat)
+      size = os.path.getsize(fname) / 1048576.0
+      print "%-28s %10.1f %10.3f %12.1f %10d" % (label, size, t, rss / 1024.0, n)
+
+  finally:
+    for fname in files.values():
+      os.remove(fname)
+    os.rmdir(tmpdir)
@@ -277,6 +277,30 @@ class DlsPhedexApiTest(unittest.TestCase):
         self.C.locsFblockSeA = locs
 
 
+    def testM_SyncEntries(self):
+        print "\n\n########## Syncing a local mirror for pattern"
+        api = dlsClient.getDlsApi(dls_type=TYPE, dls_endpoint=ENDPOINT)
+        from dlsPhedexApi import DlsReplicaStore
+        store = DlsReplicaStore()
+
+        print "Full sync for pattern: %s" % fbPattern
+        entryList = api.syncEntries(store, fbPattern)
+        self.assertEqual(store.lastSync, store.lastFullSync)
+        fList = [x.fileBlock.name for x in store.getEntries()]
+        print "\nfList: %s" % fList
+        self.assertEqual(len(fList), len(self.C.fListFbPat))
+        for fb in fList:
+            self.assert_(fb in [x.name for x in self.C.fListFbPat])
+
+        print "Incremental sync for pattern: %s" % fbPattern
+        lastFull = store.lastFullSync
+        entryList = api.syncEntries(store, fbPattern)
+        print "\nUpdated: %s" % [x.fileBlock.name for x in entryList]
+        self.assertEqual(store.lastFullSync, lastFull)
+        self.assert_(store.lastSync >= lastFull)
+        self.assertEqual(len(store.getEntries()), len(fList))
+
+
 
 
 ########## MAIN ###########
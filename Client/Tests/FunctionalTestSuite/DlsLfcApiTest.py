@@ -556,7 +556,60 @@ class TestDlsApi_LFC_Trans(TestDlsApi_LFC):
        self.assertEqual(0, 1, msg)
 
 
-  # Test transactions on update 
+  # Test bulk addition with one failing location (among several)
+  def testBulkAddFailedLocation(self):
+
+     fB = DlsFileBlock("f1")
+     loc1 = DlsLocation("DlsApiTest-se1")
+     loc2 = DlsLocation("DlsApiTest-se2")
+     loc3 = DlsLocation("DlsApiTest-se3")
+
+     entry = DlsEntry(fB, [loc1])
+     try:
+       self.api.add(entry, checkLocations = False)
+     except DlsApiError, inst:
+       msg = "Error in add(%s): %s" % (entry, inst)
+       self.assertEqual(0, 1, msg)
+
+     # The replica in se1 exists already, so adding it fails
+     entry2 = DlsEntry(fB, [loc1, loc2, loc3])
+     try:
+       status = self.api.add(entry2, bulk = True, checkLocations = False)
+     except DlsApiError, inst:
+       msg = "Error in add(%s, bulk): %s" % (entry2, inst)
+       self.assertEqual(0, 1, msg)
+     msg = "The failed location was not reported (status: %s)" % (status)
+     self.assert_(status[0][1] != None, msg)
+
+     try:
+       res = self.api.getLocations(fB)
+     except DlsApiError, inst:
+       msg = "Error in getLocations(%s): %s" % (fB, inst)
+       self.assertEqual(0, 1, msg)
+     correct = (res[0].getLocation("DlsApiTest-se1") != None)
+     correct *= (res[0].getLocation("DlsApiTest-se2") != None)
+     correct *= (res[0].getLocation("DlsApiTest-se3") != None)
+     msg = "Locations were not correctly retrieved (entry: %s)" % (res[0])
+     self.assert_(correct, msg)
+
+     # Not errorTolerant: the failure is raised
+     try:
+       self.api.add(entry, bulk = True, checkLocations = False, errorTolerant = False)
+       msg = "Unexpected success in add(%s, bulk)" % (entry)
+       self.assertEqual(0, 1, msg)
+     except DlsApiError, inst:
+       pass
+
+     # Clean: Delete the entries
+     try:
+       self.api.delete(entry, all = True)
+       self.clean = False
+     except DlsApiError, inst:
+       msg = "Error in delete(%s): %s" % (entry, inst)
+       self.assertEqual(0, 1, msg)
+
+
+  # Test transactions on update
   def testUpdateTrans(self):
   
      fB = DlsFileBlock("f1")